@@ -1,9 +1,76 @@
+import functools
+import importlib
+import threading
+from urllib.parse import urlparse
+
+import flask
 from dash import Dash, dcc, html, callback
+from dash import _callback
 from dash.dependencies import Input, Output
-from pages import main_page, hw3_1_page
 
-app = Dash(__name__, suppress_callback_exceptions=True)
+from testapp.middleware import caching_middleware
+
+# url path -> module with the page's layout (a component, or a function
+# returning one) and its callbacks. Each page is imported by the first request
+# that belongs to it, not with the app, so a worker starts without loading
+# pandas, plotly and ibapi, and one serving the main page never loads them.
+PAGES = {
+    '/': 'pages.main_page',
+    '/homework_3.1': 'pages.hw3_1_page',
+}
+
+_pages_lock = threading.Lock()
+
+
+def load_pages(paths=PAGES):
+    # Import the pages at paths and hand the @callback registrations they
+    # make to the app. Dash only collects those itself on its first request.
+    with _pages_lock:
+        for path in paths:
+            importlib.import_module(PAGES[path])
+        for output in list(_callback.GLOBAL_CALLBACK_MAP):
+            app.callback_map[output] = _callback.GLOBAL_CALLBACK_MAP.pop(output)
+        app._callback_list.extend(_callback.GLOBAL_CALLBACK_LIST)
+        _callback.GLOBAL_CALLBACK_LIST.clear()
+
+
+def load_referring_page():
+    # Pages are only reached by loading their URL, so the renderer's _dash-*
+    # requests belong to the page in their Referer, which needn't have been
+    # served by this worker. Without one they might need any page.
+    path = urlparse(flask.request.referrer or '').path
+    load_pages([path] if path in PAGES else PAGES)
+
+
+class lazy_dash(Dash):
+    def _setup_server(self):
+        # Dash hands over the same registrations here
+        with _pages_lock:
+            super()._setup_server()
+
+    def index(self, *args, **kwargs):
+        if flask.request.path in PAGES:
+            load_pages([flask.request.path])
+        return super().index(*args, **kwargs)
+
+    def dependencies(self):
+        load_referring_page()
+        return super().dependencies()
+
+    def dispatch(self):
+        load_referring_page()
+        return super().dispatch()
+
+
+@functools.lru_cache(maxsize=None)
+def page_layout(pathname):
+    layout = importlib.import_module(PAGES[pathname]).layout
+    return layout() if callable(layout) else layout
+
+
+app = lazy_dash(__name__, suppress_callback_exceptions=True)
 server = app.server
+server.wsgi_app = caching_middleware(server.wsgi_app)
 app.layout = html.Div([
     dcc.Location(id='url', refresh=False),
     html.Div(id='page-content')
@@ -13,10 +80,8 @@ app.layout = html.Div([
 @callback(Output('page-content', 'children'),
           Input('url', 'pathname'))
 def display_page(pathname):
-    if pathname == '/':
-        return main_page.layout
-    elif pathname == '/homework_3.1':
-        return hw3_1_page.layout
+    if pathname in PAGES:
+        return page_layout(pathname)
     else:
         return '404'
 
@@ -0,0 +1,65 @@
+# Backtest throughput on synthetic bars: a moving-average crossover run
+# through backtest_signals, and the same strategy sending MKT orders through
+# replay.
+#
+#   python benchmarks/bench_backtest.py [n_bars]
+import os
+import sys
+import time
+
+import numpy as np
+from ibapi.order import Order
+
+# Run as a script from anywhere, the package isn't installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fintech_ibkr.backtest import backtest_signals, replay
+from fintech_ibkr.indicators import sma
+
+from bench_indicators import make_bars
+
+REPLAY_BARS = 200_000
+QUANTITY = 20_000
+
+
+def crossover_signal(bars):
+    close = bars['close']
+    return np.sign(close.rolling(10).mean() - close.rolling(50).mean()).to_numpy()
+
+
+def bench_signals(bars):
+    started = time.perf_counter()
+    result = backtest_signals(bars, crossover_signal(bars), quantity=QUANTITY, commission=2e-5)
+    return time.perf_counter() - started, result
+
+
+def bench_replay(bars):
+    # Incremental averages, as a strategy that can't see ahead has to do it
+    fast, slow = sma(10), sma(50)
+
+    def strategy(broker, bar):
+        fast_value, = fast.step(bar, commit=True)
+        slow_value, = slow.step(bar, commit=True)
+        if np.isnan(slow_value) or broker.open_orders:
+            return
+        target = QUANTITY if fast_value > slow_value else -QUANTITY
+        if target != broker.position:
+            order = Order()
+            order.action = 'BUY' if target > broker.position else 'SELL'
+            order.orderType = 'MKT'
+            order.totalQuantity = abs(target - broker.position)
+            broker.submit_order(order)
+
+    started = time.perf_counter()
+    result = replay(bars, strategy, commission=2e-5)
+    return time.perf_counter() - started, result
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5_000_000
+    bars = make_bars(n)
+    elapsed, result = bench_signals(bars)
+    print(f'backtest_signals: {n / elapsed / 1e6:6.1f}M bars/s, {result.summary()}')
+    bars = bars.iloc[:REPLAY_BARS]
+    elapsed, result = bench_replay(bars)
+    print(f'replay:           {len(bars) / elapsed / 1e3:6.0f}k bars/s, {result.summary()}')
@@ -0,0 +1,77 @@
+# Ingest throughput of ibkr_app.historicalData.
+#
+# Feeds synthetic bars straight into the wrapper callbacks (no TWS needed) and
+# compares the columnar bar_buffer path against the old one-row-DataFrame +
+# pd.concat approach, which is quadratic and so only run on a small sample.
+#
+#   python benchmarks/bench_bar_buffer.py [n_bars]
+import os
+import sys
+import time
+
+import pandas as pd
+from ibapi.common import BarData
+
+# Run as a script from anywhere, the package isn't installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fintech_ibkr.synchronous_functions import ibkr_app
+
+LEGACY_BARS = 5_000
+
+
+def make_bars(n, start=1_646_146_800):
+    bars = []
+    for i in range(n):
+        bar = BarData()
+        bar.date = str(start + i)
+        bar.open = 1.0 + i * 1e-5
+        bar.high = bar.open + 2e-4
+        bar.low = bar.open - 2e-4
+        bar.close = bar.open + 1e-4
+        bar.volume = 10
+        bar.average = bar.open
+        bar.barCount = 3
+        bars.append(bar)
+    return bars
+
+
+def bench_columnar(bars):
+    app = ibkr_app()
+    future = app.start_request(1)
+    started = time.perf_counter()
+    for bar in bars:
+        app.historicalData(1, bar)
+    app.historicalDataEnd(1, '', '')
+    elapsed = time.perf_counter() - started
+    assert len(future.result()) == len(bars)
+    return elapsed
+
+
+def bench_legacy(bars):
+    # formatDate=1 style strings, which is what the old code parsed
+    dates = [pd.Timestamp(int(bar.date), unit='s').strftime('%Y%m%d  %H:%M:%S')
+             for bar in bars]
+    data = pd.DataFrame(columns=['date', 'open', 'close', 'high', 'low'])
+    started = time.perf_counter()
+    for bar, date in zip(bars, dates):
+        record = pd.DataFrame({'date': [date], 'open': [bar.open],
+                               'high': [bar.high], 'low': [bar.low],
+                               'close': [bar.close]})
+        record['date'] = pd.to_datetime(record['date'])
+        data = pd.concat([data, record], ignore_index=True)
+    return time.perf_counter() - started
+
+
+if __name__ == '__main__':
+    n_bars = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    bars = make_bars(n_bars)
+
+    elapsed = bench_columnar(bars)
+    print(f'bar_buffer: {n_bars:>9,} bars in {elapsed:8.3f}s '
+          f'({n_bars / elapsed:>12,.0f} bars/s)')
+
+    legacy_n = min(n_bars, LEGACY_BARS)
+    elapsed = bench_legacy(bars[:legacy_n])
+    print(f'legacy    : {legacy_n:>9,} bars in {elapsed:8.3f}s '
+          f'({legacy_n / elapsed:>12,.0f} bars/s)')
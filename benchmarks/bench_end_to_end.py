@@ -0,0 +1,86 @@
+# End-to-end latency of fetch_historical_data and submit_order against the
+# local TWS simulator, through the real EClient sockets, session pool and
+# pacing scheduler.
+#
+# History requests stay inside IB's pacing budget (60 per 10 minutes, 5 per
+# contract), otherwise the scheduler's waits would be all this measures.
+#
+#   python benchmarks/bench_end_to_end.py [n_orders] [latency_seconds]
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from ibapi.contract import Contract
+from ibapi.order import Order
+
+# Run as a script from anywhere, the package isn't installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fintech_ibkr.simulator import tws_simulator
+from fintech_ibkr.synchronous_functions import fetch_historical_data, submit_order
+
+CONTRACTS = ['EUR', 'GBP', 'AUD', 'NZD', 'CHF', 'CAD', 'JPY', 'SEK', 'NOK', 'DKK']
+REQUESTS_PER_CONTRACT = 5
+CLIENT_ID = 900
+CONCURRENCY = 8
+
+
+def make_contract(symbol):
+    contract = Contract()
+    contract.symbol = symbol
+    contract.secType = 'CASH'
+    contract.exchange = 'IDEALPRO'
+    contract.currency = 'USD'
+    return contract
+
+
+def timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - started
+
+
+def report(name, seconds, wall):
+    ms = np.array(seconds) * 1000
+    print(f'{name:>12}: {len(ms)} calls in {wall:.2f}s, p50 {np.percentile(ms, 50):.1f} ms, '
+          f'p95 {np.percentile(ms, 95):.1f} ms, max {ms.max():.1f} ms')
+
+
+def bench_history(port, pool):
+    calls = [(make_contract(symbol), f'2026010{i + 1} 00:00:00')
+             for symbol in CONTRACTS for i in range(REQUESTS_PER_CONTRACT)]
+    started = time.perf_counter()
+    seconds = list(pool.map(
+        lambda call: timed(fetch_historical_data, call[0], call[1], '1 M', '1 hour',
+                           port=port, client_id=CLIENT_ID, use_cache=False), calls))
+    report('history', seconds, time.perf_counter() - started)
+
+
+def bench_orders(port, pool, n_orders):
+    contract = make_contract('EUR')
+
+    def place(_):
+        order = Order()
+        order.action = 'BUY'
+        order.orderType = 'MKT'
+        order.totalQuantity = 1000
+        return timed(submit_order, contract, order, port=port, client_id=CLIENT_ID)
+
+    started = time.perf_counter()
+    seconds = list(pool.map(place, range(n_orders)))
+    report('orders', seconds, time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+    n_orders = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.02
+    simulator = tws_simulator(port=0, latency=latency, enforce_pacing=True).start()
+    with ThreadPoolExecutor(CONCURRENCY) as pool:
+        bench_history(simulator.port, pool)
+        bench_orders(simulator.port, pool, n_orders)
+    print(f'pacing violations: {simulator.pacing_violations}')
+    # The session pool's EClient threads aren't daemons
+    sys.stdout.flush()
+    os._exit(0)
@@ -0,0 +1,76 @@
+# Cold start of the app, as a fresh worker (nssm restart, server.py
+# respawn) sees it.
+#
+# Each run is a new interpreter that imports app, then serves a page and the
+# renderer's first request for it (which load that page) through Flask's test
+# client, for each page. Prints the median over the runs, plus the modules
+# that dominate `import app`.
+#
+#   python benchmarks/bench_import_time.py [runs]
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOP_IMPORTS = 10
+
+RUN = """
+import json, sys, time
+path = sys.argv[1]
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.server.test_client()
+client.get(path)
+client.get('/_dash-dependencies', headers={'Referer': 'http://localhost' + path})
+served = time.perf_counter()
+print(json.dumps({'import app': imported - started,
+                  'first request': served - imported,
+                  'ready to serve': served - started}))
+"""
+
+
+def run_once(env, path):
+    output = subprocess.run([sys.executable, '-c', RUN, path], cwd=REPO, env=env, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def top_imports(env):
+    # -X importtime lines: "import time: self | cumulative | name", with
+    # name indented two more spaces per level of nesting and every module
+    # listed after the modules it imported
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=REPO,
+                            env=env, check=True, capture_output=True, text=True).stderr
+    rows = []
+    for line in stderr.splitlines()[1:]:
+        _, cumulative, name = line.split('|')
+        if not name.startswith('   '):
+            if name.strip() == 'app':
+                break
+            rows = []
+        elif not name.startswith('     '):
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:TOP_IMPORTS]
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    env = dict(os.environ)
+    env.setdefault('TESTAPP_DATA_PATH', tempfile.mkdtemp())
+    env['PYTHONPATH'] = REPO + os.pathsep + env.get('PYTHONPATH', '')
+    sys.path.insert(0, REPO)
+    os.environ.update(env)
+    from app import PAGES
+    for path in PAGES:
+        results = [run_once(env, path) for _ in range(runs)]
+        print(path)
+        for stage in results[0]:
+            print(f'  {stage:>15}: {statistics.median(r[stage] for r in results) * 1000:.0f} ms '
+                  f'(median of {runs})')
+    print('Imports made by app, cumulative:')
+    for microseconds, name in top_imports(env):
+        print(f'  {microseconds / 1000:8.1f} ms  {name}')
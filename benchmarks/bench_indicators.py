@@ -0,0 +1,73 @@
+# Indicator engine throughput: the whole history at once with compute(),
+# then streaming one bar at a time through update() (a frame, as the stream
+# callback has them) and step() (a bar_row), which should cost the same per
+# bar however much history came before it.
+#
+#   python benchmarks/bench_indicators.py [n_bars]
+import os
+import sys
+import time
+
+import pandas as pd
+
+# Run as a script from anywhere, the package isn't installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fintech_ibkr.indicators import STANDARD_INDICATORS, bar_rows, standard_engine
+from fintech_ibkr.simulator import synthetic_bars
+
+STREAMED_BARS = 2_000
+BAR_SECONDS = 60
+
+
+def make_bars(n, start=1_646_146_800):
+    bars = synthetic_bars('EUR.USD', start, start + n * BAR_SECONDS, BAR_SECONDS,
+                          skip_weekends=False)
+    frame = pd.DataFrame({column: bars[column] for column in
+                          ['open', 'high', 'low', 'close', 'volume']})
+    frame.insert(0, 'date', pd.to_datetime(bars['time'], unit='s'))
+    return frame.astype({'volume': 'float64'})
+
+
+def bench_compute(bars, keys):
+    started = time.perf_counter()
+    standard_engine(keys).compute(bars)
+    return time.perf_counter() - started
+
+
+def bench_update(bars, keys, history):
+    # Per bar, as the stream callback sees them: one-row frames
+    engine = standard_engine(keys)
+    engine.compute(bars.iloc[:history], forming=True)
+    streamed = [bars.iloc[i:i + 1] for i in range(history, history + STREAMED_BARS)]
+    started = time.perf_counter()
+    for frame in streamed:
+        engine.update(frame)
+    return (time.perf_counter() - started) / len(streamed)
+
+
+def bench_step(bars, keys, history):
+    engine = standard_engine(keys)
+    engine.compute(bars.iloc[:history], forming=True)
+    streamed = bar_rows(bars.iloc[history:history + STREAMED_BARS])
+    started = time.perf_counter()
+    for bar in streamed:
+        engine.step(bar)
+    return (time.perf_counter() - started) / len(streamed)
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    bars = make_bars(n + STREAMED_BARS)
+    history = bars.iloc[:n]
+    for key in STANDARD_INDICATORS:
+        elapsed = bench_compute(history, [key])
+        print(f'compute {key:>7}: {n / elapsed / 1e6:6.1f}M bars/s')
+    keys = list(STANDARD_INDICATORS)
+    elapsed = bench_compute(history, keys)
+    print(f'compute     all: {n / elapsed / 1e6:6.1f}M bars/s')
+    for size in (1_000, n):
+        per_bar = bench_update(bars, keys, size)
+        print(f'update after {size:>9} bars: {per_bar * 1e6:6.0f} us per bar, all indicators')
+        per_bar = bench_step(bars, keys, size)
+        print(f'step after   {size:>9} bars: {per_bar * 1e6:6.0f} us per bar, all indicators')
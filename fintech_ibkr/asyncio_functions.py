@@ -0,0 +1,379 @@
+# asyncio versions of the functions in synchronous_functions.
+#
+# One ibkr_async_client owns one connection to TWS and multiplexes any number
+# of concurrent requests over it: every request gets its own reqId and Future
+# in ibkr_app, and asyncio.wrap_future hands the result back to the event loop
+# through loop.call_soon_threadsafe when the reader thread resolves it. No
+# thread is parked per request.
+#
+#   import asyncio
+#   from fintech_ibkr import asyncio_functions as aio
+#
+#   async def main(contracts):
+#       return await asyncio.gather(*[aio.fetch_historical_data(c) for c in contracts])
+import asyncio
+import weakref
+from datetime import datetime
+
+import pandas as pd
+
+from fintech_ibkr.sessions import connect_leased, CONNECT_TIMEOUT_SECONDS
+from fintech_ibkr.client_ids import default_client_id_allocator
+from fintech_ibkr.bar_buffer import empty_bars
+from fintech_ibkr.bar_store import historical_bar_store, key_fields
+from fintech_ibkr.pacing import request_scheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from fintech_ibkr.synchronous_functions import ibkr_app, ibkr_request_error, \
+    is_no_data_error, historical_request_keys, contract_details_cache, contract_details_key, save_order, \
+    default_hostname, default_port, default_client_id, DEFAULT_TIMEOUT_SECONDS, \
+    CURRENT_TIME_TIMEOUT_SECONDS, CONTRACT_DETAILS_NEGATIVE_TTL_SECONDS
+from fintech_ibkr.caching import MISSING
+
+# Keep the asyncio connection clear of the client ids the synchronous session
+# pool prefers. The id actually used is leased, see client_ids.
+ASYNC_CLIENT_ID_OFFSET = 100
+default_async_client_id = default_client_id + ASYNC_CLIENT_ID_OFFSET
+# Requests a batch fetch keeps outstanding at once
+DEFAULT_MAX_IN_FLIGHT = 10
+
+
+class ibkr_async_client:
+    def __init__(self, hostname=default_hostname, port=default_port,
+                 client_id=default_async_client_id):
+        self.hostname = hostname
+        self.port = port
+        self.client_id = client_id
+        self.app = None
+        self.leased_client_id = None
+        self._next_request_id = 0
+        self._connect_lock = asyncio.Lock()
+
+    async def connected_app(self):
+        # Connect on first use and again whenever the link has dropped. The
+        # blocking connect handshake runs in the default executor.
+        if self.app is not None and self.app.isConnected():
+            return self.app
+        async with self._connect_lock:
+            if self.app is None or not self.app.isConnected():
+                self._release_client_id()
+                loop = asyncio.get_running_loop()
+                app, self.leased_client_id = await loop.run_in_executor(
+                    None, connect_leased, ibkr_app, self.hostname, self.port,
+                    self.client_id, default_client_id_allocator(), CONNECT_TIMEOUT_SECONDS)
+                self._next_request_id = max(self._next_request_id, app.next_valid_id)
+                self.app = app
+        return self.app
+
+    def next_request_id(self):
+        # Only ever called on the event loop thread, so no lock is needed.
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        return request_id
+
+    async def disconnect(self):
+        if self.app is not None and self.app.isConnected():
+            self.app.disconnect()
+        self.app = None
+        self._release_client_id()
+
+    def _release_client_id(self):
+        if self.leased_client_id is not None:
+            default_client_id_allocator().release(self.leased_client_id)
+            self.leased_client_id = None
+
+    async def fetch_managed_accounts(self):
+        app = await self.connected_app()
+        return app.managed_accounts
+
+    async def _wait(self, future, timeout):
+        # Wait for a scheduler Future without cancelling it on timeout: other
+        # callers may be sharing it. Returns False on timeout.
+        done, _ = await asyncio.wait({asyncio.wrap_future(future)}, timeout=timeout)
+        return bool(done)
+
+    async def request_historical_data(self, contract, endDateTime, durationStr,
+                                      barSizeSetting, whatToShow, useRTH,
+                                      timeout=DEFAULT_TIMEOUT_SECONDS,
+                                      priority=PRIORITY_INTERACTIVE):
+        app = await self.connected_app()
+        scheduler = request_scheduler()
+        tickerId = self.next_request_id()
+
+        def issue():
+            future = app.start_request(tickerId)
+            app.reqHistoricalData(
+                tickerId, contract, endDateTime, durationStr, barSizeSetting,
+                whatToShow, useRTH, formatDate=2, keepUpToDate=False, chartOptions=[])
+            return future
+
+        def abandon():
+            if app.isConnected():
+                app.cancelHistoricalData(tickerId)
+            app.finish_request(tickerId)
+
+        request_key, contract_key = historical_request_keys(
+            contract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH)
+        future = scheduler.submit(issue, request_key, contract_key, priority,
+                                  on_abandon=abandon)
+        try:
+            if not await self._wait(future, timeout):
+                raise TimeoutError(f'Historical data request {tickerId} timed out after {timeout}s')
+        except BaseException:
+            # Timed out or cancelled: the last caller to give up on a shared
+            # request has it cancelled.
+            scheduler.cancel(future)
+            raise
+        return future.result()
+
+    async def fetch_historical_data(self, contract, endDateTime='', durationStr='30 D',
+                                    barSizeSetting='1 hour', whatToShow='MIDPOINT',
+                                    useRTH=True, timeout=DEFAULT_TIMEOUT_SECONDS,
+                                    use_cache=True, priority=PRIORITY_INTERACTIVE):
+        store = historical_bar_store() if use_cache else None
+        if store is None:
+            return await self.request_historical_data(
+                contract, endDateTime, durationStr, barSizeSetting, whatToShow,
+                useRTH, timeout, priority)
+
+        # Same gap filling as the synchronous version, under the same per-key
+        # lock. Waiting for the lock and the store's file I/O run in the
+        # default executor so the loop isn't blocked.
+        loop = asyncio.get_running_loop()
+        fields = key_fields(contract, whatToShow, barSizeSetting, useRTH)
+        key = store.key(fields)
+        lock = store.lock(key)
+        await acquire_in_executor(lock)
+        try:
+            start, end, gaps = await loop.run_in_executor(
+                None, store.gap_requests, key, endDateTime, durationStr, barSizeSetting)
+            for gap in gaps:
+                try:
+                    bars = await self.request_historical_data(
+                        contract, gap.endDateTime, gap.durationStr, barSizeSetting,
+                        whatToShow, useRTH, timeout, priority)
+                except ibkr_request_error as e:
+                    if not is_no_data_error(e):
+                        raise
+                    bars = empty_bars()
+                await loop.run_in_executor(
+                    None, store.write, key, fields, bars, gap)
+            if start is None:
+                start = await loop.run_in_executor(None, store.window_start, key, durationStr, end)
+            return await loop.run_in_executor(None, store.read, key, start, end)
+        finally:
+            lock.release()
+
+    async def fetch_contract_details(self, contract, timeout=DEFAULT_TIMEOUT_SECONDS,
+                                     use_cache=True, priority=PRIORITY_INTERACTIVE):
+        key = contract_details_key(contract)
+        if use_cache:
+            cached = contract_details_cache.get(key)
+            if cached is not MISSING:
+                return cached
+
+        app = await self.connected_app()
+        scheduler = request_scheduler()
+        reqId = self.next_request_id()
+
+        def issue():
+            future = app.start_request(reqId)
+            app.reqContractDetails(reqId, contract)
+            return future
+
+        future = scheduler.submit(issue, ('contract_details',) + key, paced=False,
+                                  priority=priority,
+                                  on_abandon=lambda: app.finish_request(reqId))
+        try:
+            if not await self._wait(future, timeout):
+                raise TimeoutError(f'Contract details request {reqId} timed out after {timeout}s')
+        except BaseException:
+            scheduler.cancel(future)
+            raise
+        try:
+            details = future.result()
+        except ibkr_request_error as e:
+            print(f'Error from contract details api: errorCode={e.errorCode} errorMessage={e.errorString}')
+            details = []
+
+        if details:
+            contract_details_cache.set(key, details[-1])
+            return details[-1]
+        contract_details_cache.set(key, None, ttl=CONTRACT_DETAILS_NEGATIVE_TTL_SECONDS)
+        return None
+
+    async def submit_order(self, contract, order, timeout=DEFAULT_TIMEOUT_SECONDS):
+        app = await self.connected_app()
+        order_id = self.next_request_id()
+        current_time = asyncio.wrap_future(app.request_current_time())
+        future = asyncio.wrap_future(app.start_order(order_id))
+        app.placeOrder(order_id, contract, order)
+
+        succeeded = False
+        try:
+            await asyncio.wait_for(future, timeout)
+            succeeded = True
+        except ibkr_request_error as e:
+            print(f'Error from place order api: errorCode={e.errorCode} errorMessage={e.errorString}')
+        except ConnectionError as e:
+            print(e)
+        except asyncio.TimeoutError:
+            print(f'No status for order {order_id} after {timeout}s, cancelling it')
+            if app.isConnected():
+                app.cancelOrder(order_id)
+        finally:
+            app.finish_request(order_id)
+
+        if not succeeded:
+            msg = f'Order {order_id} did not succeed'
+        else:
+            msg = f'Order {order_id} successfully submitted'
+            try:
+                timestamp = await asyncio.wait_for(asyncio.shield(current_time),
+                                                   CURRENT_TIME_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                timestamp = datetime.now().astimezone().isoformat()
+            await asyncio.get_running_loop().run_in_executor(
+                None, save_order, contract, order, app, order_id, timestamp)
+
+        print(msg)
+        return msg
+
+
+async def acquire_in_executor(lock):
+    # Take a blocking lock without blocking the loop. If the caller is
+    # cancelled while waiting, the lock is given back as soon as it is taken.
+    acquired = asyncio.get_running_loop().run_in_executor(None, lock.acquire)
+    try:
+        await asyncio.shield(acquired)
+    except asyncio.CancelledError:
+        acquired.add_done_callback(
+            lambda done: done.cancelled() or done.exception() or lock.release())
+        raise
+
+
+# One shared client per event loop and connection settings.
+_clients = weakref.WeakKeyDictionary()
+
+
+def async_client(hostname=default_hostname, port=default_port,
+                 client_id=default_async_client_id):
+    clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    key = (hostname, port, client_id)
+    client = clients.get(key)
+    if client is None:
+        client = clients[key] = ibkr_async_client(hostname, port, client_id)
+    return client
+
+
+async def close_async_clients():
+    # Disconnect the running loop's clients and give back their client ids,
+    # for loops that are about to close (asyncio.run).
+    for client in _clients.pop(asyncio.get_running_loop(), {}).values():
+        await client.disconnect()
+
+
+async def fetch_managed_accounts(hostname=default_hostname, port=default_port,
+                                 client_id=default_async_client_id):
+    return await async_client(hostname, port, client_id).fetch_managed_accounts()
+
+
+async def fetch_historical_data(contract, endDateTime='', durationStr='30 D',
+                                barSizeSetting='1 hour', whatToShow='MIDPOINT',
+                                useRTH=True, hostname=default_hostname,
+                                port=default_port, client_id=default_async_client_id,
+                                timeout=DEFAULT_TIMEOUT_SECONDS, use_cache=True,
+                                priority=PRIORITY_INTERACTIVE):
+    return await async_client(hostname, port, client_id).fetch_historical_data(
+        contract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH,
+        timeout, use_cache, priority)
+
+
+async def fetch_contract_details(contract, hostname=default_hostname,
+                                 port=default_port, client_id=default_async_client_id,
+                                 timeout=DEFAULT_TIMEOUT_SECONDS, use_cache=True,
+                                 priority=PRIORITY_INTERACTIVE):
+    return await async_client(hostname, port, client_id).fetch_contract_details(
+        contract, timeout, use_cache, priority)
+
+
+async def submit_order(contract, order, hostname=default_hostname,
+                       port=default_port, client_id=default_async_client_id,
+                       timeout=DEFAULT_TIMEOUT_SECONDS):
+    return await async_client(hostname, port, client_id).submit_order(
+        contract, order, timeout)
+
+
+def contract_label(contract):
+    # 'AUD.CAD' for currency pairs, the plain symbol for everything else
+    if contract.secType == 'CASH':
+        return f'{contract.symbol}.{contract.currency}'
+    return contract.symbol
+
+
+async def iter_historical_data(contracts, endDateTime='', durationStr='30 D',
+                               barSizeSetting='1 hour', whatToShow='MIDPOINT',
+                               useRTH=True, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                               hostname=default_hostname, port=default_port,
+                               client_id=default_async_client_id,
+                               timeout=DEFAULT_TIMEOUT_SECONDS, use_cache=True,
+                               priority=PRIORITY_BACKGROUND):
+    # Yield (contract, bars) for each contract as soon as its request
+    # completes, with at most max_in_flight requests outstanding. A failed
+    # request yields its exception in place of the bars.
+    client = async_client(hostname, port, client_id)
+    in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def fetch_one(contract):
+        async with in_flight:
+            try:
+                return contract, await client.fetch_historical_data(
+                    contract, endDateTime, durationStr, barSizeSetting,
+                    whatToShow, useRTH, timeout, use_cache, priority)
+            except (ibkr_request_error, TimeoutError, ConnectionError) as e:
+                return contract, e
+
+    for completed in asyncio.as_completed([fetch_one(c) for c in contracts]):
+        yield await completed
+
+
+def combine_bars(frames, layout='long', value='close'):
+    # frames maps a label to its bars. 'long' stacks them with a symbol
+    # column; 'wide' puts one column of `value` per label on a shared,
+    # outer-joined date index.
+    if layout == 'wide':
+        if not frames:
+            return pd.DataFrame()
+        wide = pd.concat({label: bars.set_index('date')[value]
+                          for label, bars in frames.items()}, axis=1)
+        return wide.sort_index()
+    if not frames:
+        return empty_bars().assign(symbol=pd.Series(dtype=str))
+    return pd.concat([bars.assign(symbol=label) for label, bars in frames.items()],
+                     ignore_index=True)
+
+
+async def fetch_historical_data_batch(contracts, endDateTime='', durationStr='30 D',
+                                      barSizeSetting='1 hour', whatToShow='MIDPOINT',
+                                      useRTH=True, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                                      layout='long', on_result=None,
+                                      hostname=default_hostname, port=default_port,
+                                      client_id=default_async_client_id,
+                                      timeout=DEFAULT_TIMEOUT_SECONDS, use_cache=True,
+                                      priority=PRIORITY_BACKGROUND):
+    # Fetch the same bars for many contracts concurrently. on_result(label,
+    # bars) is called as each one arrives; the combined frame is returned once
+    # they have all finished. Failures are reported and left out.
+    frames = {}
+    async for contract, bars in iter_historical_data(
+            contracts, endDateTime, durationStr, barSizeSetting, whatToShow,
+            useRTH, max_in_flight, hostname, port, client_id, timeout, use_cache,
+            priority):
+        label = contract_label(contract)
+        if isinstance(bars, Exception):
+            print(f'Historical data for {label} failed: {bars}')
+            continue
+        frames[label] = bars
+        if on_result is not None:
+            on_result(label, bars)
+    # Results arrive in completion order; report them in the order asked for
+    labels = [contract_label(contract) for contract in contracts]
+    return combine_bars({label: frames[label] for label in labels if label in frames}, layout)
@@ -0,0 +1,238 @@
+# Replay order logic against historical bars instead of TWS.
+#
+#   bars = fetch_historical_data(contract, durationStr='1 Y', barSizeSetting='1 hour', ...)
+#
+#   # Vectorised: one target position per bar
+#   fast = bars['close'].rolling(10).mean()
+#   slow = bars['close'].rolling(50).mean()
+#   result = backtest_signals(bars, np.sign(fast - slow), quantity=20_000)
+#
+#   # Event driven: a callback per bar that sends ibapi Orders
+#   def strategy(broker, bar):
+#       if broker.position == 0 and bar.close < bar.open:
+#           order = Order()
+#           order.action, order.orderType, order.totalQuantity = 'BUY', 'MKT', 20_000
+#           broker.submit_order(order)
+#   result = replay(bars, strategy)
+#   result.summary()
+#
+# Both modes decide at a bar's close and trade from the next bar on, so a
+# strategy never fills at a price it has already seen. backtest_signals is
+# plain array arithmetic over the whole history; replay calls the strategy
+# once per bar for logic that depends on its own fills.
+#
+# replay takes the Orders place_trade builds: MKT and LMT, tif IOC (as for
+# crypto), GTC or DAY (the default), and cashQty in place of totalQuantity.
+# Orders fill in full: MKT at the next open, LMT at the limit or better once
+# a bar trades through it.
+import numpy as np
+import pandas as pd
+from ibapi.common import UNSET_DOUBLE
+
+from fintech_ibkr.indicators import bar_rows
+from fintech_ibkr.order_state import order_status_table
+
+EQUITY_COLUMNS = ['date', 'position', 'cash', 'equity']
+FILL_COLUMNS = ['order_id', 'date', 'action', 'quantity', 'price', 'commission']
+ORDER_TYPES = ('MKT', 'LMT')
+# '' is what Order() starts with, which TWS treats as DAY
+TIME_IN_FORCE = ('', 'DAY', 'GTC', 'IOC')
+# Order statuses kept by replay; fills are all kept regardless
+MAX_REPLAY_ORDERS = 100_000
+
+
+class backtest_result:
+    def __init__(self, equity, fills, initial_cash=0.0, orders=None):
+        # equity: EQUITY_COLUMNS at every bar's close
+        # fills: FILL_COLUMNS, one row per fill
+        # orders: replay's order_status_table
+        self.equity = equity
+        self.fills = fills
+        self.initial_cash = initial_cash
+        self.orders = orders
+
+    def summary(self):
+        equity = self.equity['equity'].to_numpy()
+        position = self.equity['position'].to_numpy()
+        if not len(equity):
+            return {'bars': 0, 'fills': 0, 'total_pnl': 0.0, 'max_drawdown': 0.0,
+                    'exposure': 0.0, 'final_position': 0.0}
+        return {
+            'bars': len(equity),
+            'fills': len(self.fills),
+            'total_pnl': float(equity[-1] - self.initial_cash),
+            'max_drawdown': float((np.maximum.accumulate(equity) - equity).max()),
+            # share of bars with a position open
+            'exposure': float((position != 0).mean()),
+            'final_position': float(position[-1]),
+        }
+
+
+def equity_frame(dates, position, cash, closes):
+    return pd.DataFrame({'date': dates, 'position': position, 'cash': cash,
+                         'equity': cash + position * closes})
+
+
+def backtest_signals(bars, signal, quantity=1, initial_cash=0.0, commission=0.0, slippage=0.0):
+    # signal: one value per bar, the position to hold (in multiples of
+    # quantity) as decided at that bar's close: 1 long, -1 short, 0 flat, or
+    # any size in between. NaN keeps the previous one. The position changes
+    # at the next bar's open, as a MKT order sent at the close would fill.
+    # commission and slippage are fractions of the traded notional and of
+    # the price.
+    signal = np.asarray(signal, dtype=np.float64)
+    if len(signal) != len(bars):
+        raise ValueError(f'{len(signal)} signals for {len(bars)} bars')
+    target = pd.Series(signal).ffill().fillna(0).to_numpy() * quantity
+    position = np.zeros(len(bars))
+    position[1:] = target[:-1]
+    traded = np.diff(position, prepend=0.0)
+
+    dates = bars['date'].values
+    price = bars['open'].to_numpy(dtype=np.float64) * (1 + slippage * np.sign(traded))
+    notional = traded * price
+    fees = np.abs(notional) * commission
+    cash = initial_cash - np.cumsum(notional + fees)
+
+    filled = np.flatnonzero(traded)
+    fills = pd.DataFrame({
+        'order_id': np.arange(1, len(filled) + 1),
+        'date': dates[filled],
+        'action': np.where(traded[filled] > 0, 'BUY', 'SELL'),
+        'quantity': np.abs(traded[filled]),
+        'price': price[filled],
+        'commission': fees[filled],
+    }, columns=FILL_COLUMNS)
+    equity = equity_frame(dates, position, cash, bars['close'].to_numpy(dtype=np.float64))
+    return backtest_result(equity, fills, initial_cash)
+
+
+class replay_broker:
+    # The strategy's view of the account as of the bar it is called for
+    def __init__(self, bars, initial_cash=0.0, commission=0.0, slippage=0.0):
+        self.bars = bars
+        self.index = -1
+        self.bar = None
+        self.position = 0.0
+        self.cash = initial_cash
+        self.commission = commission
+        self.slippage = slippage
+        self.orders = order_status_table(max_orders=MAX_REPLAY_ORDERS)
+        # order_id -> Order still working
+        self.open_orders = {}
+        # order_id -> day the order was submitted on, for DAY orders
+        self._order_days = {}
+        self.fills = []
+        self._next_order_id = 1
+        self._columns = {}
+
+    @property
+    def equity(self):
+        return self.cash + self.position * self.bar.close
+
+    def history(self, column):
+        # A bars column up to and including the current bar
+        values = self._columns.get(column)
+        if values is None:
+            values = self._columns[column] = self.bars[column].to_numpy()
+        return values[:self.index + 1]
+
+    def submit_order(self, order):
+        if order.orderType not in ORDER_TYPES:
+            raise ValueError(f'Unsupported order type {order.orderType!r}')
+        if order.action not in ('BUY', 'SELL'):
+            raise ValueError(f'Unsupported action {order.action!r}')
+        if order.tif not in TIME_IN_FORCE:
+            raise ValueError(f'Unsupported time in force {order.tif!r}')
+        if order.orderType == 'LMT' and order.lmtPrice == UNSET_DOUBLE:
+            raise ValueError('LMT order without a limit price')
+        if not order_quantity(order) and order.cashQty == UNSET_DOUBLE:
+            raise ValueError('Order without a quantity')
+        order_id = self._next_order_id
+        self._next_order_id += 1
+        self.open_orders[order_id] = order
+        if order.tif in ('', 'DAY') and self.bar is not None:
+            # Sent at this bar's close, so it expires when this day ends,
+            # even if the next bar it sees is already tomorrow's
+            self._order_days[order_id] = np.datetime64(self.bar.date, 'D')
+        self._status(order_id, order, 'Submitted')
+        return order_id
+
+    def cancel_order(self, order_id):
+        order = self.open_orders.pop(order_id, None)
+        if order is not None:
+            self._order_days.pop(order_id, None)
+            self._status(order_id, order, 'Cancelled')
+
+    def _execute(self, bar):
+        # Working orders against the bar that just opened
+        day = None
+        for order_id, order in list(self.open_orders.items()):
+            if order.tif in ('', 'DAY'):
+                day = np.datetime64(bar.date, 'D') if day is None else day
+                if self._order_days.setdefault(order_id, day) != day:
+                    self.cancel_order(order_id)
+                    continue
+            price = fill_price(order, bar, self.slippage)
+            if price is not None:
+                self._fill(order_id, order, bar, price)
+            elif order.tif == 'IOC':
+                self.cancel_order(order_id)
+
+    def _fill(self, order_id, order, bar, price):
+        quantity = order_quantity(order) or order.cashQty / price
+        signed = quantity if order.action == 'BUY' else -quantity
+        notional = signed * price
+        fee = abs(notional) * self.commission
+        self.cash -= notional + fee
+        self.position += signed
+        del self.open_orders[order_id]
+        self._order_days.pop(order_id, None)
+        self.fills.append((order_id, bar.date, order.action, quantity, price, fee))
+        self._status(order_id, order, 'Filled', quantity, price)
+
+    def _status(self, order_id, order, status, filled=0.0, price=0.0):
+        remaining = 0.0 if status in ('Filled', 'Cancelled') else order_quantity(order)
+        self.orders.update(order_id, status, filled, remaining, price, order_id, 0,
+                           price, 0, '', 0.0)
+
+
+def order_quantity(order):
+    # totalQuantity as a number; place_trade sends '' for cashQty orders
+    return float(order.totalQuantity or 0)
+
+
+def fill_price(order, bar, slippage=0.0):
+    # Where the order fills on this bar, None if it doesn't
+    buy = order.action == 'BUY'
+    if order.orderType == 'MKT':
+        return bar.open * (1 + slippage if buy else 1 - slippage)
+    limit = float(order.lmtPrice)
+    if buy:
+        if bar.open <= limit:
+            return bar.open
+        return limit if bar.low <= limit else None
+    if bar.open >= limit:
+        return bar.open
+    return limit if bar.high >= limit else None
+
+
+def replay(bars, strategy, initial_cash=0.0, commission=0.0, slippage=0.0):
+    # strategy(broker, bar) is called at every bar's close, after that bar's
+    # fills; orders it submits work from the next bar on. bar has date,
+    # open, high, low, close and volume; broker is a replay_broker.
+    broker = replay_broker(bars, initial_cash, commission, slippage)
+    rows = bar_rows(bars)
+    position = np.empty(len(rows))
+    cash = np.empty(len(rows))
+    for i, bar in enumerate(rows):
+        broker.index, broker.bar = i, bar
+        if broker.open_orders:
+            broker._execute(bar)
+        strategy(broker, bar)
+        position[i] = broker.position
+        cash[i] = broker.cash
+    fills = pd.DataFrame.from_records(broker.fills, columns=FILL_COLUMNS)
+    equity = equity_frame(bars['date'].values, position, cash,
+                          bars['close'].to_numpy(dtype=np.float64))
+    return backtest_result(equity, fills, initial_cash, broker.orders)
@@ -0,0 +1,142 @@
+# Append-only, columnar storage for bars arriving through
+# ibkr_app.historicalData.
+#
+# Each bar is appended to typed array.array columns (amortised O(1), no
+# per-bar DataFrame), and the whole request is turned into one DataFrame with
+# a single vectorised date conversion once TWS sends historicalDataEnd.
+import calendar
+import time
+from array import array
+
+import numpy as np
+import pandas as pd
+
+BAR_COLUMNS = ['date', 'open', 'high', 'low', 'close', 'volume', 'wap', 'count']
+
+# With formatDate=2 TWS sends intraday bar times as epoch seconds and daily
+# (and longer) bars as 'yyyymmdd'. 8 digits can only be the latter.
+DAILY_DATE_LENGTH = 8
+SECONDS_PER_HOUR = 3600
+
+
+def empty_bars():
+    return pd.DataFrame({
+        'date': pd.Series(dtype='datetime64[ns]'),
+        'open': pd.Series(dtype='float64'),
+        'high': pd.Series(dtype='float64'),
+        'low': pd.Series(dtype='float64'),
+        'close': pd.Series(dtype='float64'),
+        'volume': pd.Series(dtype='float64'),
+        'wap': pd.Series(dtype='float64'),
+        'count': pd.Series(dtype='int64'),
+    })
+
+
+def epoch_to_local(epoch_seconds):
+    # Bars have always been shown as naive datetimes in TWS local time, which
+    # is this machine's time zone since TWS runs on the same host. UTC offsets
+    # only change on hour boundaries, so look one up per distinct hour rather
+    # than per bar.
+    epoch_seconds = np.asarray(epoch_seconds, dtype=np.int64)
+    hours, inverse = np.unique(epoch_seconds // SECONDS_PER_HOUR, return_inverse=True)
+    offsets = np.fromiter(
+        (time.localtime(int(hour) * SECONDS_PER_HOUR).tm_gmtoff for hour in hours),
+        dtype=np.int64, count=len(hours))
+    return pd.to_datetime(epoch_seconds + offsets[inverse], unit='s')
+
+
+def _utc_offsets(local_seconds):
+    # The UTC offsets that give the local time local_seconds, earliest instant
+    # first: one normally, two in the hour repeated when clocks go back.
+    candidates = {time.localtime(local_seconds + shift).tm_gmtoff for shift in (-86400, 86400)}
+    offsets = [offset for offset in candidates if time.localtime(local_seconds - offset).tm_gmtoff == offset]
+    # A local time skipped when clocks go forward doesn't exist; treat it as
+    # still on the old offset.
+    return sorted(offsets, reverse=True) or [time.localtime(local_seconds - 86400).tm_gmtoff]
+
+
+def local_to_epoch(local_seconds):
+    # Inverse of epoch_to_local for naive local seconds in time order. Bars in
+    # the repeated hour when clocks go back take the earlier instant until the
+    # local time stops going forward, then the later one, so both copies of
+    # the hour survive.
+    local_seconds = np.asarray(local_seconds, dtype=np.int64)
+    hours, inverse = np.unique(local_seconds // SECONDS_PER_HOUR, return_inverse=True)
+    hour_offsets = [_utc_offsets(int(hour) * SECONDS_PER_HOUR) for hour in hours]
+    epoch_seconds = local_seconds - np.array([offsets[0] for offsets in hour_offsets], dtype=np.int64)[inverse]
+    if all(len(offsets) == 1 for offsets in hour_offsets):
+        return epoch_seconds
+    previous = None
+    later = False
+    for i, hour in enumerate(inverse):
+        offsets = hour_offsets[hour]
+        if len(offsets) == 1:
+            previous = None
+            later = False
+            continue
+        if previous is not None and local_seconds[i] <= previous:
+            later = True
+        if later:
+            epoch_seconds[i] = local_seconds[i] - offsets[-1]
+        previous = local_seconds[i]
+    return epoch_seconds
+
+
+def bar_local_seconds(date):
+    # Naive local time, in seconds, for a single bar's date field. Streaming
+    # updates arrive one bar at a time, so there's nothing to vectorise.
+    if len(date) == DAILY_DATE_LENGTH:
+        return calendar.timegm(time.strptime(date, '%Y%m%d'))
+    epoch = int(date)
+    return epoch + time.localtime(epoch).tm_gmtoff
+
+
+class bar_buffer:
+    __slots__ = ('time', 'open', 'high', 'low', 'close', 'volume', 'wap',
+                 'count', 'daily')
+
+    def __init__(self):
+        self.time = array('q')
+        self.open = array('d')
+        self.high = array('d')
+        self.low = array('d')
+        self.close = array('d')
+        self.volume = array('d')
+        self.wap = array('d')
+        self.count = array('q')
+        self.daily = False
+
+    def __len__(self):
+        return len(self.time)
+
+    def append(self, bar):
+        date = bar.date
+        if len(date) == DAILY_DATE_LENGTH:
+            self.daily = True
+        self.time.append(int(date))
+        self.open.append(bar.open)
+        self.high.append(bar.high)
+        self.low.append(bar.low)
+        self.close.append(bar.close)
+        self.volume.append(bar.volume)
+        self.wap.append(bar.average)
+        self.count.append(bar.barCount)
+
+    def to_frame(self):
+        if not len(self):
+            return empty_bars()
+        times = np.frombuffer(self.time, dtype=np.int64)
+        if self.daily:
+            dates = pd.to_datetime(times.astype(str), format='%Y%m%d')
+        else:
+            dates = epoch_to_local(times)
+        return pd.DataFrame({
+            'date': dates,
+            'open': np.frombuffer(self.open, dtype=np.float64).copy(),
+            'high': np.frombuffer(self.high, dtype=np.float64).copy(),
+            'low': np.frombuffer(self.low, dtype=np.float64).copy(),
+            'close': np.frombuffer(self.close, dtype=np.float64).copy(),
+            'volume': np.frombuffer(self.volume, dtype=np.float64).copy(),
+            'wap': np.frombuffer(self.wap, dtype=np.float64).copy(),
+            'count': np.frombuffer(self.count, dtype=np.int64).copy(),
+        })
@@ -0,0 +1,439 @@
+# On-disk cache of historical bars.
+#
+# Bars are stored per (contract, whatToShow, barSize, useRTH) as one .npy file
+# per column, so reads are memory-mapped slices rather than parses. Alongside
+# them meta.json records which time ranges have already been fetched from IB
+# ("coverage"), which lets fetch_historical_data ask IB only for the gaps.
+#
+# Each write adds only the bars it fetched, as a new segment directory; where
+# segments overlap (a bar refetched once it finished forming) the later one
+# wins. Once there are more than MAX_SEGMENTS they are compacted into one.
+# Writers to a key exclude each other across processes with an OS lock on
+# the key's lock file, and segments that drop out of meta.json are only
+# removed once no reader can still be using them.
+#
+# A durationStr in days, weeks, months or years means whatever IB makes of
+# it (trading days, calendar months, ...), so such a request is sent to IB as
+# it is the first time, and the window is taken from the first bar IB
+# returns. meta.json keeps that window per durationStr ("windows"); repeats of
+# the request, and "now" requests later the same day, reuse it and fetch only
+# what is missing from it. Second durations are exact and are always served
+# from the cache plus gap requests.
+#
+# Times are stored as UTC epoch seconds, so the hour repeated when clocks go
+# back keeps both of its bars, and turned back into the naive TWS-local
+# datetimes of fetch_historical_data's 'date' column on read.
+import hashlib
+import json
+import math
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from fintech_ibkr.bar_buffer import BAR_COLUMNS, empty_bars, epoch_to_local, local_to_epoch
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+DEFAULT_BAR_STORE_PATH = (
+    os.path.join(os.getenv('TESTAPP_DATA_PATH'), 'bar_cache')
+    if os.getenv('TESTAPP_DATA_PATH') else None
+)
+# A "now" query is answered from the cache if the part it hasn't seen yet is
+# shorter than this (or than one bar, whichever is smaller).
+MAX_TAIL_STALENESS_SECONDS = 60
+IB_DATETIME_FORMAT = '%Y%m%d %H:%M:%S'
+SECONDS_PER_DAY = 86400
+DAYS_PER_YEAR = 365
+# Segments per key before a write compacts them into one
+MAX_SEGMENTS = 16
+# How long a segment dropped from meta.json is kept for readers that loaded
+# the old meta.json just before
+SEGMENT_GRACE_SECONDS = 60
+# Bumped when the on-disk layout changes; keys written with another version
+# are fetched again from scratch.
+STORE_VERSION = 2
+
+# Calendar approximations of IB duration units, as the simulator uses them.
+# The store itself never trusts these for anything but seconds.
+DURATION_UNIT_SECONDS = {
+    'S': 1,
+    'D': SECONDS_PER_DAY,
+    'W': 7 * SECONDS_PER_DAY,
+    'M': 30 * SECONDS_PER_DAY,
+    'Y': DAYS_PER_YEAR * SECONDS_PER_DAY,
+}
+BAR_SIZE_UNIT_SECONDS = {
+    'sec': 1, 'secs': 1,
+    'min': 60, 'mins': 60,
+    'hour': 3600, 'hours': 3600,
+    'day': SECONDS_PER_DAY,
+    'week': 7 * SECONDS_PER_DAY,
+    'month': 30 * SECONDS_PER_DAY,
+}
+COLUMN_DTYPES = {
+    'time': np.int64, 'open': np.float64, 'high': np.float64,
+    'low': np.float64, 'close': np.float64, 'volume': np.float64,
+    'wap': np.float64, 'count': np.int64,
+}
+
+
+def duration_seconds(durationStr):
+    value, unit = durationStr.split()
+    return int(value) * DURATION_UNIT_SECONDS[unit.upper()]
+
+
+def bar_size_seconds(barSizeSetting):
+    value, unit = barSizeSetting.split()
+    return int(value) * BAR_SIZE_UNIT_SECONDS[unit.lower()]
+
+
+def to_seconds(moment):
+    # naive datetime -> int seconds on the same naive clock
+    return int((pd.Timestamp(moment) - pd.Timestamp(0)).total_seconds())
+
+
+def request_end(endDateTime):
+    # Epoch seconds an IB request's endDateTime (TWS local time) stands for.
+    if not endDateTime:
+        return int(time.time())
+    local = to_seconds(datetime.strptime(' '.join(endDateTime.split()[:2]), IB_DATETIME_FORMAT))
+    return int(local_to_epoch([local])[0])
+
+
+def normalize_duration(durationStr):
+    value, unit = durationStr.split()
+    return f'{int(value)} {unit.upper()}'
+
+
+def ib_request_params(start, end, is_now):
+    # endDateTime/durationStr for an IB request that covers [start, end).
+    # IB only takes second durations up to a day, then days, then years.
+    # Days and years may reach further back than start, which is harmless:
+    # the extra bars are cached too.
+    seconds = end - start
+    if seconds <= SECONDS_PER_DAY:
+        durationStr = f'{max(seconds, 1)} S'
+    elif seconds <= DAYS_PER_YEAR * SECONDS_PER_DAY:
+        durationStr = f'{math.ceil(seconds / SECONDS_PER_DAY)} D'
+    else:
+        durationStr = f'{math.ceil(seconds / (DAYS_PER_YEAR * SECONDS_PER_DAY))} Y'
+    endDateTime = '' if is_now else time.strftime(IB_DATETIME_FORMAT, time.localtime(end))
+    return endDateTime, durationStr
+
+
+# One IB request fetch_historical_data needs to make: [start, end) in epoch
+# seconds, the request parameters, and, for a request sent as the caller gave
+# it, the durationStr whose window the answer fixes (otherwise None). start is
+# None for such a request.
+gap_request = namedtuple('gap_request', ['start', 'end', 'endDateTime', 'durationStr', 'window'])
+
+
+def key_fields(contract, whatToShow, barSizeSetting, useRTH):
+    return dict(contract_fields(contract), whatToShow=whatToShow.upper(),
+                barSize=barSizeSetting, useRTH=bool(useRTH))
+
+
+def contract_fields(contract):
+    if getattr(contract, 'conId', 0):
+        return {'conId': contract.conId}
+    return {
+        'symbol': contract.symbol.upper(),
+        'secType': contract.secType.upper(),
+        'exchange': contract.exchange.upper(),
+        'currency': contract.currency.upper(),
+        'primaryExchange': (contract.primaryExchange or '').upper(),
+        'lastTradeDateOrContractMonth': contract.lastTradeDateOrContractMonth or '',
+        'strike': contract.strike,
+        'right': contract.right or '',
+        'multiplier': contract.multiplier or '',
+    }
+
+
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def subtract_ranges(start, end, covered):
+    # Parts of [start, end) not inside any of the merged covered ranges.
+    missing = []
+    cursor = start
+    for covered_start, covered_end in covered:
+        if covered_end <= cursor:
+            continue
+        if covered_start >= end:
+            break
+        if covered_start > cursor:
+            missing.append((cursor, covered_start))
+        cursor = max(cursor, covered_end)
+    if cursor < end:
+        missing.append((cursor, end))
+    return missing
+
+
+def _lock_file(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return
+    # LK_LOCK gives up after 10 attempts a second apart
+    while True:
+        try:
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+
+def _unlock_file(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+class key_lock:
+    # Exclusive access to one key of the store: a threading.Lock between the
+    # threads of this process, and an OS lock on the key's lock file between
+    # processes. The holder may release it from another thread.
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._fd = None
+
+    def acquire(self):
+        self._thread_lock.acquire()
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                _lock_file(fd)
+            except BaseException:
+                os.close(fd)
+                raise
+        except BaseException:
+            self._thread_lock.release()
+            raise
+        self._fd = fd
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        try:
+            _unlock_file(fd)
+        finally:
+            os.close(fd)
+            self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class bar_store:
+    def __init__(self, root=DEFAULT_BAR_STORE_PATH):
+        self.root = root
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    @staticmethod
+    def key(fields):
+        return hashlib.sha1(json.dumps(fields, sort_keys=True).encode()).hexdigest()[:20]
+
+    def lock(self, key):
+        with self._locks_lock:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = key_lock(os.path.join(self._key_path(key), 'lock'))
+            return lock
+
+    def _key_path(self, key):
+        return os.path.join(self.root, key)
+
+    def _meta(self, key):
+        try:
+            with open(os.path.join(self._key_path(key), 'meta.json')) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        if meta.get('version') != STORE_VERSION:
+            return None
+        return meta
+
+    def missing_ranges(self, key, start, end, bar_seconds, is_now=False):
+        meta = self._meta(key)
+        covered = meta['coverage'] if meta else []
+        missing = subtract_ranges(start, end, covered)
+        if is_now and missing:
+            tail_start, tail_end = missing[-1]
+            if tail_end == end and covered and tail_end - tail_start < min(bar_seconds, MAX_TAIL_STALENESS_SECONDS):
+                missing.pop()
+        # Where a gap starts at the end of cached data, back it up to a bar
+        # boundary so a bar that was still forming when cached is fetched again
+        # in full.
+        return [(s - s % bar_seconds if s > start else s, e) for s, e in missing]
+
+    def gap_requests(self, key, endDateTime, durationStr, barSizeSetting):
+        # The [start, end) window a request covers and the gap_requests needed
+        # to fill the parts not cached yet. start is None until the one gap
+        # request that fixes the window has been written; see window_start.
+        end = request_end(endDateTime)
+        is_now = not endDateTime
+        durationStr = normalize_duration(durationStr)
+        value, unit = durationStr.split()
+        if unit == 'S':
+            start = end - int(value)
+        else:
+            start = self._window_start(self._meta(key), durationStr, end, is_now)
+            if start is None:
+                return None, end, [gap_request(None, end, endDateTime, durationStr, durationStr)]
+        gaps = []
+        for gap_start, gap_end in self.missing_ranges(
+                key, start, end, bar_size_seconds(barSizeSetting), is_now):
+            gap_endDateTime, gap_durationStr = ib_request_params(
+                gap_start, gap_end, is_now and gap_end == end)
+            gaps.append(gap_request(gap_start, gap_end, gap_endDateTime, gap_durationStr, None))
+        return start, end, gaps
+
+    @staticmethod
+    def _window_start(meta, durationStr, end, is_now):
+        # Start of the window IB gave for durationStr, if it still applies to
+        # a request ending at end: the same end, or for "now" requests, a
+        # later end on the same day.
+        window = meta['windows'].get(durationStr) if meta else None
+        if window is None:
+            return None
+        window_end, window_start = window
+        if end == window_end or (is_now and end > window_end and
+                                 time.localtime(end)[:3] == time.localtime(window_end)[:3]):
+            return window_start
+        return None
+
+    def window_start(self, key, durationStr, end):
+        # Start of the window fixed by the gap request for durationStr ending
+        # at end, once it has been written.
+        return self._window_start(self._meta(key), normalize_duration(durationStr), end, False)
+
+    def _columns(self, key, segment):
+        # Memory-mapped, read-only column arrays of one segment.
+        path = os.path.join(self._key_path(key), segment['name'])
+        return {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+                for name in COLUMN_DTYPES}
+
+    def _read_segments(self, key, segments, start=None, end=None):
+        # Column arrays of the bars with start <= time < end, None if there
+        # are none.
+        parts = []
+        for segment in segments:
+            if (start is not None and segment['last'] < start) or \
+                    (end is not None and segment['first'] >= end):
+                continue
+            columns = self._columns(key, segment)
+            times = columns['time']
+            first = 0 if start is None else np.searchsorted(times, start)
+            last = len(times) if end is None else np.searchsorted(times, end)
+            if last > first:
+                parts.append({name: np.array(values[first:last]) for name, values in columns.items()})
+        if len(parts) <= 1:
+            return parts[0] if parts else None
+        data = {name: np.concatenate([part[name] for part in parts]) for name in COLUMN_DTYPES}
+        # Later segments win where they overlap. The last copy of each time,
+        # in time order:
+        times = data['time']
+        _, first_reversed = np.unique(times[::-1], return_index=True)
+        keep = len(times) - 1 - first_reversed
+        return {name: values[keep] for name, values in data.items()}
+
+    def read(self, key, start=None, end=None):
+        # Bars with start <= date < end (all bars if no bounds are given).
+        meta = self._meta(key)
+        data = self._read_segments(key, meta['segments'], start, end) if meta else None
+        if data is None:
+            return empty_bars()
+        frame = pd.DataFrame({'date': epoch_to_local(data.pop('time')), **data})
+        return frame[BAR_COLUMNS]
+
+    def _write_segment(self, key_path, data):
+        name = uuid.uuid4().hex
+        path = os.path.join(key_path, name)
+        os.makedirs(path)
+        for column, dtype in COLUMN_DTYPES.items():
+            np.save(os.path.join(path, f'{column}.npy'), np.asarray(data[column], dtype=dtype))
+        return {'name': name, 'first': int(data['time'][0]), 'last': int(data['time'][-1])}
+
+    def write(self, key, fields, bars, gap):
+        # Add the bars IB returned for a gap_request to the store. They cover
+        # the gap from wherever they start, or the whole gap for a gap request
+        # whose start was known. Callers hold self.lock(key).
+        meta = self._meta(key)
+        segments = list(meta['segments']) if meta else []
+        windows = dict(meta['windows']) if meta else {}
+        key_path = self._key_path(key)
+        os.makedirs(key_path, exist_ok=True)
+
+        first = gap.end
+        if len(bars):
+            times = local_to_epoch(bars['date'].to_numpy(dtype='datetime64[s]').astype(np.int64))
+            order = np.argsort(times, kind='stable')
+            times = times[order]
+            # The last copy of each time wins
+            keep = np.append(times[1:] != times[:-1], True)
+            data = {name: bars[name].to_numpy()[order][keep] for name in COLUMN_DTYPES if name != 'time'}
+            data['time'] = times[keep]
+            segments.append(self._write_segment(key_path, data))
+            first = int(data['time'][0])
+        if len(segments) > MAX_SEGMENTS:
+            segments = [self._write_segment(key_path, self._read_segments(key, segments))]
+
+        if gap.window is not None:
+            windows[gap.window] = [gap.end, first]
+            covered = [first, gap.end]
+        else:
+            covered = [min(gap.start, first), gap.end]
+        coverage = merge_ranges((meta['coverage'] if meta else []) + [covered])
+        new_meta = {'version': STORE_VERSION, 'key': fields, 'segments': segments,
+                    'coverage': coverage, 'windows': windows}
+        tmp_path = os.path.join(key_path, f'meta.{uuid.uuid4().hex}.json')
+        with open(tmp_path, 'w') as f:
+            json.dump(new_meta, f)
+        os.replace(tmp_path, os.path.join(key_path, 'meta.json'))
+
+        # A reader may have loaded the old meta.json and not mapped its
+        # segments yet, and mapped files can't be removed at all on Windows,
+        # so only remove what has been out of use for a while, best-effort.
+        live = {segment['name'] for segment in segments}
+        cutoff = time.time() - SEGMENT_GRACE_SECONDS
+        for entry in os.listdir(key_path):
+            entry_path = os.path.join(key_path, entry)
+            if entry not in live and os.path.isdir(entry_path) and os.path.getmtime(entry_path) < cutoff:
+                shutil.rmtree(entry_path, ignore_errors=True)
+
+
+_default_store = None
+
+
+def historical_bar_store():
+    # Shared store under TESTAPP_DATA_PATH, or None if that isn't configured.
+    global _default_store
+    if _default_store is None and DEFAULT_BAR_STORE_PATH is not None:
+        _default_store = bar_store(DEFAULT_BAR_STORE_PATH)
+    return _default_store
@@ -0,0 +1,196 @@
+# One process that owns the IB side of the app for several web workers.
+#
+# With `python server.py --workers N` the Dash app runs in N waitress
+# processes, so callback work spreads over N cores. Letting each of them open
+# its own IB connections would multiply client ids, pacing budgets and
+# caches, so instead one broker process holds the session pools, the
+# contract details cache and the streaming subscriptions, and the workers
+# call into it over a local multiprocessing.managers channel (a Unix socket,
+# or a named pipe on Windows).
+#
+# Code that should work either way imports the functions below instead of
+# the synchronous_functions / streaming ones. They call the broker when
+# TESTAPP_BROKER_ADDRESS is set (workers started by server.py) and run
+# in-process otherwise.
+import os
+import secrets
+import sys
+import tempfile
+import threading
+from multiprocessing.managers import BaseManager
+
+from fintech_ibkr import synchronous_functions
+from fintech_ibkr import streaming
+
+BROKER_ADDRESS_ENV = 'TESTAPP_BROKER_ADDRESS'
+BROKER_AUTHKEY_ENV = 'TESTAPP_BROKER_AUTHKEY'
+BROKER_PIPE_NAME = r'\\.\pipe\testapp-ibkr-broker'
+BROKER_SOCKET_NAME = 'ibkr_broker.sock'
+
+
+class ibkr_broker_service:
+    # What the broker serves. Arguments and results are pickled across the
+    # channel, so everything here takes and returns plain ibapi / pandas
+    # objects rather than live subscriptions.
+    def ping(self):
+        return os.getpid()
+
+    def fetch_managed_accounts(self, *args, **kwargs):
+        return synchronous_functions.fetch_managed_accounts(*args, **kwargs)
+
+    def fetch_contract_details(self, *args, **kwargs):
+        return synchronous_functions.fetch_contract_details(*args, **kwargs)
+
+    def fetch_historical_data(self, *args, **kwargs):
+        return synchronous_functions.fetch_historical_data(*args, **kwargs)
+
+    def submit_order(self, *args, **kwargs):
+        return synchronous_functions.submit_order(*args, **kwargs)
+
+    def stream_bars(self, stream_id, contract, barSizeSetting, whatToShow, useRTH,
+                    after=None, **kwargs):
+        return local_stream_bars(stream_id, contract, barSizeSetting, whatToShow, useRTH,
+                                 after, **kwargs)
+
+    def stop_stream(self, stream_id):
+        streaming.stop_stream(stream_id)
+
+    def stats(self):
+        return {'pid': os.getpid(), 'streams': streaming.default_subscription_broker().stats()}
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def broker_service():
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = ibkr_broker_service()
+        return _service
+
+
+class broker_server_manager(BaseManager):
+    pass
+
+
+class broker_client_manager(BaseManager):
+    pass
+
+
+broker_server_manager.register('ibkr', callable=broker_service)
+broker_client_manager.register('ibkr')
+
+
+def default_broker_address():
+    if sys.platform == 'win32':
+        return BROKER_PIPE_NAME
+    return os.path.join(os.getenv('TESTAPP_DATA_PATH') or tempfile.gettempdir(), BROKER_SOCKET_NAME)
+
+
+def new_broker_authkey():
+    return secrets.token_hex(16)
+
+
+def serve_broker(address, authkey, warm=None):
+    # Run the broker until the process is killed. warm() is called in a
+    # thread once it is listening, e.g. to pre-load caches.
+    if sys.platform != 'win32' and os.path.exists(address):
+        # Left behind by a broker that didn't shut down cleanly
+        os.remove(address)
+    server = broker_server_manager(address=address, authkey=authkey.encode()).get_server()
+    print(f'IB broker {os.getpid()} listening on {address}')
+    if warm is not None:
+        threading.Thread(target=warm, daemon=True).start()
+    server.serve_forever()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def broker_client():
+    # Proxy to the broker service when this process is a worker, else None.
+    # One proxy serves every thread: it opens a connection per thread.
+    global _client
+    address = os.getenv(BROKER_ADDRESS_ENV)
+    if not address:
+        return None
+    with _client_lock:
+        if _client is None:
+            manager = broker_client_manager(address=address,
+                                            authkey=os.environ[BROKER_AUTHKEY_ENV].encode())
+            try:
+                manager.connect()
+                client = manager.ibkr()
+            except (OSError, EOFError):
+                # Broker not up (yet) or gone: no socket, or nobody listening.
+                # Nothing is cached, so the next call tries again.
+                raise ConnectionError(f'Cannot reach the IB broker process at {address}')
+            _client = client
+        return _client
+
+
+def _reset_client():
+    global _client
+    with _client_lock:
+        _client = None
+
+
+def _call(name, *args, **kwargs):
+    client = broker_client()
+    try:
+        return getattr(client, name)(*args, **kwargs)
+    except (EOFError, BrokenPipeError, ConnectionRefusedError, ConnectionResetError):
+        # Broker restarted: reconnect on the next call. Not retried here, a
+        # repeated submit_order could place the order twice.
+        _reset_client()
+        raise ConnectionError('Lost the connection to the IB broker process')
+
+
+def local_stream_bars(stream_id, contract, barSizeSetting, whatToShow, useRTH, after=None,
+                      **kwargs):
+    subscription = streaming.stream_for(stream_id, contract, barSizeSetting, whatToShow,
+                                        useRTH, **kwargs)
+    return subscription.bars.to_frame(after=after)
+
+
+def fetch_managed_accounts(*args, **kwargs):
+    if broker_client() is None:
+        return synchronous_functions.fetch_managed_accounts(*args, **kwargs)
+    return _call('fetch_managed_accounts', *args, **kwargs)
+
+
+def fetch_contract_details(*args, **kwargs):
+    if broker_client() is None:
+        return synchronous_functions.fetch_contract_details(*args, **kwargs)
+    return _call('fetch_contract_details', *args, **kwargs)
+
+
+def fetch_historical_data(*args, **kwargs):
+    if broker_client() is None:
+        return synchronous_functions.fetch_historical_data(*args, **kwargs)
+    return _call('fetch_historical_data', *args, **kwargs)
+
+
+def submit_order(*args, **kwargs):
+    if broker_client() is None:
+        return synchronous_functions.submit_order(*args, **kwargs)
+    return _call('submit_order', *args, **kwargs)
+
+
+def stream_bars(stream_id, contract, barSizeSetting, whatToShow, useRTH, after=None, **kwargs):
+    # Bars of the stream_id viewer's subscription (see streaming.stream_for)
+    # after the given bar time, as a frame.
+    if broker_client() is None:
+        return local_stream_bars(stream_id, contract, barSizeSetting, whatToShow, useRTH,
+                                 after, **kwargs)
+    return _call('stream_bars', stream_id, contract, barSizeSetting, whatToShow, useRTH,
+                 after, **kwargs)
+
+
+def stop_stream(stream_id):
+    if broker_client() is None:
+        return streaming.stop_stream(stream_id)
+    return _call('stop_stream', stream_id)
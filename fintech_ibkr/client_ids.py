@@ -0,0 +1,152 @@
+# Client id leases, so concurrent connections never clash.
+#
+# TWS refuses (error 326) or drops a socket whose client id is already
+# connected. Every connection therefore leases its id here first. A lease is
+# an exclusive OS lock on TESTAPP_DATA_PATH/client_ids/<id>.lock, held for as
+# long as the connection lives, so threads and worker processes on the same
+# machine never hand out the same id twice, and a crashed process gives its
+# ids back the moment the OS closes its files.
+#
+# The range ids are leased from is TESTAPP_CLIENT_IDS ("first-last"), by
+# default 10645-10844.
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+DEFAULT_CLIENT_ID_RANGE = (10645, 10844)
+# How long an id TWS said was taken is passed over
+REJECTED_CLIENT_ID_SECONDS = 60
+CLIENT_ID_LOCK_PATH = (
+    os.path.join(os.getenv('TESTAPP_DATA_PATH'), 'client_ids')
+    if os.getenv('TESTAPP_DATA_PATH') else None
+)
+
+
+class client_id_in_use(ConnectionError):
+    # TWS already has a connection with this id, from something that doesn't
+    # lease from the allocator (another tool, a process on another machine)
+    pass
+
+
+class client_ids_exhausted(RuntimeError):
+    pass
+
+
+def client_id_range():
+    text = os.getenv('TESTAPP_CLIENT_IDS')
+    if not text:
+        return DEFAULT_CLIENT_ID_RANGE
+    first, last = text.split('-')
+    return int(first), int(last)
+
+
+def _try_lock(fd):
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+
+def _unlock(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+class client_id_allocator:
+    # path=None only coordinates the threads of this process.
+    def __init__(self, first=None, last=None, path=CLIENT_ID_LOCK_PATH, timer=time.monotonic):
+        default_first, default_last = client_id_range()
+        self.first = default_first if first is None else first
+        self.last = default_last if last is None else last
+        self.path = path
+        self.timer = timer
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        # client id -> lock file descriptor (None without a path)
+        self._held = {}
+        # client id -> when to try it again
+        self._rejected = {}
+
+    def lease(self, preferred=None, exclude=()):
+        # The preferred id if it is free (so a single process keeps the ids
+        # it always had), otherwise the lowest free id in the range.
+        candidates = range(self.first, self.last + 1)
+        if preferred is not None:
+            candidates = [preferred] + [i for i in candidates if i != preferred]
+        with self._lock:
+            now = self.timer()
+            for client_id in candidates:
+                if client_id in self._held or client_id in exclude:
+                    continue
+                if self._rejected.get(client_id, now) > now:
+                    continue
+                if self._acquire(client_id):
+                    return client_id
+        raise client_ids_exhausted(
+            f'All client ids {self.first}-{self.last} are leased')
+
+    def release(self, client_id):
+        with self._lock:
+            if client_id not in self._held:
+                return
+            fd = self._held.pop(client_id)
+            if fd is not None:
+                try:
+                    _unlock(fd)
+                finally:
+                    os.close(fd)
+
+    def reject(self, client_id):
+        # TWS turned client_id down: give it back and pass it over for a while
+        self.release(client_id)
+        with self._lock:
+            self._rejected[client_id] = self.timer() + REJECTED_CLIENT_ID_SECONDS
+
+    def release_all(self):
+        for client_id in self.leased():
+            self.release(client_id)
+
+    def leased(self):
+        with self._lock:
+            return sorted(self._held)
+
+    def _acquire(self, client_id):
+        if self.path is None:
+            self._held[client_id] = None
+            return True
+        fd = os.open(os.path.join(self.path, f'{client_id}.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        if not _try_lock(fd):
+            os.close(fd)
+            return False
+        # The owner's pid, only for whoever is looking at the files
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._held[client_id] = fd
+        return True
+
+
+_default_allocator = None
+_default_allocator_lock = threading.Lock()
+
+
+def default_client_id_allocator():
+    global _default_allocator
+    with _default_allocator_lock:
+        if _default_allocator is None:
+            _default_allocator = client_id_allocator()
+        return _default_allocator
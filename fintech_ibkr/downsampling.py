@@ -0,0 +1,72 @@
+# Server-side OHLC aggregation so a chart never gets more candles than it can
+# show.
+#
+# Bars are grouped into equal time buckets (so gaps like weekends stay gaps)
+# and each bucket is reduced in one vectorised pass with ufunc.reduceat:
+# first open, max high, min low, last close, summed volume and count, and a
+# volume-weighted wap.
+import numpy as np
+import pandas as pd
+
+DEFAULT_TARGET_CANDLES = 2000
+# Share of the candle budget spent outside a zoomed viewport, so the chart
+# can still be panned and the range slider still shows the whole history
+CONTEXT_FRACTION = 0.25
+NANOSECONDS_PER_SECOND = 1_000_000_000
+
+
+def aggregate_bars(bars, target=DEFAULT_TARGET_CANDLES):
+    # bars: a fetch_historical_data frame sorted by date. Returns at most
+    # about `target` candles covering the same span.
+    n = len(bars)
+    if n <= target or target <= 0:
+        return bars
+    seconds = bars['date'].values.astype('datetime64[s]').astype(np.int64)
+    width = max(1, -(-int(seconds[-1] - seconds[0] + 1) // target))
+    buckets = seconds // width
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+    ends = np.append(starts[1:], n) - 1
+
+    volume = bars['volume'].values
+    bucket_volume = np.add.reduceat(volume, starts)
+    aggregated = {
+        # Each candle sits at its first bar, so neighbouring candles never collide
+        'date': bars['date'].values[starts],
+        'open': bars['open'].values[starts],
+        'high': np.maximum.reduceat(bars['high'].values, starts),
+        'low': np.minimum.reduceat(bars['low'].values, starts),
+        'close': bars['close'].values[ends],
+        'volume': bucket_volume,
+    }
+    if 'wap' in bars:
+        # MIDPOINT and friends have no volume; fall back to a plain mean
+        wap = bars['wap'].values
+        weighted = np.add.reduceat(wap * volume, starts)
+        mean = np.add.reduceat(wap, starts) / (ends - starts + 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            aggregated['wap'] = np.where(bucket_volume > 0, weighted / bucket_volume, mean)
+    if 'count' in bars:
+        aggregated['count'] = np.add.reduceat(bars['count'].values, starts)
+    return pd.DataFrame(aggregated)
+
+
+def downsample_bars(bars, target=DEFAULT_TARGET_CANDLES, start=None, end=None,
+                    context_fraction=CONTEXT_FRACTION):
+    # Aggregate for a viewport [start, end] (anything pd.Timestamp accepts,
+    # None for open-ended). The viewport gets `target` candles; the bars on
+    # either side share context_fraction * target between them.
+    if start is None and end is None:
+        return aggregate_bars(bars, target)
+    dates = bars['date'].values
+    lo = 0 if start is None else int(np.searchsorted(dates, pd.Timestamp(start).to_datetime64(), 'left'))
+    hi = len(bars) if end is None else int(np.searchsorted(dates, pd.Timestamp(end).to_datetime64(), 'right'))
+    hi = max(lo, hi)
+    outside = lo + len(bars) - hi
+    context = int(target * context_fraction)
+    parts = []
+    if lo:
+        parts.append(aggregate_bars(bars.iloc[:lo], max(1, context * lo // outside)))
+    parts.append(aggregate_bars(bars.iloc[lo:hi], target))
+    if hi < len(bars):
+        parts.append(aggregate_bars(bars.iloc[hi:], max(1, context * (len(bars) - hi) // outside)))
+    return pd.concat(parts, ignore_index=True)
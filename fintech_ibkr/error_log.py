@@ -0,0 +1,158 @@
+# Bounded record of the errors and notices TWS sends through
+# ibkr_app.error.
+#
+# A long-lived connection gets a steady trickle of farm status messages
+# (2104, 2168, 2169, ...), so errors go into a fixed-size ring with per-code
+# counters instead of a DataFrame that grows forever. Logging goes through a
+# QueueHandler, so the reader thread never waits on a console, and each code
+# is rate limited so a flapping farm can't flood the log.
+import atexit
+import itertools
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+
+import pandas as pd
+
+DEFAULT_ERROR_CAPACITY = 1000
+# Per error code: at most LOG_BURST lines every LOG_INTERVAL_SECONDS
+LOG_BURST = 5
+LOG_INTERVAL_SECONDS = 60
+# reqIds whose latest error is kept for wait_for
+MAX_TRACKED_REQUESTS = 1000
+ERROR_COLUMNS = ['time', 'reqId', 'errorCode', 'errorString']
+
+error_logger = logging.getLogger('fintech_ibkr.errors')
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def start_error_logging(stream=None):
+    # Route error_logger through a queue to a handler on its own thread.
+    # Called on first use; call it earlier to pick the stream.
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            return
+        log_queue = queue.SimpleQueue()
+        handler = logging.StreamHandler(stream or sys.stdout)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        _listener = logging.handlers.QueueListener(log_queue, handler)
+        _listener.start()
+        error_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        error_logger.setLevel(logging.INFO)
+        error_logger.propagate = False
+        atexit.register(_listener.stop)
+
+
+class error_record:
+    __slots__ = ('sequence', 'time', 'reqId', 'errorCode', 'errorString')
+
+    def __init__(self, sequence, reqId, errorCode, errorString):
+        self.sequence = sequence
+        self.time = time.time()
+        self.reqId = reqId
+        self.errorCode = errorCode
+        self.errorString = errorString
+
+    def __repr__(self):
+        return f'error_record(reqId={self.reqId}, errorCode={self.errorCode}, errorString={self.errorString!r})'
+
+
+class log_rate_limiter:
+    def __init__(self, burst=LOG_BURST, interval=LOG_INTERVAL_SECONDS, timer=time.monotonic):
+        self.burst = burst
+        self.interval = interval
+        self.timer = timer
+        # key -> [window start, lines logged in window, lines suppressed]
+        self._windows = {}
+
+    def allow(self, key):
+        # (allowed, how many were suppressed since the last allowed line)
+        now = self.timer()
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.interval:
+            suppressed = 0 if window is None else window[2]
+            self._windows[key] = [now, 1, 0]
+            return True, suppressed
+        if window[1] < self.burst:
+            window[1] += 1
+            suppressed, window[2] = window[2], 0
+            return True, suppressed
+        window[2] += 1
+        return False, 0
+
+
+class error_ring_buffer:
+    def __init__(self, capacity=DEFAULT_ERROR_CAPACITY, rate_limiter=None):
+        self._records = deque(maxlen=capacity)
+        self._counts = {}
+        self._latest_by_request = OrderedDict()
+        self._sequence = itertools.count(1)
+        self._condition = threading.Condition()
+        self._rate_limiter = rate_limiter or log_rate_limiter()
+        self.last_sequence = 0
+
+    def add(self, reqId, errorCode, errorString, level=logging.WARNING):
+        with self._condition:
+            record = error_record(next(self._sequence), reqId, errorCode, errorString)
+            self._records.append(record)
+            self._counts[errorCode] = self._counts.get(errorCode, 0) + 1
+            self.last_sequence = record.sequence
+            if reqId != -1:
+                self._latest_by_request[reqId] = record
+                self._latest_by_request.move_to_end(reqId)
+                if len(self._latest_by_request) > MAX_TRACKED_REQUESTS:
+                    self._latest_by_request.popitem(last=False)
+                self._condition.notify_all()
+            allowed, suppressed = self._rate_limiter.allow(errorCode)
+        if allowed:
+            if _listener is None:
+                start_error_logging()
+            note = f' ({suppressed} more suppressed)' if suppressed else ''
+            error_logger.log(level, 'Error: %s %s %s%s', reqId, errorCode, errorString, note)
+        return record
+
+    def wait_for(self, reqId, timeout=None, after=0):
+        # The latest error for reqId recorded after sequence number `after`
+        # (see last_sequence), waiting up to timeout seconds for one to
+        # arrive. None if none did.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                record = self._latest_by_request.get(reqId)
+                if record is not None and record.sequence > after:
+                    return record
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+    def latest(self, reqId):
+        with self._condition:
+            return self._latest_by_request.get(reqId)
+
+    def counts(self):
+        # errorCode -> how many times it was seen, including records the
+        # ring has since dropped
+        with self._condition:
+            return dict(self._counts)
+
+    def records(self):
+        with self._condition:
+            return list(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def to_frame(self):
+        with self._condition:
+            rows = [(r.time, r.reqId, r.errorCode, r.errorString) for r in self._records]
+        frame = pd.DataFrame.from_records(rows, columns=ERROR_COLUMNS)
+        frame['time'] = pd.to_datetime(frame['time'], unit='s')
+        return frame
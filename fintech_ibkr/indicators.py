@@ -0,0 +1,392 @@
+# Technical indicators over fetch_historical_data bars.
+#
+#   engine = standard_engine(['sma_20', 'rsi_14'])
+#   values = engine.compute(bars, forming=True)   # whole history, vectorised
+#   engine.update(new_bars)                       # streaming, O(1) per bar
+#   engine.step(bar_row(...))                     # one bar, no pandas at all
+#
+# compute() works on the bar columns as NumPy arrays in one pass per
+# indicator (rolling and exponential means go through pandas' C loops) and
+# leaves every indicator holding just enough state - a running sum and its
+# window, the last average - to carry on from the last bar. update() and
+# step() then cost O(1) per bar however long the history is, and return plain
+# arrays and tuples; only compute() builds a DataFrame.
+#
+# A streaming bar is revised until the next one starts, so the newest bar
+# can be "forming": its values are worked out from the state without
+# changing it, and it is only folded in once a later bar arrives.
+import copy
+import threading
+from collections import deque, namedtuple
+
+import numpy as np
+import pandas as pd
+
+# One bar, as step() sees it
+bar_row = namedtuple('bar_row', ['date', 'open', 'high', 'low', 'close', 'volume'])
+
+
+def bar_rows(bars):
+    # Rows of a bars frame. For the few bars of a streaming update, taking
+    # each column out as a Series (let alone itertuples) costs more than all
+    # the indicators' steps put together, so convert the frame once.
+    positions = [bars.columns.get_loc(field) for field in bar_row._fields]
+    return [bar_row(row[positions[0]], *(float(row[i]) for i in positions[1:]))
+            for row in bars.to_numpy().tolist()]
+
+
+def closes(bars):
+    return bars['close'].to_numpy(dtype=np.float64)
+
+
+def wilder_average(values, period):
+    # Wilder's smoothing: a plain mean of the first `period` values, then
+    # avg = avg + (value - avg) / period. NaN before that.
+    result = np.full(len(values), np.nan)
+    if len(values) < period:
+        return result
+    seeded = values[period - 1:].copy()
+    seeded[0] = values[:period].mean()
+    result[period - 1:] = pd.Series(seeded).ewm(alpha=1 / period, adjust=False).mean().to_numpy()
+    return result
+
+
+class sma:
+    on_price_axis = True
+
+    def __init__(self, period=20):
+        self.period = period
+        self.columns = [f'sma_{period}']
+        self.window = deque(maxlen=period)
+        self.total = 0.0
+
+    def compute(self, bars):
+        values = closes(bars)
+        self.window = deque(values[-self.period:], maxlen=self.period)
+        self.total = float(sum(self.window))
+        return {self.columns[0]: pd.Series(values).rolling(self.period).mean().to_numpy()}
+
+    def step(self, bar, commit):
+        total = self.total + bar.close
+        if len(self.window) == self.period:
+            total -= self.window[0]
+        if commit:
+            self.window.append(bar.close)
+            self.total = total
+        return (total / self.period if len(self.window) + (not commit) >= self.period else np.nan,)
+
+
+class ema:
+    on_price_axis = True
+
+    def __init__(self, period=20):
+        self.period = period
+        self.alpha = 2 / (period + 1)
+        self.columns = [f'ema_{period}']
+        self.value = np.nan
+        self.count = 0
+
+    def compute(self, bars):
+        values = closes(bars)
+        result = pd.Series(values).ewm(alpha=self.alpha, adjust=False).mean().to_numpy(copy=True)
+        self.count = len(values)
+        self.value = result[-1] if len(values) else np.nan
+        result[:self.period - 1] = np.nan
+        return {self.columns[0]: result}
+
+    def step(self, bar, commit):
+        value = bar.close if self.count == 0 else self.value + self.alpha * (bar.close - self.value)
+        count = self.count + 1
+        if commit:
+            self.value, self.count = value, count
+        return (value if count >= self.period else np.nan,)
+
+
+class bollinger:
+    # Middle band is the SMA; the others are `width` population standard
+    # deviations either side
+    on_price_axis = True
+
+    def __init__(self, period=20, width=2):
+        self.period = period
+        self.width = width
+        self.columns = [f'bb_upper_{period}', f'bb_middle_{period}', f'bb_lower_{period}']
+        self.window = deque(maxlen=period)
+        self.total = 0.0
+        self.total_squares = 0.0
+
+    def compute(self, bars):
+        values = closes(bars)
+        rolling = pd.Series(values).rolling(self.period)
+        middle = rolling.mean().to_numpy()
+        spread = self.width * rolling.std(ddof=0).to_numpy()
+        tail = values[-self.period:]
+        self.window = deque(tail, maxlen=self.period)
+        self.total = float(tail.sum())
+        self.total_squares = float((tail * tail).sum())
+        return dict(zip(self.columns, (middle + spread, middle, middle - spread)))
+
+    def step(self, bar, commit):
+        close = bar.close
+        total = self.total + close
+        total_squares = self.total_squares + close * close
+        if len(self.window) == self.period:
+            total -= self.window[0]
+            total_squares -= self.window[0] * self.window[0]
+        if commit:
+            self.window.append(close)
+            self.total, self.total_squares = total, total_squares
+        if len(self.window) + (not commit) < self.period:
+            return np.nan, np.nan, np.nan
+        middle = total / self.period
+        spread = self.width * np.sqrt(max(total_squares / self.period - middle * middle, 0.0))
+        return middle + spread, middle, middle - spread
+
+
+class rsi:
+    # Wilder's RSI: 100 - 100 / (1 + average gain / average loss)
+    on_price_axis = False
+
+    def __init__(self, period=14):
+        self.period = period
+        self.columns = [f'rsi_{period}']
+        self.previous_close = np.nan
+        self.average_gain = 0.0
+        self.average_loss = 0.0
+        # price changes seen, counting up to period while the averages seed
+        self.changes = 0
+
+    @staticmethod
+    def index(average_gain, average_loss):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            value = 100 - 100 / (1 + average_gain / average_loss)
+        # No losses: 100, unless nothing moved at all
+        return np.where(average_loss == 0, np.where(average_gain == 0, 50.0, 100.0), value)
+
+    @staticmethod
+    def index_of(average_gain, average_loss):
+        # index() for one bar, without NumPy's per-call overhead
+        if average_loss == 0:
+            return 50.0 if average_gain == 0 else 100.0
+        return 100 - 100 / (1 + average_gain / average_loss)
+
+    def compute(self, bars):
+        values = closes(bars)
+        change = np.diff(values)
+        gains = wilder_average(np.maximum(change, 0), self.period)
+        losses = wilder_average(np.maximum(-change, 0), self.period)
+        result = np.full(len(values), np.nan)
+        result[1:] = self.index(gains, losses)
+        result[1:][np.isnan(gains)] = np.nan
+        self.changes = len(change)
+        self.previous_close = values[-1] if len(values) else np.nan
+        if len(change) >= self.period:
+            self.average_gain, self.average_loss = gains[-1], losses[-1]
+        else:
+            # Still seeding: keep the sums
+            self.average_gain = float(np.maximum(change, 0).sum())
+            self.average_loss = float(np.maximum(-change, 0).sum())
+        return {self.columns[0]: result}
+
+    def step(self, bar, commit):
+        if self.previous_close != self.previous_close:
+            # NaN: no bar yet
+            if commit:
+                self.previous_close = bar.close
+            return (np.nan,)
+        change = bar.close - self.previous_close
+        gain, loss = max(change, 0.0), max(-change, 0.0)
+        changes = self.changes + 1
+        if changes < self.period:
+            average_gain, average_loss = self.average_gain + gain, self.average_loss + loss
+        elif changes == self.period:
+            average_gain = (self.average_gain + gain) / self.period
+            average_loss = (self.average_loss + loss) / self.period
+        else:
+            average_gain = self.average_gain + (gain - self.average_gain) / self.period
+            average_loss = self.average_loss + (loss - self.average_loss) / self.period
+        if commit:
+            self.previous_close, self.changes = bar.close, changes
+            self.average_gain, self.average_loss = average_gain, average_loss
+        if changes < self.period:
+            return (np.nan,)
+        return (self.index_of(average_gain, average_loss),)
+
+
+class atr:
+    # Wilder's average true range
+    on_price_axis = False
+
+    def __init__(self, period=14):
+        self.period = period
+        self.columns = [f'atr_{period}']
+        self.previous_close = np.nan
+        self.value = 0.0
+        self.count = 0
+
+    def compute(self, bars):
+        high = bars['high'].to_numpy(dtype=np.float64)
+        low = bars['low'].to_numpy(dtype=np.float64)
+        close = closes(bars)
+        previous = np.concatenate(([np.nan], close[:-1]))
+        true_range = np.fmax(high - low, np.fmax(np.abs(high - previous), np.abs(low - previous)))
+        result = wilder_average(true_range, self.period)
+        self.count = len(close)
+        self.previous_close = close[-1] if len(close) else np.nan
+        self.value = result[-1] if len(close) >= self.period else float(true_range.sum())
+        return {self.columns[0]: result}
+
+    def step(self, bar, commit):
+        true_range = bar.high - bar.low
+        if not np.isnan(self.previous_close):
+            true_range = max(true_range, abs(bar.high - self.previous_close),
+                             abs(bar.low - self.previous_close))
+        count = self.count + 1
+        if count < self.period:
+            value = self.value + true_range
+        elif count == self.period:
+            value = (self.value + true_range) / self.period
+        else:
+            value = self.value + (true_range - self.value) / self.period
+        if commit:
+            self.previous_close, self.value, self.count = bar.close, value, count
+        return (value if count >= self.period else np.nan,)
+
+
+class vwap:
+    # Volume-weighted typical price, (high + low + close) / 3, restarting
+    # every day. MIDPOINT and friends have no volume, so a day without any
+    # falls back to a plain mean, as downsampling's wap does.
+    on_price_axis = True
+
+    def __init__(self):
+        self.columns = ['vwap']
+        self.day = None
+        # price * volume, volume, price and bars so far today
+        self.sums = (0.0, 0.0, 0.0, 0)
+
+    @staticmethod
+    def value(price_volume, volume, price, count):
+        if volume > 0:
+            return price_volume / volume
+        return price / count if count else np.nan
+
+    def compute(self, bars):
+        n = len(bars)
+        price = ((bars['high'] + bars['low'] + bars['close']) / 3).to_numpy(dtype=np.float64)
+        volume = np.maximum(bars['volume'].to_numpy(dtype=np.float64), 0)
+        days = bars['date'].values.astype('datetime64[D]')
+        # Index of the first bar of each bar's day
+        day_start = np.zeros(n, dtype=np.int64)
+        starts = np.flatnonzero(days[1:] != days[:-1]) + 1
+        day_start[starts] = starts
+        day_start = np.maximum.accumulate(day_start)
+
+        def daily_cumsum(values):
+            total = np.cumsum(values)
+            before = np.concatenate(([0], total))[day_start]
+            return total - before
+
+        price_volume = daily_cumsum(price * volume)
+        total_volume = daily_cumsum(volume)
+        total_price = daily_cumsum(price)
+        count = np.arange(n) - day_start + 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = np.where(total_volume > 0, price_volume / total_volume, total_price / count)
+        if n:
+            self.day = bars['date'].iloc[-1].date()
+            self.sums = (price_volume[-1], total_volume[-1], total_price[-1], int(count[-1]))
+        return {'vwap': result}
+
+    def step(self, bar, commit):
+        day = bar.date.date()
+        price_volume, volume, price, count = self.sums if day == self.day else (0.0, 0.0, 0.0, 0)
+        typical = (bar.high + bar.low + bar.close) / 3
+        bar_volume = max(bar.volume, 0.0)
+        sums = (price_volume + typical * bar_volume, volume + bar_volume, price + typical, count + 1)
+        if commit:
+            self.day, self.sums = day, sums
+        return (self.value(*sums),)
+
+
+# The page's overlay choices
+STANDARD_INDICATORS = {
+    'sma_20': lambda: sma(20),
+    'ema_20': lambda: ema(20),
+    'bb_20': lambda: bollinger(20, 2),
+    'vwap': vwap,
+    'rsi_14': lambda: rsi(14),
+    'atr_14': lambda: atr(14),
+}
+
+
+class indicator_engine:
+    def __init__(self, indicators):
+        self.indicators = list(indicators)
+        self.columns = [column for indicator in self.indicators for column in indicator.columns]
+        self.last_date = None
+        self.last_values = None
+        self._forming = None
+        self._lock = threading.Lock()
+
+    def compute(self, bars, forming=False):
+        # Indicator values for every bar, one row per bar, as a DataFrame
+        # with the bars' dates. With forming=True the last bar is taken to
+        # be still forming; update() will revise it.
+        with self._lock:
+            completed = bars.iloc[:-1] if forming and len(bars) else bars
+            # The forming bar's row is filled in below
+            padding = len(bars) - len(completed)
+            columns = {'date': bars['date'].values}
+            for indicator in self.indicators:
+                for column, values in indicator.compute(completed).items():
+                    columns[column] = np.append(values, [np.nan] * padding)
+            values = pd.DataFrame(columns)
+            self._forming = None
+            if len(completed):
+                self.last_date = completed['date'].iloc[-1]
+                self.last_values = tuple(values[self.columns].iloc[len(completed) - 1])
+            if forming and len(bars):
+                # compute() left room for the forming bar at the end
+                self._forming = bar_rows(bars.iloc[-1:])[0]
+                values.loc[len(bars) - 1, self.columns] = self._step(self._forming, commit=False)
+            return values
+
+    def update(self, bars):
+        # Values for new or revised bars (oldest first, like stream_bars
+        # returns them), one row per bar and one column per self.columns,
+        # as a float array.
+        rows = [self.step(bar) for bar in bar_rows(bars)]
+        return np.array(rows, dtype=np.float64).reshape(-1, len(self.columns))
+
+    def step(self, bar):
+        # Values for one new or revised bar_row, in self.columns order. A bar
+        # is folded into the state when a later one arrives; bars older than
+        # that are ignored and get NaN.
+        with self._lock:
+            if self.last_date is not None and bar.date <= self.last_date:
+                return (np.nan,) * len(self.columns)
+            if self._forming is not None and bar.date > self._forming.date:
+                self.last_values = self._step(self._forming, commit=True)
+                self.last_date = self._forming.date
+            self._forming = bar
+            return self._step(bar, commit=False)
+
+    def copy(self):
+        # An engine in the same state that carries on independently, for
+        # when several readers stream from one computed history.
+        with self._lock:
+            engine = copy.copy(self)
+            engine.indicators = copy.deepcopy(self.indicators)
+            engine._lock = threading.Lock()
+            return engine
+
+    def _step(self, bar, commit):
+        values = ()
+        for indicator in self.indicators:
+            values += tuple(indicator.step(bar, commit))
+        return values
+
+
+def standard_engine(keys):
+    return indicator_engine([STANDARD_INDICATORS[key]() for key in keys])
@@ -0,0 +1,179 @@
+# Journal of submitted orders, kept in SQLite.
+#
+# Replaces read-everything / rewrite-everything on submitted_orders.csv: each
+# order is one INSERT, WAL mode lets readers carry on while an order is being
+# written, and SQLite's locking keeps concurrent writers from losing rows.
+import os
+import re
+import sqlite3
+import threading
+
+import pandas as pd
+
+ORDER_JOURNAL_PATH = os.path.join(os.getenv('TESTAPP_DATA_PATH') or '', 'orders.sqlite3')
+LEGACY_ORDERS_CSV_PATH = os.path.join(os.getenv('TESTAPP_DATA_PATH') or '', 'submitted_orders.csv')
+BUSY_TIMEOUT_MILLISECONDS = 10_000
+DEFAULT_PAGE_SIZE = 20
+
+ORDER_COLUMNS = ['timestamp', 'order_id', 'client_id', 'perm_id', 'con_id',
+                 'symbol', 'action', 'size', 'order_type', 'lmt_price']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT,
+    order_id INTEGER,
+    client_id INTEGER,
+    perm_id INTEGER,
+    con_id INTEGER,
+    symbol TEXT,
+    action TEXT,
+    size NUMERIC,
+    order_type TEXT,
+    lmt_price TEXT
+);
+CREATE INDEX IF NOT EXISTS orders_order_id ON orders (order_id);
+CREATE INDEX IF NOT EXISTS orders_perm_id ON orders (perm_id);
+CREATE INDEX IF NOT EXISTS orders_symbol ON orders (symbol);
+CREATE INDEX IF NOT EXISTS orders_timestamp ON orders (timestamp);
+CREATE TABLE IF NOT EXISTS imports (
+    path TEXT PRIMARY KEY,
+    rows INTEGER,
+    imported_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# Operators DataTable writes into filter_query, and their SQL equivalents.
+FILTER_OPERATORS = {
+    '=': '=', 'eq': '=',
+    '!=': '!=', 'ne': '!=',
+    '<': '<', 'lt': '<',
+    '<=': '<=', 'le': '<=',
+    '>': '>', 'gt': '>',
+    '>=': '>=', 'ge': '>=',
+    'contains': 'LIKE',
+    'datestartswith': 'LIKE',
+}
+FILTER_PART = re.compile(
+    r'^\{(?P<column>[^}]+)\}\s+[si]?(?P<operator>' +
+    '|'.join(re.escape(op) for op in sorted(FILTER_OPERATORS, key=len, reverse=True)) +
+    r')\s+(?P<value>.*)$')
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def filter_query_to_sql(filter_query):
+    # Translate a DataTable filter_query ("{symbol} contains AA && {size} > 5")
+    # into a parameterised WHERE clause. Only known columns are accepted, and
+    # parts that can't be parsed are ignored, as the table itself does.
+    clauses, params = [], []
+    for part in (filter_query or '').split(' && '):
+        match = FILTER_PART.match(part.strip())
+        if not match or match['column'] not in ORDER_COLUMNS:
+            continue
+        operator = match['operator']
+        value = match['value'].strip()
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'`':
+            value = value[1:-1]
+        if operator == 'contains':
+            clauses.append(f"{match['column']} LIKE ? ESCAPE '\\'")
+            params.append(f'%{escape_like(value)}%')
+        elif operator == 'datestartswith':
+            clauses.append(f"{match['column']} LIKE ? ESCAPE '\\'")
+            params.append(f'{escape_like(value)}%')
+        else:
+            clauses.append(f"{match['column']} {FILTER_OPERATORS[operator]} ?")
+            params.append(value)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    return where, params
+
+
+def sort_by_to_sql(sort_by):
+    terms = [f"{item['column_id']} {'DESC' if item['direction'] == 'desc' else 'ASC'}"
+             for item in (sort_by or []) if item['column_id'] in ORDER_COLUMNS]
+    return f"ORDER BY {', '.join(terms + ['id'])}"
+
+
+class order_journal:
+    def __init__(self, path=ORDER_JOURNAL_PATH, legacy_csv_path=LEGACY_ORDERS_CSV_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+        if legacy_csv_path and os.path.isfile(legacy_csv_path):
+            self.import_csv(legacy_csv_path)
+
+    def connection(self):
+        # sqlite3 connections can't be shared between threads, so each thread
+        # (waitress worker, IB reader, ...) gets its own.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_MILLISECONDS / 1000)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MILLISECONDS}')
+            self._local.conn = conn
+        return conn
+
+    def append(self, record):
+        values = [record.get(column) for column in ORDER_COLUMNS]
+        with self.connection() as conn:
+            conn.execute(
+                f"INSERT INTO orders ({', '.join(ORDER_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(ORDER_COLUMNS))})",
+                values)
+
+    def import_csv(self, csv_path):
+        # One-time import of the old submitted_orders.csv. Returns the number
+        # of rows imported, 0 if this file was imported before.
+        csv_path = os.path.abspath(csv_path)
+        conn = self.connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute('SELECT 1 FROM imports WHERE path = ?', (csv_path,)).fetchone():
+                return 0
+            # Read everything as text so 'N/A' and '170.00' limit prices survive
+            # as written; the column affinities convert the numeric ones.
+            data = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+            data = data.reindex(columns=ORDER_COLUMNS, fill_value='')
+            data = data.where(data != '', None)
+            conn.executemany(
+                f"INSERT INTO orders ({', '.join(ORDER_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(ORDER_COLUMNS))})",
+                data.itertuples(index=False, name=None))
+            conn.execute('INSERT INTO imports (path, rows) VALUES (?, ?)',
+                         (csv_path, len(data)))
+        print(f'Imported {len(data)} orders from {csv_path}')
+        return len(data)
+
+    def query(self, page_current=0, page_size=DEFAULT_PAGE_SIZE,
+              filter_query='', sort_by=None):
+        # One page of orders for a DataTable in custom paging / filtering /
+        # sorting mode, plus the number of rows matching the filter.
+        where, params = filter_query_to_sql(filter_query)
+        conn = self.connection()
+        total = conn.execute(f'SELECT COUNT(*) FROM orders {where}', params).fetchone()[0]
+        page = pd.read_sql_query(
+            f"SELECT {', '.join(ORDER_COLUMNS)} FROM orders {where} "
+            f"{sort_by_to_sql(sort_by)} LIMIT ? OFFSET ?",
+            conn, params=params + [page_size, page_current * page_size])
+        return page, total
+
+    def to_frame(self):
+        return pd.read_sql_query(
+            f"SELECT {', '.join(ORDER_COLUMNS)} FROM orders ORDER BY id",
+            self.connection())
+
+
+_default_journal = None
+_default_journal_lock = threading.Lock()
+
+
+def default_order_journal():
+    global _default_journal
+    with _default_journal_lock:
+        if _default_journal is None:
+            _default_journal = order_journal()
+        return _default_journal
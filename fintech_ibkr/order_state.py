@@ -0,0 +1,125 @@
+# Latest status of every order an ibkr_app has heard about.
+#
+# TWS sends orderStatus many times per order (often repeating itself), so
+# each order has one record that is updated in place, O(1) per callback, with
+# a short history of the transitions it went through. A DataFrame is only
+# built when somebody asks for one.
+import threading
+import time
+from collections import OrderedDict, deque
+
+import pandas as pd
+
+ORDER_STATUS_COLUMNS = ['order_id', 'status', 'filled', 'remaining', 'avg_fill_price',
+                        'perm_id', 'parent_id', 'last_fill_price', 'client_id',
+                        'why_held', 'mkt_cap_price']
+ORDER_STATUS_DTYPES = {
+    'order_id': 'int64',
+    'status': 'object',
+    'filled': 'float64',
+    'remaining': 'float64',
+    'avg_fill_price': 'float64',
+    'perm_id': 'int64',
+    'parent_id': 'int64',
+    'last_fill_price': 'float64',
+    'client_id': 'int64',
+    'why_held': 'object',
+    'mkt_cap_price': 'float64',
+}
+# Statuses after which TWS sends nothing more for an order
+FINAL_STATUSES = ('Filled', 'Cancelled', 'ApiCancelled', 'Inactive')
+DEFAULT_HISTORY_LENGTH = 16
+DEFAULT_MAX_ORDERS = 10_000
+
+
+class order_state:
+    __slots__ = tuple(ORDER_STATUS_COLUMNS) + ('history', 'updated')
+
+    def __init__(self, order_id, history_length=DEFAULT_HISTORY_LENGTH):
+        self.order_id = order_id
+        self.status = None
+        self.filled = 0.0
+        self.remaining = 0.0
+        self.avg_fill_price = 0.0
+        self.perm_id = 0
+        self.parent_id = 0
+        self.last_fill_price = 0.0
+        self.client_id = 0
+        self.why_held = ''
+        self.mkt_cap_price = 0.0
+        # (time.time(), status, filled, remaining) for every change of
+        # status or fill, oldest first
+        self.history = deque(maxlen=history_length)
+        self.updated = None
+
+    @property
+    def done(self):
+        return self.status in FINAL_STATUSES
+
+    def row(self):
+        return tuple(getattr(self, column) for column in ORDER_STATUS_COLUMNS)
+
+
+class order_status_table:
+    def __init__(self, history_length=DEFAULT_HISTORY_LENGTH, max_orders=DEFAULT_MAX_ORDERS):
+        self.history_length = history_length
+        self.max_orders = max_orders
+        self._orders = OrderedDict()
+        self._lock = threading.Lock()
+        self.updates = 0
+
+    def update(self, order_id, status, filled, remaining, avg_fill_price, perm_id,
+               parent_id, last_fill_price, client_id, why_held, mkt_cap_price):
+        now = time.time()
+        with self._lock:
+            self.updates += 1
+            state = self._orders.get(order_id)
+            if state is None:
+                state = self._orders[order_id] = order_state(order_id, self.history_length)
+                if len(self._orders) > self.max_orders:
+                    self._evict()
+            if status != state.status or filled != state.filled:
+                state.history.append((now, status, filled, remaining))
+            state.status = status
+            state.filled = filled
+            state.remaining = remaining
+            state.avg_fill_price = avg_fill_price
+            state.perm_id = perm_id
+            state.parent_id = parent_id
+            state.last_fill_price = last_fill_price
+            state.client_id = client_id
+            state.why_held = why_held
+            state.mkt_cap_price = mkt_cap_price
+            state.updated = now
+            return state
+
+    def get(self, order_id):
+        with self._lock:
+            return self._orders.get(order_id)
+
+    def history(self, order_id):
+        with self._lock:
+            state = self._orders.get(order_id)
+            return [] if state is None else list(state.history)
+
+    def __len__(self):
+        return len(self._orders)
+
+    def __contains__(self, order_id):
+        return order_id in self._orders
+
+    def to_frame(self):
+        # One row per order, in the order they were first seen
+        with self._lock:
+            rows = [state.row() for state in self._orders.values()]
+        frame = pd.DataFrame.from_records(rows, columns=ORDER_STATUS_COLUMNS)
+        return frame.astype(ORDER_STATUS_DTYPES)
+
+    def _evict(self):
+        # Forget the oldest finished order, or the oldest of all if every
+        # order is still working
+        for order_id, state in self._orders.items():
+            if state.done:
+                del self._orders[order_id]
+                return
+        self._orders.popitem(last=False)
@@ -0,0 +1,283 @@
+# Central scheduler for requests that count against IB's pacing limits.
+#
+# IB rejects historical data requests (and, with enough of them, drops the
+# connection) when a client makes
+#   - an identical request within 15 seconds,
+#   - 6 or more requests for the same contract within 2 seconds, or
+#   - more than 60 requests within 10 minutes.
+# Every historical and contract request goes through one pacing_scheduler: it
+# queues them by priority, dispatches each as soon as all of the windows
+# above have room, and hands duplicate requests that are already queued or in
+# flight the same Future instead of sending them twice.
+import bisect
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+IDENTICAL_REQUEST_SECONDS = 15
+SAME_CONTRACT_REQUESTS = 6
+SAME_CONTRACT_SECONDS = 2
+TOTAL_REQUESTS = 60
+TOTAL_SECONDS = 600
+# Threads that send dispatched requests. Sending checks a connection out of a
+# session pool, which can wait for one to come free or to connect.
+ISSUE_WORKERS = 4
+
+
+class paced_request:
+    __slots__ = ('priority', 'sequence', 'issue', 'key', 'contract_key',
+                 'paced', 'on_abandon', 'future', 'waiters', 'issued', 'sent')
+
+    def __init__(self, priority, sequence, issue, key, contract_key, paced, on_abandon):
+        self.priority = priority
+        self.sequence = sequence
+        self.issue = issue
+        self.key = key
+        self.contract_key = contract_key
+        self.paced = paced
+        self.on_abandon = on_abandon
+        self.future = Future()
+        self.waiters = 1
+        # issued: taken off the queue; sent: issue() has returned
+        self.issued = False
+        self.sent = False
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+class pacing_scheduler:
+    def __init__(self, timer=time.monotonic):
+        self.timer = timer
+        self._queue = []
+        self._pending = {}
+        # Future -> request, for every request not finished yet
+        self._requests = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._recent = deque()
+        self._recent_by_contract = {}
+        self._last_by_key = {}
+        self._thread = None
+        self._issuers = ThreadPoolExecutor(ISSUE_WORKERS, thread_name_prefix='ibkr-pacing-issue')
+        self.submitted = 0
+        self.coalesced = 0
+        self.dispatched = 0
+        self.max_queue_depth = 0
+
+    def submit(self, issue, key=None, contract_key=None,
+               priority=PRIORITY_INTERACTIVE, paced=True, on_abandon=None):
+        # Queue issue() to be called once pacing allows. issue sends the
+        # request and returns a Future for its result (or the result itself);
+        # the returned Future follows it. Requests with the same key that are
+        # still queued or in flight share one Future. on_abandon() is called
+        # if every caller gives up on the request after it was sent, to
+        # cancel it upstream.
+        with self._condition:
+            self.submitted += 1
+            if key is not None and key in self._pending:
+                request = self._pending[key]
+                request.waiters += 1
+                self.coalesced += 1
+                # An interactive caller promotes a queued background request
+                if not request.issued and priority < request.priority:
+                    self._queue.remove(request)
+                    request.priority = priority
+                    bisect.insort(self._queue, request)
+                return request.future
+            request = paced_request(priority, next(self._sequence), issue, key,
+                                    contract_key, paced, on_abandon)
+            if key is not None:
+                self._pending[key] = request
+            self._requests[request.future] = request
+            request.future.add_done_callback(lambda _: self._forget(request))
+            bisect.insort(self._queue, request)
+            self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+            self._ensure_dispatcher()
+            self._condition.notify()
+            return request.future
+
+    def cancel(self, future):
+        # A caller gives up waiting on future. Once nobody waits on it any
+        # more the request is withdrawn: taken off the queue, or abandoned
+        # if it was already sent, and its Future cancelled, so a later
+        # identical request goes out afresh. Returns True if it was.
+        with self._condition:
+            request = self._requests.get(future)
+            if request is None:
+                return False
+            request.waiters -= 1
+            if request.waiters:
+                return False
+            if not request.issued:
+                self._queue.remove(request)
+            self._forget(request)
+            # Still being sent: the worker sending it abandons it once it has
+            # been
+            abandon = request.sent and request.on_abandon is not None
+        future.cancel()
+        if abandon:
+            request.on_abandon()
+        return True
+
+    def metrics(self):
+        with self._condition:
+            depth_by_priority = {}
+            for request in self._queue:
+                depth_by_priority[request.priority] = depth_by_priority.get(request.priority, 0) + 1
+            return {
+                'queue_depth': len(self._queue),
+                'queue_depth_by_priority': depth_by_priority,
+                'max_queue_depth': self.max_queue_depth,
+                'in_flight': sum(1 for r in self._pending.values() if r.issued),
+                'submitted': self.submitted,
+                'coalesced': self.coalesced,
+                'dispatched': self.dispatched,
+                'requests_last_10_min': len(self._recent),
+            }
+
+    def _forget(self, request):
+        with self._condition:
+            self._requests.pop(request.future, None)
+            if request.key is not None and self._pending.get(request.key) is request:
+                del self._pending[request.key]
+
+    def _ensure_dispatcher(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._dispatch_loop, daemon=True,
+                                            name='ibkr-pacing-scheduler')
+            self._thread.start()
+
+    def _ready_at(self, request, now):
+        # Earliest time the request can go out without breaking a limit.
+        if not request.paced:
+            return now
+        ready = now
+        recent = self._recent
+        while recent and recent[0] <= now - TOTAL_SECONDS:
+            recent.popleft()
+        if len(recent) >= TOTAL_REQUESTS:
+            ready = max(ready, recent[len(recent) - TOTAL_REQUESTS] + TOTAL_SECONDS)
+        by_contract = self._recent_by_contract.get(request.contract_key)
+        if by_contract:
+            while by_contract and by_contract[0] <= now - SAME_CONTRACT_SECONDS:
+                by_contract.popleft()
+            if len(by_contract) >= SAME_CONTRACT_REQUESTS:
+                ready = max(ready, by_contract[len(by_contract) - SAME_CONTRACT_REQUESTS]
+                            + SAME_CONTRACT_SECONDS)
+        last = self._last_by_key.get(request.key)
+        if last is not None:
+            ready = max(ready, last + IDENTICAL_REQUEST_SECONDS)
+        return ready
+
+    def _record(self, request, now):
+        if not request.paced:
+            return
+        self._recent.append(now)
+        if request.contract_key is not None:
+            self._recent_by_contract.setdefault(request.contract_key, deque()).append(now)
+        if request.key is not None:
+            self._last_by_key[request.key] = now
+            # Nothing older than the identical-request window matters
+            stale = [k for k, t in self._last_by_key.items() if t <= now - IDENTICAL_REQUEST_SECONDS]
+            for k in stale:
+                del self._last_by_key[k]
+
+    def _next_request(self):
+        # Highest-priority request that may go out now, and when it was
+        # counted against the limits; else how long to wait.
+        with self._condition:
+            while True:
+                now = self.timer()
+                wait = None
+                for request in self._queue:
+                    if request.future.cancelled():
+                        continue
+                    ready = self._ready_at(request, now)
+                    if ready <= now:
+                        self._queue.remove(request)
+                        request.issued = True
+                        self._record(request, now)
+                        self.dispatched += 1
+                        return request, now
+                    wait = ready - now if wait is None else min(wait, ready - now)
+                self._queue = [r for r in self._queue if not r.future.cancelled()]
+                self._condition.wait(wait)
+
+    def _record_sent(self, request, dispatched_at, now):
+        # The dispatcher counted the request when it handed it to a worker;
+        # count it from when it actually went out instead.
+        if not request.paced or now == dispatched_at:
+            return
+        for times in (self._recent, self._recent_by_contract.get(request.contract_key)):
+            if times is not None and dispatched_at in times:
+                times.remove(dispatched_at)
+                times.append(now)
+        if request.key is not None:
+            self._last_by_key[request.key] = now
+
+    def _dispatch_loop(self):
+        while True:
+            request, dispatched_at = self._next_request()
+            # Sent on a worker, so one request waiting for a connection
+            # doesn't hold up the ones behind it
+            self._issuers.submit(self._issue, request, dispatched_at)
+
+    def _issue(self, request, dispatched_at):
+        try:
+            result = request.issue()
+        except Exception as e:
+            _settle(request.future, exception=e)
+            return
+        finally:
+            with self._condition:
+                request.sent = True
+                abandoned = not request.waiters
+                self._record_sent(request, dispatched_at, self.timer())
+        if abandoned:
+            # Everyone gave up while it was being sent
+            if request.on_abandon is not None:
+                request.on_abandon()
+            return
+        if isinstance(result, Future):
+            result.add_done_callback(lambda done, request=request: _copy_result(done, request.future))
+        else:
+            _settle(request.future, result)
+
+
+def _settle(target, result=None, exception=None):
+    # The last caller giving up cancels target, which can happen at any
+    # moment up to here
+    try:
+        if exception is not None:
+            target.set_exception(exception)
+        else:
+            target.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+def _copy_result(source, target):
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        _settle(target, exception=source.exception())
+    else:
+        _settle(target, source.result())
+
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def request_scheduler():
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = pacing_scheduler()
+        return _default_scheduler
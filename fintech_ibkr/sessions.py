@@ -0,0 +1,220 @@
+# Long-lived, pooled connections to TWS / IB Gateway.
+#
+# Connecting to TWS costs a TCP handshake, the API version handshake and a
+# wait for nextValidId. Instead of paying that on every call, the functions in
+# synchronous_functions check a connected app out of a pool, run one request
+# on it and hand it back still connected.
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from fintech_ibkr.client_ids import client_id_in_use
+
+DEFAULT_POOL_SIZE = 2
+CONNECT_TIMEOUT_SECONDS = 10
+CONNECT_POLL_SECONDS = 0.1
+CHECKOUT_TIMEOUT_SECONDS = 30
+# Ids TWS says are taken by someone outside the allocator before giving up
+MAX_REJECTED_CLIENT_IDS = 5
+
+
+def connect_app(app, hostname, port, client_id,
+                timeout=CONNECT_TIMEOUT_SECONDS):
+    # Connect an ibkr_app, start its reader loop in a daemon thread and block
+    # until TWS sends nextValidId. Raises ConnectionError if the socket can't
+    # be opened or nextValidId doesn't arrive before the timeout, and
+    # client_id_in_use if TWS turned the client id down.
+    app.connect(hostname, port, client_id)
+    if not app.isConnected():
+        raise ConnectionError(
+            f'Could not connect to {hostname}:{port} with client id {client_id}')
+
+    api_thread = threading.Thread(target=app.run, daemon=True,
+                                  name=f'ibkr-reader-{client_id}')
+    api_thread.start()
+    app.api_thread = api_thread
+
+    deadline = time.monotonic() + timeout
+    while not app.next_valid_id_event.wait(CONNECT_POLL_SECONDS):
+        # TWS hangs up straight away on a client id clash, no need to wait
+        # out the timeout
+        if app.isConnected() and time.monotonic() < deadline:
+            continue
+        app.disconnect()
+        # Let the reader loop deliver the error that came before the hangup
+        api_thread.join(CONNECT_POLL_SECONDS)
+        if getattr(app, 'client_id_rejected', False):
+            raise client_id_in_use(
+                f'Client id {client_id} is already connected to {hostname}:{port}')
+        raise ConnectionError(
+            f'No nextValidId from {hostname}:{port} for client id {client_id}')
+    return app
+
+
+def connect_leased(app_factory, hostname, port, preferred, allocator,
+                   timeout=CONNECT_TIMEOUT_SECONDS):
+    # Lease a client id from allocator (preferred if it is free) and connect
+    # a new app with it. Returns (app, client_id); the caller releases the id
+    # when it is done with the connection. Ids TWS rejects are skipped.
+    rejected = []
+    while True:
+        client_id = allocator.lease(preferred, exclude=rejected)
+        try:
+            return connect_app(app_factory(), hostname, port, client_id, timeout), client_id
+        except client_id_in_use as e:
+            allocator.reject(client_id)
+            rejected.append(client_id)
+            print(f'{e}, trying another')
+            if len(rejected) >= MAX_REJECTED_CLIENT_IDS:
+                raise
+        except BaseException:
+            allocator.release(client_id)
+            raise
+
+
+class ibkr_session_pool:
+    # A fixed number of connection slots to one TWS instance. Each slot uses
+    # its own client id because TWS refuses two sockets with the same id:
+    # client_id, client_id + 1, ... or, with an allocator, ids leased from it
+    # (those same ids when they are free) so that other pools and processes
+    # can't clash with this one. Slots are connected lazily and reconnected
+    # on checkout if the link has dropped.
+    def __init__(self, app_factory, hostname, port, client_id,
+                 size=DEFAULT_POOL_SIZE, allocator=None):
+        self.app_factory = app_factory
+        self.hostname = hostname
+        self.port = port
+        self.client_id = client_id
+        self.size = size
+        self.allocator = allocator
+        self._slots = [None] * size
+        self._slot_client_ids = [None] * size
+        self._streaming_client_id = None
+        self._idle = queue.LifoQueue()
+        for slot in range(size):
+            self._idle.put(slot)
+        self._id_lock = threading.Lock()
+        self._next_request_id = None
+        self._streaming = None
+        self._streaming_lock = threading.Lock()
+        self._closed = False
+
+    def next_request_id(self):
+        # Request and order ids come from one counter shared by every
+        # connection in the pool, seeded from the highest nextValidId seen,
+        # so ask for one only with a connection checked out.
+        with self._id_lock:
+            if self._next_request_id is None:
+                raise RuntimeError('No request ids before a connection has sent nextValidId')
+            request_id = self._next_request_id
+            self._next_request_id += 1
+            return request_id
+
+    def _reserve_ids_from(self, next_valid_id):
+        with self._id_lock:
+            if self._next_request_id is None or next_valid_id > self._next_request_id:
+                self._next_request_id = next_valid_id
+
+    def _connect(self, preferred, old_client_id):
+        # Returns (app, client_id), giving back the id of the connection it
+        # replaces first so that it can be reused.
+        if self.allocator is None:
+            app = connect_app(self.app_factory(), self.hostname, self.port, preferred)
+            client_id = preferred
+        else:
+            if old_client_id is not None:
+                self.allocator.release(old_client_id)
+            app, client_id = connect_leased(self.app_factory, self.hostname, self.port,
+                                            preferred, self.allocator)
+        self._reserve_ids_from(app.next_valid_id)
+        return app, client_id
+
+    def _connected_app(self, slot):
+        app = self._slots[slot]
+        if app is not None and app.isConnected():
+            return app
+        old_client_id = self._slot_client_ids[slot]
+        if app is not None:
+            print(f'Connection for client id {old_client_id} dropped, reconnecting...')
+        self._slots[slot] = self._slot_client_ids[slot] = None
+        app, self._slot_client_ids[slot] = self._connect(self.client_id + slot, old_client_id)
+        self._slots[slot] = app
+        return app
+
+    @contextmanager
+    def session(self, timeout=CHECKOUT_TIMEOUT_SECONDS):
+        # Check out one connected app for the duration of the with block.
+        if self._closed:
+            raise RuntimeError('Session pool is closed')
+        try:
+            slot = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(
+                f'No free IB connection to {self.hostname}:{self.port} after {timeout}s')
+        try:
+            yield self._connected_app(slot)
+        finally:
+            self._idle.put(slot)
+
+    def client_ids(self):
+        # Client ids of the connections currently open
+        ids = [client_id for client_id in self._slot_client_ids if client_id is not None]
+        if self._streaming_client_id is not None:
+            ids.append(self._streaming_client_id)
+        return ids
+
+    def streaming_app(self):
+        # One extra long-lived connection (client id client_id + size) shared
+        # by every streaming subscription. It is never checked out, since
+        # subscriptions stay open far longer than a request.
+        if self._closed:
+            raise RuntimeError('Session pool is closed')
+        with self._streaming_lock:
+            app = self._streaming
+            if app is None or not app.isConnected():
+                old_client_id = self._streaming_client_id
+                self._streaming = self._streaming_client_id = None
+                app, self._streaming_client_id = self._connect(
+                    self.client_id + self.size, old_client_id)
+                self._streaming = app
+            return app
+
+    def close(self):
+        self._closed = True
+        for slot, app in enumerate(self._slots):
+            if app is not None and app.isConnected():
+                app.disconnect()
+            self._slots[slot] = None
+        if self._streaming is not None and self._streaming.isConnected():
+            self._streaming.disconnect()
+        self._streaming = None
+        if self.allocator is not None:
+            for client_id in self.client_ids():
+                self.allocator.release(client_id)
+        self._slot_client_ids = [None] * self.size
+        self._streaming_client_id = None
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_session_pool(app_factory, hostname, port, client_id,
+                     size=DEFAULT_POOL_SIZE, allocator=None):
+    # One pool per (hostname, port, client_id), created on first use.
+    key = (hostname, port, client_id)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool._closed:
+            pool = ibkr_session_pool(app_factory, hostname, port, client_id,
+                                     size, allocator)
+            _pools[key] = pool
+        return pool
+
+
+def close_session_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
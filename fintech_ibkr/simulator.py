@@ -0,0 +1,518 @@
+# A stand-in for TWS / IB Gateway that speaks enough of the IB socket
+# protocol for EClient to connect and for everything in fintech_ibkr to run
+# offline: handshake, nextValidId, managedAccounts, reqContractDetails,
+# reqHistoricalData (including keepUpToDate), placeOrder / cancelOrder with
+# orderStatus, and reqCurrentTime.
+#
+#   with tws_simulator(port=7497, latency=0.05) as sim:
+#       fetch_historical_data(contract, port=sim.port, use_cache=False)
+#
+# or standalone:  python -m fintech_ibkr.simulator --port 7497 --latency 0.05
+#
+# Bars are synthetic but deterministic: the bar for a given symbol and time is
+# the same in every request, so caching and gap filling can be tested too.
+# Latency, random errors, IB's pacing limits and duplicate client ids can all
+# be switched on.
+import argparse
+import math
+import random
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from ibapi.message import IN, OUT
+from ibapi.server_versions import MAX_CLIENT_VER
+
+from fintech_ibkr.bar_store import duration_seconds, bar_size_seconds, IB_DATETIME_FORMAT
+from fintech_ibkr.pacing import IDENTICAL_REQUEST_SECONDS, SAME_CONTRACT_REQUESTS, \
+    SAME_CONTRACT_SECONDS, TOTAL_REQUESTS, TOTAL_SECONDS
+
+DEFAULT_SIMULATOR_PORT = 7497
+DEFAULT_ACCOUNTS = ('DU1234567',)
+FIRST_ORDER_ID = 1
+UPDATE_INTERVAL_SECONDS = 1.0
+SECONDS_PER_DAY = 86400
+NO_SECURITY_DEFINITION_CODE = 200
+ORDER_CANCELLED_CODE = 202
+HISTORICAL_DATA_ERROR_CODE = 162
+CLIENT_ID_IN_USE_CODE = 326
+SIMULATED_ERROR_CODE = 322
+KNOWN_SEC_TYPES = {'STK': 'SMART', 'CASH': 'IDEALPRO', 'CRYPTO': 'PAXOS'}
+
+
+def frame(fields):
+    text = ''.join(f'{field}\0' for field in fields).encode()
+    return struct.pack('!I', len(text)) + text
+
+
+def split_fields(payload):
+    return [field.decode(errors='backslashreplace') for field in payload.split(b'\0')[:-1]]
+
+
+def stable_hash(*parts):
+    # Same answer in every process, unlike hash()
+    value = 1469598103934665603
+    for byte in '\0'.join(str(part) for part in parts).encode():
+        value = ((value ^ byte) * 1099511628211) & 0xFFFFFFFFFFFFFFFF
+    return value
+
+
+def price_at(symbol, epoch_seconds):
+    # Deterministic synthetic price path: a daily and a weekly cycle plus
+    # per-second hash noise, around a per-symbol base price.
+    t = np.asarray(epoch_seconds, dtype=np.int64)
+    base = 0.5 + (stable_hash(symbol) % 20000) / 100
+    noise = (t.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+             + np.uint64(stable_hash(symbol, 'noise'))) >> np.uint64(40)
+    noise = noise.astype(np.float64) / float(1 << 24) - 0.5
+    cycle = 0.01 * np.sin(2 * math.pi * t / SECONDS_PER_DAY) + 0.03 * np.sin(2 * math.pi * t / (7 * SECONDS_PER_DAY))
+    return base * (1 + cycle + 0.001 * noise)
+
+
+def synthetic_bars(symbol, start, end, bar_seconds, skip_weekends=True):
+    # Bars starting in [start, end) epoch seconds, aligned to the bar size.
+    # Returns dict of arrays.
+    first = -(-start // bar_seconds) * bar_seconds
+    times = np.arange(first, end, bar_seconds, dtype=np.int64)
+    if skip_weekends:
+        # 1970-01-01 was a Thursday, so day % 7 is 2 for Saturday and 3 for Sunday
+        weekday = (times // SECONDS_PER_DAY) % 7
+        times = times[(weekday != 2) & (weekday != 3)]
+    opens = price_at(symbol, times)
+    closes = price_at(symbol, times + bar_seconds - 1)
+    middle = price_at(symbol, times + bar_seconds // 2)
+    spread = np.abs(opens - closes) + np.abs(middle - opens) * 0.5
+    volume = (stable_hash(symbol) % 900 + 100) * np.ones(len(times), dtype=np.int64)
+    return {
+        'time': times,
+        'open': opens,
+        'high': np.maximum(np.maximum(opens, closes), middle) + spread * 0.25,
+        'low': np.minimum(np.minimum(opens, closes), middle) - spread * 0.25,
+        'close': closes,
+        'volume': volume,
+        'wap': (opens + closes + middle) / 3,
+        'count': volume // 10,
+    }
+
+
+class simulated_connection:
+    def __init__(self, simulator, sock):
+        self.simulator = simulator
+        self.sock = sock
+        self.client_id = None
+        self.send_lock = threading.Lock()
+        self.closed = False
+        self.subscriptions = {}
+        self.recent = deque()
+        self.recent_by_contract = {}
+        self.last_by_key = {}
+
+    def send(self, *fields):
+        if self.closed:
+            return
+        try:
+            with self.send_lock:
+                self.sock.sendall(frame(fields))
+        except OSError:
+            self.close()
+
+    def send_later(self, callback, *args):
+        # Every answer goes out after the configured latency, off the reader
+        # thread, so slow answers don't hold up later requests.
+        delay = self.simulator.delay()
+        if delay <= 0:
+            callback(*args)
+            return
+        timer = threading.Timer(delay, callback, args)
+        timer.daemon = True
+        timer.start()
+
+    def error(self, req_id, code, message):
+        self.send(IN.ERR_MSG, 2, req_id, code, message)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        self.simulator.disconnected(self)
+
+    def serve(self):
+        buffer = b''
+        handshake_done = False
+        try:
+            while not self.closed:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                buffer += data
+                if not handshake_done:
+                    if not buffer.startswith(b'API\0') or len(buffer) < 8:
+                        continue
+                    size = struct.unpack('!I', buffer[4:8])[0]
+                    if len(buffer) < 8 + size:
+                        continue
+                    buffer = buffer[8 + size:]
+                    self.send(self.simulator.server_version,
+                              time.strftime('%Y%m%d %H:%M:%S ') + time.strftime('%Z'))
+                    handshake_done = True
+                while len(buffer) >= 4:
+                    size = struct.unpack('!I', buffer[:4])[0]
+                    if len(buffer) < 4 + size:
+                        break
+                    fields = split_fields(buffer[4:4 + size])
+                    buffer = buffer[4 + size:]
+                    if fields:
+                        self.handle(fields)
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def handle(self, fields):
+        handler = HANDLERS.get(int(fields[0]))
+        if handler is not None:
+            handler(self, fields)
+
+    # -- requests --------------------------------------------------------
+
+    def start_api(self, fields):
+        client_id = int(fields[2])
+        if not self.simulator.register_client(self, client_id):
+            self.error(-1, CLIENT_ID_IN_USE_CODE,
+                       'Unable to connect as the client id is already in use. Retry with a unique client id.')
+            self.close()
+            return
+        self.client_id = client_id
+        self.send(IN.MANAGED_ACCTS, 1, ','.join(self.simulator.accounts))
+        self.send(IN.NEXT_VALID_ID, 1, self.simulator.next_order_id())
+        for code, message in ((2104, 'Market data farm connection is OK:usfarm'),
+                              (2106, 'HMDS data farm connection is OK:ushmds')):
+            self.error(-1, code, message)
+
+    def req_ids(self, fields):
+        self.send_later(self.send, IN.NEXT_VALID_ID, 1, self.simulator.next_order_id())
+
+    def req_current_time(self, fields):
+        self.send_later(lambda: self.send(IN.CURRENT_TIME, 1, int(time.time())))
+
+    def req_contract_details(self, fields):
+        # [9, version, reqId, conId, symbol, secType, lastTradeDate, strike,
+        #  right, multiplier, exchange, primaryExchange, currency, ...]
+        req_id = int(fields[2])
+        symbol, sec_type = fields[4], fields[5]
+        exchange, primary_exchange, currency = fields[10], fields[11], fields[12]
+        if self.simulator.inject_error():
+            self.send_later(self.error, req_id, SIMULATED_ERROR_CODE, 'Simulated error')
+            return
+        if not known_contract(symbol, sec_type, exchange, currency):
+            self.send_later(self.error, req_id, NO_SECURITY_DEFINITION_CODE,
+                            'No security definition has been found for the request')
+            return
+        con_id = stable_hash(symbol, sec_type, currency) % 900_000_000 + 1
+        self.send_later(self.send_contract_details, req_id, symbol, sec_type, exchange,
+                        primary_exchange, currency, con_id)
+
+    def send_contract_details(self, req_id, symbol, sec_type, exchange, primary_exchange,
+                              currency, con_id):
+        local_symbol = f'{symbol}.{currency}' if sec_type == 'CASH' else symbol
+        self.send(
+            IN.CONTRACT_DATA, 8, req_id, symbol, sec_type, '', 0.0, '', exchange, currency,
+            local_symbol, symbol, symbol, con_id, 0.00005 if sec_type == 'CASH' else 0.01,
+            1, '', 'LMT,MKT', exchange, 1, 0, f'{symbol} {currency}', primary_exchange,
+            '', '', '', '', 'US/Eastern', '', '', '', 0, 0, 0, '', '', '26', '', '')
+        self.send(IN.CONTRACT_DATA_END, 1, req_id)
+
+    def req_historical_data(self, fields):
+        # [20, reqId, conId, symbol, secType, lastTradeDate, strike, right,
+        #  multiplier, exchange, primaryExchange, currency, localSymbol,
+        #  tradingClass, includeExpired, endDateTime, barSize, duration,
+        #  useRTH, whatToShow, formatDate, keepUpToDate, chartOptions]
+        req_id = int(fields[1])
+        symbol, sec_type, currency = fields[3], fields[4], fields[11]
+        end_date_time, bar_size, duration = fields[15], fields[16], fields[17]
+        format_date = int(fields[20])
+        keep_up_to_date = fields[21] == '1'
+        contract_key = (symbol, sec_type, currency)
+        violation = self.pacing_violation(contract_key, tuple(fields[2:21]))
+        if violation:
+            self.send_later(self.error, req_id, HISTORICAL_DATA_ERROR_CODE,
+                            f'Historical Market Data Service error message:{violation}')
+            return
+        if self.simulator.inject_error():
+            self.send_later(self.error, req_id, SIMULATED_ERROR_CODE, 'Simulated error')
+            return
+        try:
+            bar_seconds = bar_size_seconds(bar_size)
+            end = time.time() if not end_date_time else time.mktime(
+                time.strptime(' '.join(end_date_time.split()[:2]), IB_DATETIME_FORMAT))
+            start = end - duration_seconds(duration)
+        except (ValueError, KeyError):
+            self.send_later(self.error, req_id, 321, 'Error validating request:-\'bP\' : cause - invalid bar size or duration')
+            return
+        bars = synthetic_bars(symbol, int(start), int(end), bar_seconds, self.simulator.skip_weekends)
+        if keep_up_to_date:
+            self.subscriptions[req_id] = True
+        self.send_later(self.send_historical_data, req_id, symbol, bars, bar_seconds,
+                        format_date, start, end, keep_up_to_date)
+
+    def send_historical_data(self, req_id, symbol, bars, bar_seconds, format_date, start, end,
+                             keep_up_to_date):
+        count = len(bars['time'])
+        if not count:
+            self.error(req_id, HISTORICAL_DATA_ERROR_CODE,
+                       'Historical Market Data Service error message:HMDS query returned no data')
+            return
+        if bar_seconds >= SECONDS_PER_DAY:
+            dates = [time.strftime('%Y%m%d', time.localtime(t)) for t in bars['time'].tolist()]
+        elif format_date == 2:
+            dates = bars['time'].tolist()
+        else:
+            dates = [time.strftime('%Y%m%d  %H:%M:%S', time.localtime(t)) for t in bars['time'].tolist()]
+        fields = [IN.HISTORICAL_DATA, req_id,
+                  time.strftime('%Y%m%d  %H:%M:%S', time.localtime(start)),
+                  time.strftime('%Y%m%d  %H:%M:%S', time.localtime(end)), count]
+        columns = zip(dates, bars['open'].tolist(), bars['high'].tolist(), bars['low'].tolist(),
+                      bars['close'].tolist(), bars['volume'].tolist(), bars['wap'].tolist(),
+                      bars['count'].tolist())
+        for row in columns:
+            fields.extend(row)
+        self.send(*fields)
+        if keep_up_to_date:
+            threading.Thread(target=self.stream_updates, args=(req_id, symbol, bar_seconds),
+                             daemon=True).start()
+
+    def stream_updates(self, req_id, symbol, bar_seconds):
+        # historicalDataUpdate with the forming bar until cancelled
+        while not self.closed and self.subscriptions.get(req_id):
+            time.sleep(self.simulator.update_interval)
+            now = int(time.time())
+            bar_start = now - now % bar_seconds
+            bars = synthetic_bars(symbol, bar_start, bar_start + 1, bar_seconds,
+                                  self.simulator.skip_weekends)
+            if not len(bars['time']):
+                continue
+            close = float(price_at(symbol, now))
+            opened = float(bars['open'][0])
+            self.send(IN.HISTORICAL_DATA_UPDATE, req_id, int(bars['count'][0]), bar_start,
+                      opened, close, max(opened, close, float(bars['high'][0])),
+                      min(opened, close, float(bars['low'][0])), float(bars['wap'][0]),
+                      int(bars['volume'][0]))
+
+    def cancel_historical_data(self, fields):
+        self.subscriptions.pop(int(fields[2]), None)
+
+    def place_order(self, fields):
+        # [3, orderId, conId, symbol, secType, lastTradeDate, strike, right,
+        #  multiplier, exchange, primaryExchange, currency, localSymbol,
+        #  tradingClass, secIdType, secId, action, totalQuantity, orderType,
+        #  lmtPrice, auxPrice, tif, ...]
+        order_id = int(fields[1])
+        quantity = float(fields[17] or 0)
+        order_type, lmt_price = fields[18], fields[19]
+        symbol = fields[3]
+        if self.simulator.inject_error():
+            self.send_later(self.error, order_id, 201, 'Order rejected - reason:Simulated error')
+            return
+        perm_id = self.simulator.next_perm_id()
+        if order_type == 'MKT':
+            fill = float(price_at(symbol, int(time.time())))
+            self.send_later(self.order_filled, order_id, perm_id, quantity, fill)
+        else:
+            self.send_later(self.order_status, order_id, 'Submitted', 0.0, quantity, 0.0, perm_id, 0.0)
+        self.simulator.orders[order_id] = (self, perm_id, quantity)
+
+    def order_filled(self, order_id, perm_id, quantity, fill):
+        self.order_status(order_id, 'PreSubmitted', 0.0, quantity, 0.0, perm_id, 0.0)
+        self.order_status(order_id, 'Filled', quantity, 0.0, fill, perm_id, fill)
+
+    def order_status(self, order_id, status, filled, remaining, avg_fill_price, perm_id,
+                     last_fill_price):
+        self.send(IN.ORDER_STATUS, order_id, status, filled, remaining, avg_fill_price,
+                  perm_id, 0, last_fill_price, self.client_id, '', 0.0)
+
+    def cancel_order(self, fields):
+        order_id = int(fields[2])
+        order = self.simulator.orders.pop(order_id, None)
+        if order is None:
+            self.send_later(self.error, order_id, 135, "Can't find order with id =" + str(order_id))
+            return
+        _, perm_id, quantity = order
+        self.send_later(self.order_status, order_id, 'Cancelled', 0.0, quantity, 0.0, perm_id, 0.0)
+        self.send_later(self.error, order_id, ORDER_CANCELLED_CODE, 'Order Canceled - reason:')
+
+    def pacing_violation(self, contract_key, request_key):
+        # IB's historical data limits, applied per connection like the
+        # pacing_scheduler applies them per process.
+        if not self.simulator.enforce_pacing:
+            return None
+        now = time.monotonic()
+        recent = self.recent
+        while recent and recent[0] <= now - TOTAL_SECONDS:
+            recent.popleft()
+        by_contract = self.recent_by_contract.setdefault(contract_key, deque())
+        while by_contract and by_contract[0] <= now - SAME_CONTRACT_SECONDS:
+            by_contract.popleft()
+        last = self.last_by_key.get(request_key)
+        violation = None
+        if last is not None and now - last < IDENTICAL_REQUEST_SECONDS:
+            violation = 'Pacing violation: identical request within 15 seconds'
+        elif len(by_contract) >= SAME_CONTRACT_REQUESTS:
+            violation = 'Pacing violation: 6 or more requests for the same contract within 2 seconds'
+        elif len(recent) >= TOTAL_REQUESTS:
+            violation = 'Pacing violation: more than 60 requests within 10 minutes'
+        recent.append(now)
+        by_contract.append(now)
+        self.last_by_key[request_key] = now
+        if violation:
+            self.simulator.pacing_violations += 1
+        return violation
+
+
+HANDLERS = {
+    OUT.START_API: simulated_connection.start_api,
+    OUT.REQ_IDS: simulated_connection.req_ids,
+    OUT.REQ_CURRENT_TIME: simulated_connection.req_current_time,
+    OUT.REQ_CONTRACT_DATA: simulated_connection.req_contract_details,
+    OUT.REQ_HISTORICAL_DATA: simulated_connection.req_historical_data,
+    OUT.CANCEL_HISTORICAL_DATA: simulated_connection.cancel_historical_data,
+    OUT.PLACE_ORDER: simulated_connection.place_order,
+    OUT.CANCEL_ORDER: simulated_connection.cancel_order,
+}
+
+
+def known_contract(symbol, sec_type, exchange, currency):
+    if sec_type not in KNOWN_SEC_TYPES or not symbol.isalnum() or not currency.isalpha():
+        return False
+    if sec_type == 'CASH':
+        return len(symbol) == 3 and len(currency) == 3 and symbol != currency
+    return True
+
+
+class tws_simulator:
+    def __init__(self, host='127.0.0.1', port=DEFAULT_SIMULATOR_PORT, latency=0.0, jitter=0.0,
+                 error_rate=0.0, enforce_pacing=False, accounts=DEFAULT_ACCOUNTS,
+                 update_interval=UPDATE_INTERVAL_SECONDS, skip_weekends=True,
+                 server_version=MAX_CLIENT_VER, seed=None):
+        # port=0 picks a free port; see .port once started. skip_weekends=False
+        # trades around the clock, so streaming can be tested on a Sunday.
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.enforce_pacing = enforce_pacing
+        self.accounts = list(accounts)
+        self.update_interval = update_interval
+        self.skip_weekends = skip_weekends
+        self.server_version = server_version
+        self.orders = {}
+        self.pacing_violations = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._connections = set()
+        self._next_order_id = FIRST_ORDER_ID
+        self._next_perm_id = 1_000_000
+        self._socket = None
+        self._thread = None
+
+    def delay(self):
+        if not self.jitter:
+            return self.latency
+        with self._lock:
+            return max(0.0, self._random.gauss(self.latency, self.jitter))
+
+    def inject_error(self):
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def next_order_id(self):
+        with self._lock:
+            return self._next_order_id
+
+    def next_perm_id(self):
+        with self._lock:
+            self._next_perm_id += 1
+            return self._next_perm_id
+
+    def register_client(self, connection, client_id):
+        with self._lock:
+            if client_id in self._clients:
+                return False
+            self._clients[client_id] = connection
+            return True
+
+    def disconnected(self, connection):
+        with self._lock:
+            self._connections.discard(connection)
+            if self._clients.get(connection.client_id) is connection:
+                del self._clients[connection.client_id]
+
+    def start(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, self.port))
+        self._socket.listen()
+        self.port = self._socket.getsockname()[1]
+        self._thread = threading.Thread(target=self._accept_loop, daemon=True,
+                                        name='tws-simulator')
+        self._thread.start()
+        print(f'TWS simulator listening on {self.host}:{self.port}')
+        return self
+
+    def stop(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            connection.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _accept_loop(self):
+        while self._socket is not None:
+            try:
+                sock, _ = self._socket.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = simulated_connection(self, sock)
+            with self._lock:
+                self._connections.add(connection)
+            threading.Thread(target=connection.serve, daemon=True,
+                             name='tws-simulator-connection').start()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for TWS / IB Gateway')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_SIMULATOR_PORT)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every answer')
+    parser.add_argument('--jitter', type=float, default=0.0, help='standard deviation of the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with an error')
+    parser.add_argument('--enforce-pacing', action='store_true', help='reject requests that break IB pacing rules')
+    parser.add_argument('--weekends', action='store_true', help='keep trading on Saturdays and Sundays')
+    args = parser.parse_args()
+    simulator = tws_simulator(args.host, args.port, args.latency, args.jitter, args.error_rate,
+                              args.enforce_pacing, skip_weekends=not args.weekends).start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.stop()
@@ -0,0 +1,355 @@
+# Live bars via reqHistoricalData(keepUpToDate=True).
+#
+# TWS first sends a normal set of historical bars and then keeps calling
+# historicalDataUpdate with the bar that is currently forming (same date,
+# revised values) until a new bar starts. Every subscription writes those into
+# a fixed-size ring buffer, so a reader (the chart's polling callback) only has
+# to ask for what came after the last bar it has already drawn.
+#
+# Browser sessions don't subscribe directly: the subscription_broker shares one
+# upstream subscription between every session watching the same instrument.
+import json
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import numpy as np
+import pandas as pd
+
+from fintech_ibkr.bar_buffer import bar_local_seconds
+from fintech_ibkr.bar_store import bar_size_seconds, contract_fields
+from fintech_ibkr.pacing import request_scheduler, PRIORITY_INTERACTIVE
+from fintech_ibkr.synchronous_functions import session_pool, historical_request_keys, \
+    default_hostname, default_port, default_client_id, DEFAULT_TIMEOUT_SECONDS
+
+RING_COLUMNS = ['time', 'open', 'high', 'low', 'close', 'volume']
+DEFAULT_RING_CAPACITY = 4096
+# IB only streams bars of 5 seconds or more
+MIN_STREAM_BAR_SECONDS = 5
+# History requested along with the subscription, just enough to seed the ring
+STREAM_SEED_SECONDS = 3600
+SECONDS_PER_DAY = 86400
+# Viewers that haven't polled for this long are dropped
+STREAM_IDLE_SECONDS = 60
+# How often the broker looks for them while it has subscriptions open
+STREAM_REAP_SECONDS = 15
+
+
+class bar_ring_buffer:
+    # The last `capacity` bars of a subscription. A bar with the same time as
+    # the newest one replaces it (the forming bar being revised); a later time
+    # appends. Safe to read from one thread while the IB reader thread writes.
+    def __init__(self, capacity=DEFAULT_RING_CAPACITY):
+        self.capacity = capacity
+        self.time = np.zeros(capacity, dtype=np.int64)
+        self.open = np.zeros(capacity, dtype=np.float64)
+        self.high = np.zeros(capacity, dtype=np.float64)
+        self.low = np.zeros(capacity, dtype=np.float64)
+        self.close = np.zeros(capacity, dtype=np.float64)
+        self.volume = np.zeros(capacity, dtype=np.float64)
+        self.count = 0
+        self.version = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def update(self, bar_time, open, high, low, close, volume):
+        with self._lock:
+            if self.count:
+                last = (self.count - 1) % self.capacity
+                if bar_time < self.time[last]:
+                    return
+                if bar_time == self.time[last]:
+                    i = last
+                else:
+                    i = self.count % self.capacity
+                    self.count += 1
+            else:
+                i = 0
+                self.count = 1
+            self.time[i] = bar_time
+            self.open[i] = open
+            self.high[i] = high
+            self.low[i] = low
+            self.close[i] = close
+            self.volume[i] = volume
+            self.version += 1
+
+    def update_bar(self, bar):
+        self.update(bar_local_seconds(bar.date), bar.open, bar.high, bar.low,
+                    bar.close, bar.volume)
+
+    def since(self, after=None):
+        # Bars newer than `after` (naive local seconds), oldest first, as a
+        # dict of column arrays. The last one may still be forming.
+        with self._lock:
+            n = len(self)
+            order = np.arange(self.count - n, self.count) % self.capacity
+            times = self.time[order]
+            if after is not None:
+                order = order[times > after]
+            return {column: getattr(self, column)[order].copy() for column in RING_COLUMNS}
+
+    def to_frame(self, after=None):
+        bars = self.since(after)
+        frame = pd.DataFrame(bars)
+        frame.insert(0, 'date', pd.to_datetime(frame.pop('time'), unit='s'))
+        return frame
+
+
+class bar_subscription:
+    def __init__(self, app, reqId, contract, barSizeSetting, whatToShow, useRTH,
+                 capacity=DEFAULT_RING_CAPACITY):
+        self.app = app
+        self.reqId = reqId
+        self.contract = contract
+        self.barSizeSetting = barSizeSetting
+        self.whatToShow = whatToShow
+        self.useRTH = useRTH
+        self.bars = bar_ring_buffer(capacity)
+        # Set by the app if IB ends the subscription or the connection drops
+        self.error = None
+        self.cancelled = False
+
+    @property
+    def alive(self):
+        return not self.cancelled and self.error is None and self.app.isConnected()
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        self.app.unsubscribe_updates(self.reqId)
+        if self.app.isConnected():
+            self.app.cancelHistoricalData(self.reqId)
+
+
+def stream_seed_duration(barSizeSetting):
+    bar_seconds = bar_size_seconds(barSizeSetting)
+    if bar_seconds >= SECONDS_PER_DAY:
+        return '1 W'
+    return f'{min(max(2 * bar_seconds, STREAM_SEED_SECONDS), SECONDS_PER_DAY)} S'
+
+
+def subscribe_historical_bars(contract, barSizeSetting='1 hour', whatToShow='MIDPOINT',
+                              useRTH=True, hostname=default_hostname, port=default_port,
+                              client_id=default_client_id, timeout=DEFAULT_TIMEOUT_SECONDS,
+                              priority=PRIORITY_INTERACTIVE, capacity=DEFAULT_RING_CAPACITY):
+    # Start a keepUpToDate subscription on the pool's streaming connection and
+    # wait for its initial bars. Subscriptions aren't checked out of the pool,
+    # so any number of them share that one connection.
+    if bar_size_seconds(barSizeSetting) < MIN_STREAM_BAR_SECONDS:
+        raise ValueError(f'Cannot stream {barSizeSetting} bars, the minimum is {MIN_STREAM_BAR_SECONDS} secs')
+    pool = session_pool(hostname, port, client_id)
+    app = pool.streaming_app()
+    reqId = pool.next_request_id()
+    subscription = bar_subscription(app, reqId, contract, barSizeSetting, whatToShow,
+                                    useRTH, capacity)
+    durationStr = stream_seed_duration(barSizeSetting)
+
+    def issue():
+        future = app.start_request(reqId)
+        app.subscribe_updates(reqId, subscription)
+        app.reqHistoricalData(
+            reqId, contract, '', durationStr, barSizeSetting, whatToShow, useRTH,
+            formatDate=2, keepUpToDate=True, chartOptions=[])
+        return future
+
+    # Each subscription is its own stream, so it is paced but never coalesced.
+    _, contract_key = historical_request_keys(
+        contract, '', durationStr, barSizeSetting, whatToShow, useRTH)
+    scheduler = request_scheduler()
+    future = scheduler.submit(issue, None, contract_key, priority)
+    try:
+        future.result(timeout=timeout)
+    except FutureTimeoutError:
+        scheduler.cancel(future)
+        subscription.cancel()
+        raise TimeoutError(f'Streaming request {reqId} timed out after {timeout}s')
+    except Exception:
+        subscription.cancel()
+        raise
+    finally:
+        app.finish_request(reqId)
+    return subscription
+
+
+def subscription_key(contract, barSizeSetting, whatToShow, useRTH):
+    return json.dumps([contract_fields(contract), barSizeSetting, whatToShow, bool(useRTH)],
+                      sort_keys=True)
+
+
+class shared_subscription:
+    # One upstream subscription and the viewers (stream ids) reading from it.
+    # `future` resolves to the bar_subscription once the first viewer's
+    # request has its initial bars; later viewers wait on the same Future.
+    def __init__(self, key):
+        self.key = key
+        self.future = Future()
+        self.viewers = {}
+        self.closed = False
+
+    @property
+    def dead(self):
+        if not self.future.done():
+            return False
+        return self.future.exception() is not None or not self.future.result().alive
+
+    def cancel(self):
+        self.closed = True
+        if self.future.done() and self.future.exception() is None:
+            self.future.result().cancel()
+
+
+class subscription_broker:
+    # Keeps one upstream IB subscription per (contract, barSize, whatToShow,
+    # useRTH) however many browser sessions are watching it. Every session
+    # reads the same ring buffer with its own cursor, so upstream requests and
+    # memory grow with the number of instruments, not viewers. Sessions
+    # heartbeat by attaching on every poll; the upstream is cancelled when the
+    # last one detaches or goes quiet for idle_seconds. A reaper thread checks
+    # for quiet ones every reap_seconds while there are upstreams.
+    def __init__(self, subscribe=subscribe_historical_bars,
+                 idle_seconds=STREAM_IDLE_SECONDS, timer=time.monotonic,
+                 reap_seconds=STREAM_REAP_SECONDS):
+        self.subscribe = subscribe
+        self.idle_seconds = idle_seconds
+        self.timer = timer
+        self.reap_seconds = reap_seconds
+        self._lock = threading.Lock()
+        self._upstreams = {}
+        self._viewers = {}
+        self._reaper = None
+
+    def attach(self, stream_id, contract, barSizeSetting, whatToShow, useRTH, **kwargs):
+        # The bar_subscription stream_id should read from, subscribing
+        # upstream if nobody else is watching this instrument yet.
+        self.reap()
+        key = subscription_key(contract, barSizeSetting, whatToShow, useRTH)
+        released = []
+        with self._lock:
+            if self._viewers.get(stream_id, key) != key:
+                released += self._detach(stream_id)
+            upstream = self._upstreams.get(key)
+            if upstream is not None and upstream.dead:
+                del self._upstreams[key]
+                released.append(upstream)
+                upstream = None
+            create = upstream is None
+            if create:
+                upstream = self._upstreams[key] = shared_subscription(key)
+                self._ensure_reaper()
+            upstream.viewers[stream_id] = self.timer()
+            self._viewers[stream_id] = key
+        for stale in released:
+            stale.cancel()
+        if create:
+            self._start(upstream, contract, barSizeSetting, whatToShow, useRTH, kwargs)
+        return upstream.future.result()
+
+    def detach(self, stream_id):
+        self.reap()
+        with self._lock:
+            released = self._detach(stream_id)
+        for upstream in released:
+            upstream.cancel()
+
+    def reap(self):
+        # Browsers that close the tab never say so; drop the sessions that
+        # stopped polling.
+        cutoff = self.timer() - self.idle_seconds
+        with self._lock:
+            idle = [stream_id for upstream in self._upstreams.values()
+                    for stream_id, seen in upstream.viewers.items() if seen < cutoff]
+            released = [upstream for stream_id in idle for upstream in self._detach(stream_id)]
+        for upstream in released:
+            upstream.cancel()
+
+    def stats(self):
+        self.reap()
+        with self._lock:
+            return {'upstreams': len(self._upstreams), 'viewers': len(self._viewers),
+                    'viewers_by_upstream': {key: len(upstream.viewers)
+                                            for key, upstream in self._upstreams.items()}}
+
+    def close(self):
+        with self._lock:
+            released = list(self._upstreams.values())
+            self._upstreams.clear()
+            self._viewers.clear()
+        for upstream in released:
+            upstream.cancel()
+
+    def _ensure_reaper(self):
+        # Caller holds the lock
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap_loop, daemon=True,
+                                            name='ibkr-stream-reaper')
+            self._reaper.start()
+
+    def _reap_loop(self):
+        # Without this a session that was the last one watching an instrument
+        # would keep its upstream open for good once its tab closed, since
+        # nobody attaches again to trigger reap().
+        while True:
+            time.sleep(self.reap_seconds)
+            try:
+                self.reap()
+            except Exception as e:
+                print(f'Stream reaper: {e}')
+            with self._lock:
+                if not self._upstreams:
+                    self._reaper = None
+                    return
+
+    def _detach(self, stream_id):
+        # Caller holds the lock. Returns the upstreams left without viewers,
+        # to be cancelled once the lock is released.
+        key = self._viewers.pop(stream_id, None)
+        upstream = self._upstreams.get(key)
+        if upstream is None:
+            return []
+        upstream.viewers.pop(stream_id, None)
+        if upstream.viewers:
+            return []
+        del self._upstreams[key]
+        return [upstream]
+
+    def _start(self, upstream, contract, barSizeSetting, whatToShow, useRTH, kwargs):
+        try:
+            subscription = self.subscribe(contract, barSizeSetting, whatToShow, useRTH, **kwargs)
+        except Exception as e:
+            with self._lock:
+                if self._upstreams.get(upstream.key) is upstream:
+                    del self._upstreams[upstream.key]
+                for stream_id in upstream.viewers:
+                    if self._viewers.get(stream_id) == upstream.key:
+                        del self._viewers[stream_id]
+            upstream.future.set_exception(e)
+            return
+        upstream.future.set_result(subscription)
+        # Everyone may have left while the request was in flight
+        if upstream.closed:
+            subscription.cancel()
+
+
+_default_broker = None
+_default_broker_lock = threading.Lock()
+
+
+def default_subscription_broker():
+    global _default_broker
+    with _default_broker_lock:
+        if _default_broker is None:
+            _default_broker = subscription_broker()
+        return _default_broker
+
+
+def stream_for(stream_id, contract, barSizeSetting, whatToShow, useRTH, **kwargs):
+    return default_subscription_broker().attach(
+        stream_id, contract, barSizeSetting, whatToShow, useRTH, **kwargs)
+
+
+def stop_stream(stream_id):
+    default_subscription_broker().detach(stream_id)
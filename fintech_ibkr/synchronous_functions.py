@@ -1,11 +1,24 @@
 import pandas as pd
 from ibapi.client import EClient
 from ibapi.common import OrderId
+from ibapi.contract import Contract
 from ibapi.wrapper import EWrapper
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import json
+import logging
 import threading
 import time
 from datetime import datetime
 import os
+from fintech_ibkr.sessions import get_session_pool, close_session_pools
+from fintech_ibkr.client_ids import default_client_id_allocator
+from fintech_ibkr.caching import ttl_lru_cache, MISSING
+from fintech_ibkr.order_journal import default_order_journal
+from fintech_ibkr.bar_buffer import bar_buffer, empty_bars
+from fintech_ibkr.order_state import order_status_table
+from fintech_ibkr.error_log import error_ring_buffer
+from fintech_ibkr.bar_store import historical_bar_store, key_fields, contract_fields
+from fintech_ibkr.pacing import request_scheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
 
 APP_DATA_PATH = f"{os.getenv('TESTAPP_DATA_PATH')}\submitted_orders.csv"
 default_hostname = '127.0.0.1'
@@ -15,239 +28,488 @@ DEFAULT_ERROR_CODE = -999
 SHORT_SLEEP_SECONDS = 0.1
 MEDIUM_SLEEP_SECONDS = 0.5
 LONG_SLEEP_SECONDS = 5
+DEFAULT_TIMEOUT_SECONDS = 60
+CURRENT_TIME_TIMEOUT_SECONDS = 2
 WARNING_ERROR_CODES = [399, 504, 2104, 2168, 2169]
+NO_DATA_ERROR_CODE = 162
+CLIENT_ID_IN_USE_ERROR_CODE = 326
+# For an order, only these mean TWS turned it down (or cancelled it); the
+# rest (2109 outside RTH attribute ignored, 10167 delayed data, ...) come
+# with an order that is live all the same.
+ORDER_REJECTION_ERROR_CODES = range(100, 1000)
+ORDER_CANCELLED_STATUSES = ['Cancelled', 'ApiCancelled']
+CONTRACT_DETAILS_CACHE_SIZE = 1024
+CONTRACT_DETAILS_TTL_SECONDS = 6 * 60 * 60
+CONTRACT_DETAILS_NEGATIVE_TTL_SECONDS = 60
+WATCHLIST_PATH = os.path.join(os.getenv('TESTAPP_DATA_PATH') or '', 'watchlist.csv')
+
+contract_details_cache = ttl_lru_cache(CONTRACT_DETAILS_CACHE_SIZE, CONTRACT_DETAILS_TTL_SECONDS)
+
+
+class ibkr_request_error(Exception):
+    def __init__(self, reqId, errorCode, errorString):
+        super().__init__(f'reqId={reqId} errorCode={errorCode} errorMessage={errorString}')
+        self.reqId = reqId
+        self.errorCode = errorCode
+        self.errorString = errorString
+
+    def __reduce__(self):
+        # Survive pickling (the broker process sends these to web workers)
+        return ibkr_request_error, (self.reqId, self.errorCode, self.errorString)
 
 
 class ibkr_app(EWrapper, EClient):
     def __init__(self):
         EClient.__init__(self, self)
-        self.error_messages = pd.DataFrame(columns=[
-            'reqId', 'errorCode', 'errorString'
-        ])
+        self.errors = error_ring_buffer()
         self.next_valid_id = None
+        self.next_valid_id_event = threading.Event()
+        self.client_id_rejected = False
         self.current_time = None
-        self.historical_data_end = ''
-        self.contract_details = None
-        self.contract_details_end = None
-        self.contract_details_reqId = None
-        self.order_reqId_end = None
         self.order_reqId = None
-        self.order_status = pd.DataFrame(
-            columns=['orderId', 'status', 'filled', 'remaining', 'avgFillPrice',
-                     'permId', 'parentId', 'lastFillPrice', 'clientId',
-                     'whyHeld', 'mktCapPrice'])
+        self.order_states = order_status_table()
 
-        self.historical_data = pd.DataFrame(columns=['date', 'open', 'close', 'high', 'low'])
+        self.historical_data = empty_bars()
         self.managed_accounts = ''
 
+        # Every in-flight request has a Future keyed on its reqId (the order id
+        # for orders). The wrapper callbacks below resolve or fail it, so the
+        # caller wakes up as soon as TWS answers.
+        self._requests_lock = threading.Lock()
+        self._requests = {}
+        self._historical_data = {}
+        self._contract_details = {}
+        self._current_time_future = None
+        # Order ids among the requests, see start_order
+        self._orders = set()
+        # keepUpToDate subscriptions: reqId -> streaming.bar_subscription
+        self._subscriptions = {}
+
+    def reset_request_state(self):
+        # Pooled apps are reused across calls, so clear whatever the previous
+        # request left behind before starting a new one.
+        self.current_time = None
+        self.order_reqId = None
+
+    def start_request(self, reqId):
+        future = Future()
+        with self._requests_lock:
+            self._requests[reqId] = future
+        return future
+
+    def start_order(self, orderId):
+        # A request for an order's first status. Unlike other requests, only
+        # a rejection fails it.
+        future = self.start_request(orderId)
+        with self._requests_lock:
+            self._orders.add(orderId)
+        return future
+
+    def finish_request(self, reqId):
+        # Forget a request whether it completed or not; late callbacks for it
+        # are then ignored.
+        with self._requests_lock:
+            self._requests.pop(reqId, None)
+            self._orders.discard(reqId)
+            self._historical_data.pop(reqId, None)
+            self._contract_details.pop(reqId, None)
+
+    def _resolve_request(self, reqId, result):
+        with self._requests_lock:
+            future = self._requests.pop(reqId, None)
+            self._orders.discard(reqId)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def _fail_request(self, reqId, exception):
+        with self._requests_lock:
+            future = self._requests.pop(reqId, None)
+            self._orders.discard(reqId)
+        if future is not None and not future.done():
+            future.set_exception(exception)
+        return future is not None
+
+    def request_current_time(self):
+        # Concurrent callers share one outstanding reqCurrentTime.
+        with self._requests_lock:
+            future = self._current_time_future
+            if future is None or future.done():
+                future = self._current_time_future = Future()
+                send = True
+            else:
+                send = False
+        if send:
+            self.reqCurrentTime()
+        return future
+
+    @property
+    def error_messages(self):
+        # The most recent errors and notices as a DataFrame, built on demand
+        return self.errors.to_frame()
+
     def error(self, reqId, errorCode, errorString):
-        if reqId == self.contract_details_reqId:
-            print(f'Error from contract details api: errorCode={errorCode} errorMessage={errorString}')
-            self.contract_details_end = DEFAULT_ERROR_CODE
-        elif reqId == self.order_reqId_end:
-            print(f'Error from place order api: errorCode={errorCode} errorMessage={errorString}')
-            self.order_reqId_end = DEFAULT_ERROR_CODE
-
-        if (reqId != -1) and errorCode not in WARNING_ERROR_CODES:
-            print("Error: ", reqId, " ", errorCode, " ", errorString)
-            print("Closing connection!")
-            self.disconnect()
-        self.error_messages = pd.concat(
-            [self.error_messages, pd.DataFrame({
-                "reqId": [reqId],
-                "errorCode": [errorCode],
-                "errorString": [errorString]
-            })])
+        if errorCode == CLIENT_ID_IN_USE_ERROR_CODE:
+            self.client_id_rejected = True
+        if reqId in self._orders and errorCode not in ORDER_REJECTION_ERROR_CODES:
+            # The order is working regardless: keep waiting for its status
+            self.errors.add(reqId, errorCode, errorString)
+        elif (reqId != -1) and errorCode not in WARNING_ERROR_CODES:
+            self.errors.add(reqId, errorCode, errorString)
+            self._fail_request(reqId, ibkr_request_error(reqId, errorCode, errorString))
+            subscription = self._subscriptions.pop(reqId, None)
+            if subscription is not None:
+                subscription.error = ibkr_request_error(reqId, errorCode, errorString)
+        else:
+            # Farm status and other notices: kept and counted, only logged
+            # at debug level
+            self.errors.add(reqId, errorCode, errorString, logging.DEBUG)
+
+    def connectionClosed(self):
+        with self._requests_lock:
+            pending = list(self._requests.items())
+            self._requests.clear()
+            subscriptions = list(self._subscriptions.values())
+            self._subscriptions.clear()
+        for reqId, future in pending:
+            if not future.done():
+                future.set_exception(ConnectionError(f'Connection closed before reqId {reqId} completed'))
+        for subscription in subscriptions:
+            subscription.error = ConnectionError('Connection closed')
 
     def managedAccounts(self, accountsList):
         self.managed_accounts = [i for i in accountsList.split(",") if i]
 
     def nextValidId(self, orderId: int):
         self.next_valid_id = orderId
+        self.next_valid_id_event.set()
 
     def currentTime(self, time: int):
         self.current_time = datetime.fromtimestamp(time).astimezone().isoformat()
+        future = self._current_time_future
+        if future is not None and not future.done():
+            future.set_result(self.current_time)
 
     def historicalData(self, reqId, bar):
-        record = pd.DataFrame(
-            {'date': [bar.date],
-             'open': [bar.open],
-             'high': [bar.high],
-             'low': [bar.low],
-             'close': [bar.close]
-             })
-        record['date'] = pd.to_datetime(record['date'])
-        self.historical_data = pd.concat([self.historical_data, record], ignore_index=True)
+        # Runs on the reader thread once per bar, so keep it to an append.
+        buffer = self._historical_data.get(reqId)
+        if buffer is None:
+            with self._requests_lock:
+                buffer = self._historical_data.setdefault(reqId, bar_buffer())
+        buffer.append(bar)
+        # A keepUpToDate request's initial bars also seed its ring buffer, in
+        # order with the updates that follow them.
+        subscription = self._subscriptions.get(reqId)
+        if subscription is not None:
+            subscription.bars.update_bar(bar)
 
     def historicalDataEnd(self, reqId: int, start: str, end: str):
         print("HistoricalDataEnd. ReqId:", reqId, "from", start, "to", end)
-        self.historical_data_end = reqId
+        with self._requests_lock:
+            buffer = self._historical_data.pop(reqId, None)
+        data = buffer.to_frame() if buffer is not None else empty_bars()
+        self.historical_data = data
+        self._resolve_request(reqId, data)
+
+    def subscribe_updates(self, reqId, subscription):
+        with self._requests_lock:
+            self._subscriptions[reqId] = subscription
+
+    def unsubscribe_updates(self, reqId):
+        with self._requests_lock:
+            self._subscriptions.pop(reqId, None)
+
+    def historicalDataUpdate(self, reqId: int, bar):
+        subscription = self._subscriptions.get(reqId)
+        if subscription is not None:
+            subscription.bars.update_bar(bar)
 
     def contractDetails(self, reqId: int, contractDetails):
-        self.contract_details = contractDetails
+        with self._requests_lock:
+            self._contract_details.setdefault(reqId, []).append(contractDetails)
 
     def contractDetailsEnd(self, reqId: int):
-        self.contract_details_end = reqId
+        with self._requests_lock:
+            details = self._contract_details.pop(reqId, [])
+        self._resolve_request(reqId, details)
+
+    @property
+    def order_status(self):
+        # Latest status of each order as a DataFrame, built on demand
+        return self.order_states.to_frame()
 
     def orderStatus(self, orderId: OrderId, status: str, filled: float,
                     remaining: float, avgFillPrice: float, permId: int,
                     parentId: int, lastFillPrice: float, clientId: int,
                     whyHeld: str, mktCapPrice: float):
         print(f'Order {orderId} status is {status}')
-        self.order_reqId_end = orderId
-        self.order_status = pd.concat(
-            [
-                self.order_status,
-                pd.DataFrame({
-                    'order_id': [orderId],
-                    'status': [status],
-                    'filled': [filled],
-                    'remaining': [remaining],
-                    'avg_fill_price': [avgFillPrice],
-                    'perm_id': [permId],
-                    'parent_id': [parentId],
-                    'last_fill_price': [lastFillPrice],
-                    'client_id': [clientId],
-                    'why_held': [whyHeld],
-                    'mkt_cap_price': [mktCapPrice]
-                })
-            ],
-            ignore_index=True
-        )
-        self.order_status.drop_duplicates(inplace=True)
+        self.order_states.update(orderId, status, filled, remaining, avgFillPrice,
+                                 permId, parentId, lastFillPrice, clientId, whyHeld,
+                                 mktCapPrice)
+        if status in ORDER_CANCELLED_STATUSES and not filled:
+            self._fail_request(orderId, ibkr_request_error(orderId, DEFAULT_ERROR_CODE, f'Order {status}'))
+        else:
+            self._resolve_request(orderId, status)
 
 
-def fetch_managed_accounts(hostname=default_hostname, port=default_port,
-                           client_id=default_client_id):
-    app = ibkr_app()
-    app.connect(hostname, port, client_id)
-    while not app.isConnected():
-        time.sleep(SHORT_SLEEP_SECONDS)
+def session_pool(hostname=default_hostname, port=default_port,
+                 client_id=default_client_id):
+    # client_id is where the pool's client ids start if they are free; the
+    # allocator moves them out of the way of other pools and processes.
+    return get_session_pool(ibkr_app, hostname, port, client_id,
+                            allocator=default_client_id_allocator())
 
-    def run_loop():
-        app.run()
 
-    api_thread = threading.Thread(target=run_loop, daemon=True)
-    api_thread.start()
-    while isinstance(app.next_valid_id, type(None)):
-        time.sleep(SHORT_SLEEP_SECONDS)
-    app.disconnect()
-    return app.managed_accounts
+def fetch_managed_accounts(hostname=default_hostname, port=default_port,
+                           client_id=default_client_id):
+    with session_pool(hostname, port, client_id).session() as app:
+        return app.managed_accounts
+
+
+def is_no_data_error(e):
+    # An empty range (weekend, outside RTH) is a valid answer, not a failure.
+    return e.errorCode == NO_DATA_ERROR_CODE and 'no data' in e.errorString.lower()
+
+
+def historical_request_keys(contract, endDateTime, durationStr, barSizeSetting,
+                            whatToShow, useRTH):
+    # (identical-request key, same-contract key) for the pacing scheduler
+    contract_key = json.dumps(contract_fields(contract), sort_keys=True)
+    request_key = json.dumps([key_fields(contract, whatToShow, barSizeSetting, useRTH),
+                              endDateTime, durationStr], sort_keys=True)
+    return request_key, contract_key
+
+
+def request_historical_data(contract, endDateTime, durationStr, barSizeSetting,
+                            whatToShow, useRTH, hostname=default_hostname,
+                            port=default_port, client_id=default_client_id,
+                            timeout=DEFAULT_TIMEOUT_SECONDS,
+                            priority=PRIORITY_INTERACTIVE):
+    # One reqHistoricalData round trip through the pacing scheduler, no
+    # caching. An identical request already queued or in flight is shared.
+    pool = session_pool(hostname, port, client_id)
+    scheduler = request_scheduler()
+    tickerId = app = None
+
+    def issue():
+        # A connection is only checked out to send the request, once pacing
+        # lets it go. The answer arrives on the reader thread either way, so
+        # queued and slow requests don't hold connections orders need. The
+        # id is taken after checkout, once the pool has seen nextValidId.
+        nonlocal tickerId, app
+        with pool.session() as app:
+            tickerId = pool.next_request_id()
+            future = app.start_request(tickerId)
+            app.reqHistoricalData(
+                tickerId, contract, endDateTime, durationStr, barSizeSetting,
+                whatToShow, useRTH, formatDate=2, keepUpToDate=False, chartOptions=[])
+        return future
+
+    def abandon():
+        if app.isConnected():
+            app.cancelHistoricalData(tickerId)
+        app.finish_request(tickerId)
+
+    request_key, contract_key = historical_request_keys(
+        contract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH)
+    future = scheduler.submit(issue, request_key, contract_key, priority,
+                              on_abandon=abandon)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        # Callers that joined this request keep waiting on it; the last one
+        # to give up has it cancelled.
+        scheduler.cancel(future)
+        raise TimeoutError(f'Historical data request {"(queued)" if tickerId is None else tickerId} timed out after {timeout}s')
 
 
 def fetch_historical_data(contract, endDateTime='', durationStr='30 D',
                           barSizeSetting='1 hour', whatToShow='MIDPOINT',
                           useRTH=True, hostname=default_hostname,
-                          port=default_port, client_id=default_client_id):
-    app = ibkr_app()
-    app.connect(hostname, port, client_id)
-    while not app.isConnected():
-        time.sleep(SHORT_SLEEP_SECONDS)
-
-    def run_loop():
-        app.run()
-
-    api_thread = threading.Thread(target=run_loop, daemon=True)
-    api_thread.start()
-    while isinstance(app.next_valid_id, type(None)):
-        time.sleep(SHORT_SLEEP_SECONDS)
-    tickerId = app.next_valid_id
-    app.reqHistoricalData(
-        tickerId, contract, endDateTime, durationStr, barSizeSetting,
-        whatToShow, useRTH, formatDate=1, keepUpToDate=False, chartOptions=[])
-    while app.historical_data_end != tickerId:
-        time.sleep(MEDIUM_SLEEP_SECONDS)
-        if not app.isConnected():
-            break
-    app.disconnect()
-    return app.historical_data
+                          port=default_port, client_id=default_client_id,
+                          timeout=DEFAULT_TIMEOUT_SECONDS, use_cache=True,
+                          priority=PRIORITY_INTERACTIVE):
+    store = historical_bar_store() if use_cache else None
+    if store is None:
+        return request_historical_data(
+            contract, endDateTime, durationStr, barSizeSetting, whatToShow,
+            useRTH, hostname, port, client_id, timeout, priority)
+
+    # Serve the window from the on-disk bar store, asking IB only for the
+    # parts of it that haven't been fetched before.
+    fields = key_fields(contract, whatToShow, barSizeSetting, useRTH)
+    key = store.key(fields)
+    with store.lock(key):
+        start, end, gaps = store.gap_requests(key, endDateTime, durationStr, barSizeSetting)
+        for gap in gaps:
+            print(f'Fetching {gap.durationStr} ending {gap.endDateTime or "now"} from IB')
+            try:
+                bars = request_historical_data(
+                    contract, gap.endDateTime, gap.durationStr, barSizeSetting,
+                    whatToShow, useRTH, hostname, port, client_id, timeout, priority)
+            except ibkr_request_error as e:
+                if not is_no_data_error(e):
+                    raise
+                bars = empty_bars()
+            store.write(key, fields, bars, gap)
+        if start is None:
+            start = store.window_start(key, durationStr, end)
+        return store.read(key, start, end)
+
+
+def fetch_historical_data_batch(contracts, endDateTime='', durationStr='30 D',
+                                barSizeSetting='1 hour', whatToShow='MIDPOINT',
+                                useRTH=True, max_in_flight=None, layout='long',
+                                on_result=None, **kwargs):
+    # Blocking wrapper around asyncio_functions.fetch_historical_data_batch
+    # for callers without an event loop (Dash callbacks, scripts).
+    import asyncio
+    from fintech_ibkr import asyncio_functions
+    # asyncio.run makes a new loop, and with it a new connection, every
+    # time, so the connection is closed again before the loop goes.
+    if max_in_flight is None:
+        max_in_flight = asyncio_functions.DEFAULT_MAX_IN_FLIGHT
+
+    async def run_batch():
+        try:
+            return await asyncio_functions.fetch_historical_data_batch(
+                contracts, endDateTime, durationStr, barSizeSetting, whatToShow,
+                useRTH, max_in_flight, layout, on_result, **kwargs)
+        finally:
+            await asyncio_functions.close_async_clients()
+
+    return asyncio.run(run_batch())
+
+
+def contract_details_key(contract):
+    return tuple((getattr(contract, field) or '').upper() for field in
+                 ('symbol', 'secType', 'exchange', 'currency', 'primaryExchange'))
 
 
 def fetch_contract_details(contract, hostname=default_hostname,
-                           port=default_port, client_id=default_client_id):
-    app = ibkr_app()
-    app.connect(hostname, port, client_id)
-    while not app.isConnected():
-        time.sleep(SHORT_SLEEP_SECONDS)
-
-    def run_loop():
-        app.run()
-
-    api_thread = threading.Thread(target=run_loop, daemon=True)
-    api_thread.start()
-    while isinstance(app.next_valid_id, type(None)):
-        time.sleep(SHORT_SLEEP_SECONDS)
-    app.contract_details_reqId = app.next_valid_id
-    app.reqContractDetails(app.contract_details_reqId, contract)
-    while (app.contract_details_end != app.contract_details_reqId) and (app.contract_details_end != DEFAULT_ERROR_CODE):
-        time.sleep(MEDIUM_SLEEP_SECONDS)
-        if not app.isConnected():
-            break
-    app.disconnect()
-    return app.contract_details
-
-
-def save_order(contract, order, app):
+                           port=default_port, client_id=default_client_id,
+                           timeout=DEFAULT_TIMEOUT_SECONDS, use_cache=True,
+                           priority=PRIORITY_INTERACTIVE):
+    # Validations are served from contract_details_cache when possible. A
+    # contract TWS doesn't know is remembered too, but only briefly.
+    key = contract_details_key(contract)
+    if use_cache:
+        cached = contract_details_cache.get(key)
+        if cached is not MISSING:
+            return cached
+
+    # Contract details aren't subject to historical data pacing, but still go
+    # through the scheduler for priority ordering and de-duplication.
+    pool = session_pool(hostname, port, client_id)
+    scheduler = request_scheduler()
+    reqId = app = None
+
+    def issue():
+        # Checked out only to send, as in request_historical_data
+        nonlocal reqId, app
+        with pool.session() as app:
+            reqId = pool.next_request_id()
+            future = app.start_request(reqId)
+            app.reqContractDetails(reqId, contract)
+        return future
+
+    # There is no cancel call for contract details; dropping the request
+    # makes any late answer a no-op.
+    future = scheduler.submit(issue, ('contract_details',) + key, paced=False,
+                              priority=priority,
+                              on_abandon=lambda: app.finish_request(reqId))
+    try:
+        details = future.result(timeout=timeout)
+    except ibkr_request_error as e:
+        print(f'Error from contract details api: errorCode={e.errorCode} errorMessage={e.errorString}')
+        details = []
+    except FutureTimeoutError:
+        scheduler.cancel(future)
+        raise TimeoutError(f'Contract details request {"(queued)" if reqId is None else reqId} timed out after {timeout}s')
+
+    if details:
+        contract_details_cache.set(key, details[-1])
+        return details[-1]
+    contract_details_cache.set(key, None, ttl=CONTRACT_DETAILS_NEGATIVE_TTL_SECONDS)
+    return None
+
+
+def warm_contract_details_cache(watchlist_path=WATCHLIST_PATH, **kwargs):
+    # Pre-load contract_details_cache from a CSV with columns symbol, secType,
+    # exchange, currency and optionally primaryExchange.
+    watchlist = pd.read_csv(watchlist_path, dtype=str).fillna('')
+    for row in watchlist.to_dict('records'):
+        contract = Contract()
+        contract.symbol = row['symbol']
+        contract.secType = row['secType']
+        contract.exchange = row['exchange']
+        contract.currency = row['currency']
+        contract.primaryExchange = row.get('primaryExchange', '')
+        fetch_contract_details(contract, **kwargs)
+    print(f'Warmed contract details cache with {len(watchlist)} contracts')
+
+
+def save_order(contract, order, app, order_id=None, timestamp=None):
+    # order_id / timestamp default to the app's last order, which is only
+    # meaningful when the app isn't shared between concurrent orders.
+    order_id = app.order_reqId if order_id is None else order_id
+    timestamp = app.current_time if timestamp is None else timestamp
     print(f'Saving order...')
-    status = app.order_status[app.order_status['order_id'] == app.order_reqId]
-    client_id = int(status['client_id'].values[0])
-    perm_id = int(status['perm_id'].values[0])
+    state = app.order_states.get(order_id)
+    client_id = int(state.client_id)
+    perm_id = int(state.perm_id)
     lmt_price = f'{order.lmtPrice:.2f}' if order.orderType == 'LMT' else 'N/A'
 
-    data = pd.read_csv(APP_DATA_PATH)
-    data = pd.concat(
-        [data,
-         pd.DataFrame({
-             'timestamp': [app.current_time],
-             'order_id': [app.order_reqId],
-             'client_id': [client_id],
-             'perm_id': [perm_id],
-             'con_id': [0],
-             'symbol': [contract.symbol],
-             'action': [order.action],
-             'size': [order.totalQuantity],
-             'order_type': [order.orderType],
-             'lmt_price': [lmt_price]
-         })
-         ],
-        ignore_index=True
-    )
-    data.to_csv(APP_DATA_PATH, index=False)
+    default_order_journal().append({
+        'timestamp': timestamp,
+        'order_id': order_id,
+        'client_id': client_id,
+        'perm_id': perm_id,
+        'con_id': 0,
+        'symbol': contract.symbol,
+        'action': order.action,
+        'size': order.totalQuantity,
+        'order_type': order.orderType,
+        'lmt_price': lmt_price
+    })
     print(f'Order saved!')
 
 
 def submit_order(contract, order, hostname=default_hostname,
-                 port=default_port, client_id=default_client_id):
-    app = ibkr_app()
-    app.connect(hostname, port, client_id)
-    while not app.isConnected():
-        time.sleep(SHORT_SLEEP_SECONDS)
-
-    def run_loop():
-        app.run()
-
-    api_thread = threading.Thread(target=run_loop, daemon=True)
-    api_thread.start()
-    while isinstance(app.next_valid_id, type(None)):
-        time.sleep(SHORT_SLEEP_SECONDS)
-
-    app.order_reqId = app.next_valid_id
-    app.reqCurrentTime()
-    app.placeOrder(app.order_reqId, contract, order)
-
-    while (app.order_reqId_end != app.order_reqId) and (app.order_reqId_end != DEFAULT_ERROR_CODE):
-        # while not ('Submitted' in set(app.order_status['status'])):
-        time.sleep(MEDIUM_SLEEP_SECONDS)
-        if not app.isConnected():
-            break
-    app.disconnect()
-
-    if app.order_reqId_end == DEFAULT_ERROR_CODE:
-        msg = f'Order {app.order_reqId} did not succeed'
-    else:
-        msg = f'Order {app.order_reqId} successfully submitted'
-
-    save_order(contract, order, app)
+                 port=default_port, client_id=default_client_id,
+                 timeout=DEFAULT_TIMEOUT_SECONDS):
+    pool = session_pool(hostname, port, client_id)
+    with pool.session() as app:
+        app.reset_request_state()
+        app.order_reqId = pool.next_request_id()
+        current_time = app.request_current_time()
+        future = app.start_order(app.order_reqId)
+        app.placeOrder(app.order_reqId, contract, order)
+
+        succeeded = False
+        try:
+            future.result(timeout=timeout)
+            succeeded = True
+        except ibkr_request_error as e:
+            print(f'Error from place order api: errorCode={e.errorCode} errorMessage={e.errorString}')
+        except ConnectionError as e:
+            print(e)
+        except FutureTimeoutError:
+            # Don't leave an order working that we told the user had failed.
+            print(f'No status for order {app.order_reqId} after {timeout}s, cancelling it')
+            if app.isConnected():
+                app.cancelOrder(app.order_reqId)
+        finally:
+            app.finish_request(app.order_reqId)
+
+        if not succeeded:
+            msg = f'Order {app.order_reqId} did not succeed'
+        else:
+            msg = f'Order {app.order_reqId} successfully submitted'
+            try:
+                current_time.result(timeout=CURRENT_TIME_TIMEOUT_SECONDS)
+            except FutureTimeoutError:
+                app.current_time = datetime.now().astimezone().isoformat()
+            save_order(contract, order, app)
 
     print(msg)
     return msg
@@ -1,3 +1,4 @@
+import plotly.colors
 import plotly.graph_objects as go
 import dash
 from dash import dcc, html, callback, dash_table
@@ -5,10 +6,57 @@ from dash.dependencies import Input, Output, State
 from ibapi.contract import Contract
 from ibapi.order import Order
 from fintech_ibkr import *
+import numpy as np
 import pandas as pd
+import uuid
+from fintech_ibkr.order_journal import ORDER_COLUMNS, DEFAULT_PAGE_SIZE
+from fintech_ibkr.bar_store import bar_size_seconds, to_seconds
+from fintech_ibkr.streaming import MIN_STREAM_BAR_SECONDS
+from fintech_ibkr.broker import fetch_contract_details, fetch_historical_data, submit_order, \
+    stream_bars, stop_stream
+from fintech_ibkr.downsampling import downsample_bars
+from fintech_ibkr.indicators import standard_engine
+from fintech_ibkr.caching import ttl_lru_cache, MISSING
+from testapp.callback_cache import memoize_callback
+from testapp.jobs import default_job_pool, report_progress, check_cancelled, \
+    job_cancelled, job_pool_full, FINISHED as JOB_FINISHED
 
-APP_DATA_PATH = f"{os.getenv('TESTAPP_DATA_PATH')}\submitted_orders.csv"
-order_data = pd.read_csv(APP_DATA_PATH)
+ORDER_HISTORY_REFRESH_MILLISECONDS = 15_000
+STREAM_REFRESH_MILLISECONDS = 2_000
+# Completed candles kept on a streaming chart before the oldest are dropped
+STREAM_MAX_CANDLES = 10_000
+# How often a page checks on its background jobs
+JOB_POLL_MILLISECONDS = 500
+# Candles sent to the browser for the visible range; more bars than this are
+# aggregated server side
+CHART_MAX_CANDLES = 2_000
+FULL_RESOLUTION_CACHE_SIZE = 16
+FULL_RESOLUTION_TTL_SECONDS = 30 * 60
+INDICATOR_OPTIONS = [
+    {'label': 'SMA 20', 'value': 'sma_20'},
+    {'label': 'EMA 20', 'value': 'ema_20'},
+    {'label': 'Bollinger 20, 2', 'value': 'bb_20'},
+    {'label': 'VWAP', 'value': 'vwap'},
+    {'label': 'RSI 14', 'value': 'rsi_14'},
+    {'label': 'ATR 14', 'value': 'atr_14'},
+]
+# Share of the chart's height for each indicator (RSI, ATR) that gets a
+# pane of its own under the candles
+INDICATOR_PANE_HEIGHT = 0.2
+INDICATOR_PANE_GAP = 0.03
+INDICATOR_COLORS = plotly.colors.qualitative.Plotly
+
+# Bars behind each drawn chart, keyed by chart-state's bars_id
+full_resolution_bars = ttl_lru_cache(FULL_RESOLUTION_CACHE_SIZE, FULL_RESOLUTION_TTL_SECONDS)
+# Next to them, the chart's indicators: (bars_id, indicator keys) ->
+# (indicator_engine, values for every bar).
+indicator_values = ttl_lru_cache(FULL_RESOLUTION_CACHE_SIZE, FULL_RESOLUTION_TTL_SECONDS)
+# A streaming chart's engine as it was when the chart was drawn, keyed by
+# stream params' indicators_id. Memoized charts hand the same stream params
+# to many sessions, so nothing updates these: each session streams from its
+# own copy, stream_id -> (indicators_id, engine).
+indicator_snapshots = ttl_lru_cache(FULL_RESOLUTION_CACHE_SIZE, FULL_RESOLUTION_TTL_SECONDS)
+stream_indicator_engines = ttl_lru_cache(FULL_RESOLUTION_CACHE_SIZE, FULL_RESOLUTION_TTL_SECONDS)
 
 layout = html.Div([
 
@@ -180,20 +228,48 @@ layout = html.Div([
     ),
     # Submit button
     html.Button('Submit', id='submit-button', n_clicks=0, disabled=False),
+    html.Button('Cancel', id='cancel-button', n_clicks=0),
+    # The running query's background job, and the interval that polls it
+    dcc.Store(id='chart-job'),
+    dcc.Interval(id='chart-job-poll', interval=JOB_POLL_MILLISECONDS, disabled=True),
+    # Keep the chart up to date after it is drawn (only when endDateTime is now)
+    dcc.Checklist(
+        id='stream-choice',
+        options=[{'label': 'Stream live updates', 'value': 'stream'}],
+        value=[],
+        style={'display': 'inline-block'}
+    ),
+    # Indicators drawn over the candles; changing them redraws the chart
+    # without fetching the bars again
+    html.Div(
+        dcc.Dropdown(INDICATOR_OPTIONS, [], multi=True, placeholder='Indicators',
+                     id='indicator-choice'),
+        style={'width': '25%'}
+    ),
     # Divs that only serve as a state holder
     html.Div(id='submit-button-disabled', children=0, style=dict(display='none')),
     html.Div(id='submit-button-enabled', children=0, style=dict(display='none')),
     # Line break
     html.Br(),
     # Div to hold the initial instructions and the updated info once submit is pressed
-    html.Div(id='currency-output', children='Enter a currency code and press submit'),
-    # Div to hold the candlestick graph
-    # Loading spinner for graph
+    # Loading spinner while the chart is fetched. It wraps the message rather
+    # than the graph so that streaming updates to the graph don't set it off.
     dcc.Loading(
         id="loading-1",
         type="default",
-        children=html.Div([dcc.Graph(id='candlestick-graph')]),
+        children=html.Div(id='currency-output', children='Enter a currency code and press submit'),
     ),
+    # Div to hold the candlestick graph
+    html.Div([dcc.Graph(id='candlestick-graph')]),
+    # Streaming: the chart callback writes what to stream in stream-params,
+    # the interval callback appends to the chart through extendData and keeps
+    # this session's stream id and position in stream-cursor.
+    html.Div(id='stream-output'),
+    dcc.Store(id='stream-params'),
+    # What the chart shows, for redrawing it on zoom
+    dcc.Store(id='chart-state'),
+    dcc.Store(id='stream-cursor'),
+    dcc.Interval(id='stream-interval', interval=STREAM_REFRESH_MILLISECONDS, disabled=True),
     # Another line break
     html.H3("Section 2: Place Orders"),
     html.H4("Make a Trade"),
@@ -252,15 +328,33 @@ layout = html.Div([
 
     # Div to confirm what trade was made
     html.Div(id='trade-output'),
+    html.Div(id='trade-progress'),
+    dcc.Store(id='trade-job'),
+    dcc.Interval(id='trade-job-poll', interval=JOB_POLL_MILLISECONDS, disabled=True),
     html.Br(),
     html.H3("Section 3: Display Order History"),
     html.Div(
         children=[
+            # Paging, filtering and sorting all happen in the order journal;
+            # the browser only ever holds the visible page.
             dash_table.DataTable(
-                order_data.to_dict('records'),
-                [{"name": i, "id": i} for i in order_data.columns],
-                id='order-history-tbl'
-            )],
+                [],
+                [{"name": i, "id": i} for i in ORDER_COLUMNS],
+                id='order-history-tbl',
+                page_current=0,
+                page_size=DEFAULT_PAGE_SIZE,
+                page_action='custom',
+                filter_action='custom',
+                filter_query='',
+                sort_action='custom',
+                sort_mode='multi',
+                sort_by=[]
+            ),
+            # Bumped by every trade so the table reloads its current page
+            dcc.Store(id='order-history-version', data=0),
+            # Picks up orders placed from other sessions
+            dcc.Interval(id='order-history-refresh', interval=ORDER_HISTORY_REFRESH_MILLISECONDS)
+        ],
         style={'width': '50%', 'margin': '0 auto'}
     )
 ])
@@ -311,15 +405,18 @@ def trigger_disable_trade_button(n_click):
 
 @callback(
     Output(component_id='submit-button-enabled', component_property='children'),
-    Input('candlestick-graph', 'figure'),
+    Input('chart-job', 'data'),
 )
-def trigger_enable_submit_button(n_click):
-    return 1
+def trigger_enable_submit_button(chart_job):
+    # Re-enable once the query's background job has been collected
+    if chart_job is None:
+        return 1
+    return dash.no_update
 
 
 @callback(
     Output(component_id='trade-button-enabled', component_property='children'),
-    Input('order-history-tbl', 'data'),
+    Input('trade-output', 'children'),
 )
 def trigger_enable_trade_button(n_click):
     return 1
@@ -328,9 +425,20 @@ def trigger_enable_trade_button(n_click):
 @callback(
     [  # there's more than one output here, so you have to use square brackets to pass it in as an array.
         Output(component_id='currency-output', component_property='children'),
-        Output(component_id='candlestick-graph', component_property='figure')
+        Output(component_id='candlestick-graph', component_property='figure'),
+        Output(component_id='stream-params', component_property='data'),
+        Output(component_id='stream-interval', component_property='disabled'),
+        Output(component_id='chart-state', component_property='data'),
+        Output(component_id='chart-job', component_property='data'),
+        Output(component_id='chart-job-poll', component_property='disabled')
     ],
     Input('submit-button', 'n_clicks'),
+    # Zooming or panning the chart re-aggregates the bars for the new range
+    Input('candlestick-graph', 'relayoutData'),
+    # The query itself runs as a background job; these follow it
+    Input('chart-job-poll', 'n_intervals'),
+    Input('cancel-button', 'n_clicks'),
+    Input('indicator-choice', 'value'),
     # The callback function will
     # fire when the submit button's n_clicks changes
     # The currency input's value is passed in as a "State" because if the user is typing and the value changes, then
@@ -340,24 +448,94 @@ def trigger_enable_trade_button(n_click):
      State('edt-date', 'date'), State('edt-hour', 'value'),
      State('edt-minute', 'value'), State('edt-second', 'value'),
      State('duration-value', 'value'), State('duration-category', 'value'),
-     State('bar-size', 'value'), State('rth-choice', 'value')]
+     State('bar-size', 'value'), State('rth-choice', 'value'),
+     State('stream-choice', 'value'), State('chart-state', 'data'),
+     State('stream-cursor', 'data'), State('chart-job', 'data')]
 )
-def update_candlestick_graph(n_clicks, currency_string, what_to_show,
+def update_candlestick_graph(n_clicks, relayout_data, n_intervals, cancel_clicks, indicator_choice,
+                             currency_string, what_to_show,
                              edt_date, edt_hour, edt_minute, edt_second,
-                             duration_value, duration_category, bar_size, rth_choice):
+                             duration_value, duration_category, bar_size, rth_choice,
+                             stream_choice, chart_state, stream_cursor, chart_job):
     # n_clicks doesn't get used, we only include it for the dependency.
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    if triggered == ['candlestick-graph.relayoutData']:
+        return zoom_candlestick_graph(relayout_data, chart_state, stream_cursor) + \
+            (dash.no_update, dash.no_update)
+    if triggered == ['indicator-choice.value']:
+        return change_indicators(indicator_choice, relayout_data, chart_state, stream_cursor) + \
+            (dash.no_update, dash.no_update)
+    if triggered == ['chart-job-poll.n_intervals']:
+        return poll_chart_job(chart_job)
+    if triggered == ['cancel-button.n_clicks']:
+        if chart_job and default_job_pool().cancel(chart_job['job_id']):
+            return 'Cancelling query...', dash.no_update, dash.no_update, dash.no_update, \
+                dash.no_update, dash.no_update, dash.no_update
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update, \
+            dash.no_update, dash.no_update, dash.no_update
+
+    # Submit: hand the IB round trips to the job pool and return right away,
+    # replacing any query this session still has running.
+    if chart_job:
+        default_job_pool().cancel(chart_job['job_id'])
+    try:
+        job_id = default_job_pool().submit(
+            load_candlestick_graph, currency_string, what_to_show,
+            edt_date, edt_hour, edt_minute, edt_second,
+            duration_value, duration_category, bar_size, rth_choice, stream_choice,
+            indicator_choice)
+    except job_pool_full:
+        return 'The server is busy, please try again shortly', dash.no_update, dash.no_update, \
+            dash.no_update, dash.no_update, None, True
+    return 'Fetching ' + currency_string + '...', dash.no_update, dash.no_update, \
+        dash.no_update, dash.no_update, {'job_id': job_id}, False
+
+
+def poll_chart_job(chart_job):
+    if not chart_job:
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update, \
+            dash.no_update, None, True
+    pool = default_job_pool()
+    status = pool.status(chart_job['job_id'])
+    if status is None:
+        return 'Query was lost, please submit it again', dash.no_update, dash.no_update, \
+            dash.no_update, dash.no_update, None, True
+    if status['status'] not in JOB_FINISHED:
+        return f"{status['message']} ({status['progress']:.0%})", dash.no_update, dash.no_update, \
+            dash.no_update, dash.no_update, dash.no_update, dash.no_update
+    try:
+        result = pool.collect(chart_job['job_id'])
+    except job_cancelled:
+        return 'Query cancelled', dash.no_update, dash.no_update, \
+            dash.no_update, dash.no_update, None, True
+    except Exception as e:
+        return f'Query failed: {e}', {}, None, True, None, None, True
+    return result + (None, True)
+
+
+# Pressing Submit again with the same settings reuses the figure.
+@memoize_callback(
+    now=lambda edt_date, edt_hour, edt_minute, edt_second, **_: None in [edt_date, edt_hour, edt_minute, edt_second],
+    should_cache=lambda result: isinstance(result[1], go.Figure)
+)
+def load_candlestick_graph(currency_string, what_to_show,
+                           edt_date, edt_hour, edt_minute, edt_second,
+                           duration_value, duration_category, bar_size, rth_choice,
+                           stream_choice, indicator_choice):
+    # Runs in the job pool. Returns the chart outputs: message, figure,
+    # stream params, stream interval disabled, chart state.
     if any([i is None for i in [edt_date, edt_hour, edt_minute, edt_second]]):
         end_date_time = ''
     else:
         end_date_time = f'{edt_date.replace("-", "")} {edt_hour}:{edt_minute}:{edt_second}'
 
+    # Streaming only makes sense for a window that ends now
+    streaming = ('stream' in (stream_choice or []) and end_date_time == ''
+                 and bar_size_seconds(bar_size) >= MIN_STREAM_BAR_SECONDS)
+
     # First things first -- what currency pair history do you want to fetch?
     # Define it as a contract object!
-    contract = Contract()
-    contract.symbol = currency_string.split(".")[0]
-    contract.secType = 'CASH'
-    contract.exchange = 'IDEALPRO'  # 'IDEALPRO' is the currency exchange.
-    contract.currency = currency_string.split(".")[1]
+    contract = currency_contract(currency_string)
 
     print("Graph Input:"
           f"\n\t contract.symbol: {contract.symbol}"
@@ -369,33 +547,375 @@ def update_candlestick_graph(n_clicks, currency_string, what_to_show,
           f"\n\t rth:  {bool(rth_choice)}"
           )
     print("Checking if contract is valid...")
-    contract_details = fetch_contract_details(contract)
-    if isinstance(contract_details, type(None)):
-        return ('Currency pair ' + currency_string + ' is not valid'), {}
-
-    cph = fetch_historical_data(
-        contract=contract,
-        endDateTime=end_date_time,
-        durationStr=f"{duration_value} {duration_category}",  # <-- make a reactive input
-        barSizeSetting=bar_size,  # <-- make a reactive input
-        whatToShow=what_to_show,
-        useRTH=bool(rth_choice)  # <-- make a reactive input
-    )
-    # # # Make the candlestick figure
-    fig = go.Figure(
-        data=[
-            go.Candlestick(
-                x=cph['date'],
-                open=cph['open'],
-                high=cph['high'],
-                low=cph['low'],
-                close=cph['close']
+    report_progress(0.1, 'Checking ' + currency_string)
+    try:
+        contract_details = fetch_contract_details(contract)
+        if isinstance(contract_details, type(None)):
+            return ('Currency pair ' + currency_string + ' is not valid'), {}, None, True, None
+
+        check_cancelled()
+        report_progress(0.3, 'Fetching history for ' + currency_string)
+        cph = fetch_historical_data(
+            contract=contract,
+            endDateTime=end_date_time,
+            durationStr=f"{duration_value} {duration_category}",  # <-- make a reactive input
+            barSizeSetting=bar_size,  # <-- make a reactive input
+            whatToShow=what_to_show,
+            useRTH=bool(rth_choice)  # <-- make a reactive input
+        )
+    except (TimeoutError, ConnectionError, ibkr_request_error) as e:
+        return f'Query for {currency_string} failed: {e}', {}, None, True, None
+
+    # Keep the full-resolution bars server side; the browser only ever gets
+    # them aggregated for the range it is showing.
+    chart_state = {
+        'bars_id': uuid.uuid4().hex,
+        'currency': currency_string,
+        'what_to_show': what_to_show,
+        'bar_size': bar_size,
+        'rth': bool(rth_choice),
+        'end_date_time': end_date_time,
+        'duration': f"{duration_value} {duration_category}",
+        'streaming': streaming,
+        'indicators': list(indicator_choice or [])
+    }
+    full_resolution_bars.set(chart_state['bars_id'], cph)
+    check_cancelled()
+    report_progress(0.9, 'Drawing chart')
+    return draw_candlestick_graph(cph, chart_state) + (chart_state,)
+
+
+def zoom_candlestick_graph(relayout_data, chart_state, stream_cursor):
+    viewport = relayout_viewport(relayout_data)
+    if viewport is None or not chart_state:
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update
+    return redraw_candlestick_graph(viewport, chart_state, stream_cursor) + (dash.no_update,)
+
+
+def change_indicators(indicator_choice, relayout_data, chart_state, stream_cursor):
+    # Same bars and range, different overlays
+    if not chart_state:
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update
+    chart_state = dict(chart_state, indicators=list(indicator_choice or []))
+    viewport = relayout_viewport(relayout_data) or (None, None)
+    return redraw_candlestick_graph(viewport, chart_state, stream_cursor) + (chart_state,)
+
+
+def redraw_candlestick_graph(viewport, chart_state, stream_cursor):
+    cph = full_resolution_bars.get(chart_state['bars_id'])
+    if cph is MISSING:
+        # Drawn by another worker (or long ago); the bar store still has it
+        try:
+            cph = fetch_historical_data(
+                contract=currency_contract(chart_state['currency']),
+                endDateTime=chart_state['end_date_time'],
+                durationStr=chart_state['duration'],
+                barSizeSetting=chart_state['bar_size'],
+                whatToShow=chart_state['what_to_show'],
+                useRTH=chart_state['rth']
             )
-        ]
+        except (TimeoutError, ConnectionError, ibkr_request_error) as e:
+            return f'Query for {chart_state["currency"]} failed: {e}', \
+                dash.no_update, dash.no_update, dash.no_update
+    if chart_state['streaming'] and stream_cursor:
+        cph = with_live_bars(cph, chart_state, stream_cursor['stream_id'])
+    full_resolution_bars.set(chart_state['bars_id'], cph)
+    return draw_candlestick_graph(cph, chart_state, viewport)
+
+
+def draw_candlestick_graph(cph, chart_state, viewport=(None, None)):
+    # -> (message, figure, stream params, stream interval disabled)
+    currency_string = chart_state['currency']
+    start, end = viewport
+    bars = downsample_bars(cph, CHART_MAX_CANDLES, start, end)
+
+    # Live updates append raw candles, so only stream while the newest bars
+    # are in view and drawn at full resolution.
+    dates = cph['date']
+    in_view = len(dates) if start is None else int((dates >= pd.Timestamp(start)).sum())
+    streaming = (chart_state['streaming'] and len(cph) > 0 and in_view <= CHART_MAX_CANDLES
+                 and (end is None or pd.Timestamp(end) >= dates.iloc[-1]))
+
+    # When streaming, the last (still forming) candle goes in a trace of its
+    # own so updates can replace it while completed candles are appended.
+    completed = bars.iloc[:-1] if streaming else bars
+    # # # Make the candlestick figure
+    fig = go.Figure(data=[candlestick_trace(completed)])
+    # uirevision keeps zoom and other UI state when the figure is redrawn.
+    # x values are epoch milliseconds, so the axis has to be told it's dates.
+    fig.update_layout(title=('Exchange Rate: ' + currency_string),
+                      uirevision=chart_state['bars_id'],
+                      xaxis_type='date')
+    if start is not None or end is not None:
+        fig.update_xaxes(range=[start, end], autorange=False)
+    if len(bars) < len(cph):
+        message = f'Showing {currency_string}: {len(cph)} bars as {len(bars)} candles'
+    else:
+        message = 'Submitted query for ' + currency_string
+    if not streaming:
+        draw_indicators(fig, cph, bars, chart_state, streaming)
+        if chart_state['streaming']:
+            message += '; zoom in on the latest bars to stream live updates'
+        return message, fig, None, True
+
+    forming = cph.iloc[-1:]
+    fig.add_trace(candlestick_trace(forming))
+    fig.update_layout(showlegend=False)
+    engine = draw_indicators(fig, cph, bars, chart_state, streaming)
+    indicators_id = None
+    if engine is not None:
+        indicators_id = uuid.uuid4().hex
+        indicator_snapshots.set(indicators_id, engine)
+    if len(completed):
+        last_time = to_seconds(completed['date'].iloc[-1])
+    else:
+        last_time = to_seconds(forming['date'].iloc[-1]) - 1
+    stream_params = {
+        'currency': currency_string,
+        'what_to_show': chart_state['what_to_show'],
+        'bar_size': chart_state['bar_size'],
+        'rth': chart_state['rth'],
+        'last_time': last_time,
+        'bars_id': chart_state['bars_id'],
+        'indicators': chart_state.get('indicators') or [],
+        'indicators_id': indicators_id,
+        # Candles are traces 0 and 1, indicator lines come after
+        'first_indicator_trace': 2
+    }
+    return ('Streaming ' + currency_string), fig, stream_params, False
+
+
+def epoch_milliseconds(dates):
+    # Bar dates (naive local time) as the numbers a plotly date axis reads
+    # them as. Far shorter on the wire than date strings and, being floats,
+    # sent as a binary typed array by plotly versions that support them.
+    return dates.values.astype('datetime64[ms]').astype(np.int64).astype(np.float64)
+
+
+def candlestick_trace(bars):
+    # Plain numpy columns rather than Series/datetimes: they skip plotly's
+    # per-element conversions and serialize through the fast paths (orjson,
+    # base64 typed arrays) when those are available.
+    return go.Candlestick(
+        x=epoch_milliseconds(bars['date']),
+        open=bars['open'].to_numpy(dtype=np.float64),
+        high=bars['high'].to_numpy(dtype=np.float64),
+        low=bars['low'].to_numpy(dtype=np.float64),
+        close=bars['close'].to_numpy(dtype=np.float64)
     )
-    fig.update_layout(title=('Exchange Rate: ' + currency_string))
 
-    return ('Submitted query for ' + currency_string), fig
+
+def chart_indicators(cph, chart_state):
+    # (engine, values) for the chart's indicators over cph, None without any.
+    # Zooming reuses them; a streaming chart's bars have moved on since, so
+    # they are worked out again (and not cached, see indicator_snapshots).
+    keys = tuple(chart_state.get('indicators') or ())
+    if not keys:
+        return None
+    cache_key = (chart_state['bars_id'], keys)
+    if not chart_state['streaming']:
+        cached = indicator_values.get(cache_key)
+        if cached is not MISSING:
+            return cached
+    engine = standard_engine(keys)
+    values = engine.compute(cph, forming=chart_state['streaming'])
+    if not chart_state['streaming']:
+        indicator_values.set(cache_key, (engine, values))
+    return engine, values
+
+
+def draw_indicators(fig, cph, bars, chart_state, streaming):
+    # Lines for the chart's indicators, one point per candle. Each line is
+    # drawn newest first so that streaming can add to it with prependData
+    # (extendData can't extend candles and lines in one go), and while
+    # streaming the forming bar's segment is a trace of its own, like the
+    # forming candle. Returns the engine, None without indicators.
+    indicators = chart_indicators(cph, chart_state)
+    if indicators is None:
+        return None
+    engine, values = indicators
+    # A candle shows the indicator as of its last bar
+    if len(bars) == len(cph):
+        ends = np.arange(len(cph))
+    else:
+        starts = np.searchsorted(cph['date'].values, bars['date'].values)
+        ends = np.append(starts[1:], len(cph)) - 1
+    x = epoch_milliseconds(bars['date'])
+    panes = [indicator for indicator in engine.indicators if not indicator.on_price_axis]
+    column = 0
+    for indicator in engine.indicators:
+        yaxis = 'y' if indicator.on_price_axis else f'y{panes.index(indicator) + 2}'
+        for name in indicator.columns:
+            y = values[name].to_numpy()[ends]
+            line = {'color': INDICATOR_COLORS[column % len(INDICATOR_COLORS)], 'width': 1}
+            column += 1
+            completed = slice(None, -1) if streaming else slice(None)
+            fig.add_trace(go.Scatter(x=x[completed][::-1], y=y[completed][::-1], mode='lines',
+                                     name=name, line=line, yaxis=yaxis))
+            if streaming:
+                fig.add_trace(go.Scatter(x=x[-2:][::-1], y=y[-2:][::-1], mode='lines',
+                                         name=name, line=line, yaxis=yaxis, showlegend=False))
+    if panes:
+        fig.update_layout(yaxis_domain=[INDICATOR_PANE_HEIGHT * len(panes), 1],
+                          xaxis_anchor='y2')
+        for i, indicator in enumerate(panes):
+            fig.update_layout({f'yaxis{i + 2}': {
+                'domain': [INDICATOR_PANE_HEIGHT * i,
+                           INDICATOR_PANE_HEIGHT * (i + 1) - INDICATOR_PANE_GAP],
+                'title': indicator.columns[0]
+            }})
+    return engine
+
+
+def stream_indicator_engine(stream_params, stream_id):
+    # This session's engine for the chart, copied from the chart's snapshot
+    # when it starts streaming it. None once the snapshot has expired.
+    indicators_id = stream_params.get('indicators_id')
+    cached = stream_indicator_engines.get(stream_id)
+    if cached is MISSING or cached[0] != indicators_id:
+        snapshot = indicator_snapshots.get(indicators_id)
+        if snapshot is MISSING:
+            return None
+        cached = (indicators_id, snapshot.copy())
+    # Keep it for as long as the chart streams
+    stream_indicator_engines.set(stream_id, cached)
+    return cached[1]
+
+
+def indicator_stream_update(stream_params, bars, stream_id):
+    # prependData for the indicator lines (see draw_indicators), carrying on
+    # from the engine the chart was drawn with
+    if not stream_params.get('indicators'):
+        return dash.no_update
+    engine = stream_indicator_engine(stream_params, stream_id)
+    if engine is None:
+        print(f'Indicators for {stream_params["currency"]} expired; redraw the chart to update them')
+        return dash.no_update
+    values = engine.update(bars)
+    x = epoch_milliseconds(bars['date'])
+    update = {'x': [], 'y': []}
+    traces, max_points = [], []
+    trace = stream_params['first_indicator_trace']
+    for i, name in enumerate(engine.columns):
+        y = values[:, i]
+        if len(bars) > 1:
+            update['x'].append(x[-2::-1].tolist())
+            update['y'].append(y[-2::-1].tolist())
+            traces.append(trace)
+            max_points.append(STREAM_MAX_CANDLES)
+        # The forming segment: from the last completed bar to the forming one
+        segment_x, segment_y = [x[-1]], [y[-1]]
+        if engine.last_date is not None:
+            segment_x.append(engine.last_date.value / 1e6)
+            segment_y.append(float(engine.last_values[i]))
+        update['x'].append(segment_x)
+        update['y'].append([float(value) for value in segment_y])
+        traces.append(trace + 1)
+        max_points.append(2)
+        trace += 2
+    return [update, traces, {key: max_points for key in update}]
+
+
+def relayout_viewport(relayout_data):
+    # (start, end) of the x range the user zoomed or panned to, (None, None)
+    # when they reset it, None if relayoutData isn't about the x axis.
+    if not relayout_data:
+        return None
+    if relayout_data.get('xaxis.autorange'):
+        return None, None
+    if 'xaxis.range[0]' in relayout_data:
+        return relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']
+    if 'xaxis.range' in relayout_data:
+        return tuple(relayout_data['xaxis.range'])
+    return None
+
+
+def with_live_bars(cph, chart_state, stream_id):
+    # The cached bars plus whatever the live subscription has added since
+    try:
+        live = stream_bars(
+            stream_id, currency_contract(chart_state['currency']),
+            chart_state['bar_size'], chart_state['what_to_show'], chart_state['rth'])
+    except (TimeoutError, ConnectionError, ibkr_request_error, ValueError) as e:
+        print(f'Could not add live bars for {chart_state["currency"]}: {e}')
+        return cph
+    if live.empty:
+        return cph
+    return pd.concat([cph[cph['date'] < live['date'].iloc[0]], live], ignore_index=True)
+
+
+@callback(
+    [
+        Output('candlestick-graph', 'extendData'),
+        Output('candlestick-graph', 'prependData'),
+        Output('stream-cursor', 'data'),
+        Output('stream-output', 'children')
+    ],
+    Input('stream-interval', 'n_intervals'),
+    Input('stream-params', 'data'),
+    State('stream-cursor', 'data'),
+    prevent_initial_call=True
+)
+def stream_candlestick_graph(n_intervals, stream_params, stream_cursor):
+    # Send the browser only the candles that completed since the last tick
+    # (appended to trace 0) and the forming candle (replaces trace 1), and
+    # the same for any indicator lines through prependData.
+    # The cursor holds this browser session's stream id, which the
+    # subscription broker counts as a viewer, and the last candle drawn.
+    stream_id = stream_cursor['stream_id'] if stream_cursor else uuid.uuid4().hex
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    if 'stream-params.data' in triggered:
+        # The chart was redrawn; its indicators start again from its snapshot
+        stream_indicator_engines.pop(stream_id)
+        if not stream_params:
+            stop_stream(stream_id)
+            return dash.no_update, dash.no_update, {'stream_id': stream_id}, ''
+        return dash.no_update, dash.no_update, \
+            {'stream_id': stream_id, 'last_time': stream_params['last_time']}, ''
+    if not stream_params or not stream_cursor or stream_cursor.get('failed'):
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update
+    last_time = stream_cursor['last_time']
+
+    try:
+        bars = stream_bars(
+            stream_id, currency_contract(stream_params['currency']),
+            stream_params['bar_size'], stream_params['what_to_show'], stream_params['rth'],
+            after=last_time)
+    except (TimeoutError, ConnectionError, ibkr_request_error, ValueError) as e:
+        print(f'Streaming {stream_params["currency"]} failed: {e}')
+        return (dash.no_update, dash.no_update,
+                {'stream_id': stream_id, 'last_time': last_time, 'failed': True},
+                f'Streaming {stream_params["currency"]} stopped: {e}')
+
+    if bars.empty:
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update
+    dates = pd.Series(epoch_milliseconds(bars['date']), index=bars.index)
+    columns = {'x': dates, 'open': bars['open'], 'high': bars['high'],
+               'low': bars['low'], 'close': bars['close']}
+    update = {key: [] for key in columns}
+    traces, max_points = [], []
+    if len(bars) > 1:
+        for key, values in columns.items():
+            update[key].append(values.iloc[:-1].tolist())
+        traces.append(0)
+        max_points.append(STREAM_MAX_CANDLES)
+        last_time = to_seconds(bars['date'].iloc[-2])
+    for key, values in columns.items():
+        update[key].append(values.iloc[-1:].tolist())
+    traces.append(1)
+    max_points.append(1)
+    return ([update, traces, {key: max_points for key in columns}],
+            indicator_stream_update(stream_params, bars, stream_id),
+            {'stream_id': stream_id, 'last_time': last_time}, dash.no_update)
+
+
+def currency_contract(currency_string):
+    contract = Contract()
+    contract.symbol = currency_string.split(".")[0]
+    contract.secType = 'CASH'
+    contract.exchange = 'IDEALPRO'  # 'IDEALPRO' is the currency exchange.
+    contract.currency = currency_string.split(".")[1]
+    return contract
 
 
 @callback(
@@ -413,22 +933,57 @@ def display_limit_price(order_type):
 @callback(
     [
         Output(component_id='trade-output', component_property='children'),
-        Output(component_id='order-history-tbl', component_property='data')
+        Output(component_id='order-history-version', component_property='data'),
+        Output(component_id='trade-progress', component_property='children'),
+        Output(component_id='trade-job', component_property='data'),
+        Output(component_id='trade-job-poll', component_property='disabled')
     ],
     # We only want to run this callback function when the trade-button is pressed
+    # (and to follow the background job placing the order)
     Input('trade-button', 'n_clicks'),
+    Input('trade-job-poll', 'n_intervals'),
     # We DON'T want to run this function whenever buy-or-sell, trade-currency, or trade-amt is updated, so we pass those
     #   in as States, not Inputs:
     [State('security-type', 'value'), State('buy-or-sell', 'value'), State('security-symbol', 'value'),
      State('trade-amt', 'value'), State('currency', 'value'),
      State('market-or-limit', 'value'), State('limit-price', 'value'),
-     State('order-history-tbl', 'data')
+     State('order-history-version', 'data'), State('trade-job', 'data')
      ],
     # We DON'T want to start executing trades just because n_clicks was initialized to 0!!!
     prevent_initial_call=True
 )
-def trade(n_clicks, sec_type, action, security_symbol, trade_amt, currency, order_type, limit_price,
-          order_history_data):
+def trade(n_clicks, n_intervals, sec_type, action, security_symbol, trade_amt, currency, order_type,
+          limit_price, order_history_version, trade_job):
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    pool = default_job_pool()
+    if triggered == ['trade-job-poll.n_intervals']:
+        # trade-output is only written once the job is over, which is what
+        # re-enables the trade button.
+        if not trade_job:
+            return dash.no_update, dash.no_update, '', None, True
+        status = pool.status(trade_job['job_id'])
+        if status is None:
+            return 'Lost track of the order, check the order history', order_history_version + 1, '', None, True
+        if status['status'] not in JOB_FINISHED:
+            return dash.no_update, dash.no_update, status['message'], dash.no_update, dash.no_update
+        try:
+            msg, placed = pool.collect(trade_job['job_id'])
+        except job_cancelled:
+            return 'Order cancelled before it was sent', order_history_version, '', None, True
+        except Exception as e:
+            return f'Order for {security_symbol} failed: {e}', order_history_version + 1, '', None, True
+        return msg, order_history_version + placed, '', None, True
+
+    try:
+        job_id = pool.submit(place_trade, sec_type, action, security_symbol, trade_amt,
+                             currency, order_type, limit_price)
+    except job_pool_full:
+        return 'The server is busy, please try again shortly', order_history_version, '', None, True
+    return dash.no_update, dash.no_update, 'Placing order...', {'job_id': job_id}, False
+
+
+def place_trade(sec_type, action, security_symbol, trade_amt, currency, order_type, limit_price):
+    # Runs in the job pool. Returns (message, whether an order was sent).
     contract = Contract()
 
     if sec_type == 'STK':
@@ -460,9 +1015,13 @@ def trade(n_clicks, sec_type, action, security_symbol, trade_amt, currency, orde
           )
 
     print("Checking if contract is valid...")
-    contract_details = fetch_contract_details(contract)
+    report_progress(0.2, 'Checking ' + security_symbol)
+    try:
+        contract_details = fetch_contract_details(contract)
+    except (TimeoutError, ConnectionError) as e:
+        return f'Could not validate contract for {security_symbol}: {e}', False
     if isinstance(contract_details, type(None)):
-        return ('Contract for ' + security_symbol + ' is not valid'), order_history_data
+        return ('Contract for ' + security_symbol + ' is not valid'), False
 
     order = Order()
     order.action = action
@@ -476,7 +1035,30 @@ def trade(n_clicks, sec_type, action, security_symbol, trade_amt, currency, orde
             order.cashQty = trade_amt
             order.totalQuantity = ''
 
-    msg = submit_order(contract, order)
+    # Last point at which cancelling is safe: the order hasn't been sent
+    check_cancelled()
+    report_progress(0.5, 'Sending order for ' + security_symbol)
+    try:
+        msg = submit_order(contract, order)
+    except (TimeoutError, ConnectionError) as e:
+        return f'Order for {security_symbol} was not sent: {e}', False
+
+    return msg, True
 
-    order_history_data = pd.read_csv(APP_DATA_PATH)
-    return msg, order_history_data.to_dict('records')
+
+@callback(
+    [
+        Output('order-history-tbl', 'data'),
+        Output('order-history-tbl', 'page_count')
+    ],
+    Input('order-history-tbl', 'page_current'),
+    Input('order-history-tbl', 'page_size'),
+    Input('order-history-tbl', 'sort_by'),
+    Input('order-history-tbl', 'filter_query'),
+    Input('order-history-version', 'data'),
+    Input('order-history-refresh', 'n_intervals')
+)
+def update_order_history_table(page_current, page_size, sort_by, filter_query,
+                               order_history_version, n_intervals):
+    page, total = default_order_journal().query(page_current, page_size, filter_query, sort_by)
+    return page.to_dict('records'), max(1, -(-total // page_size))
@@ -4,17 +4,20 @@ from dash import callback
 from dash.dependencies import Input, Output
 from testapp import *
 
-layout = html.Div([
-    html.H1('You Passed'),
-    github_info_header(),
-    html.Div([
-        "Input: ",
-        dcc.Input(id='ticker-input', value='Enter stock ticker', type='text')
-    ]),
-    html.Br(),
-    html.Div(id='ticker-output'),
-    html.Img(src="assets/charging_bull.jpg")
-])
+
+def layout():
+    # Built on first visit, see app.page_layout
+    return html.Div([
+        html.H1('You Passed'),
+        github_info_header(),
+        html.Div([
+            "Input: ",
+            dcc.Input(id='ticker-input', value='Enter stock ticker', type='text')
+        ]),
+        html.Br(),
+        html.Div(id='ticker-output'),
+        html.Img(src="assets/charging_bull.jpg")
+    ])
 
 
 @callback(
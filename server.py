@@ -1,5 +1,113 @@
 # Serve app on a local port via waitress
-from waitress import serve
-import app
+#
+#   python server.py                 one waitress process on port 3000
+#   python server.py --workers 4     an IB broker process plus 4 waitress
+#                                    workers on ports 3000-3003, behind the
+#                                    nginx upstream in nginx/nginx.conf
+import argparse
+import os
+import threading
+import time
+from multiprocessing import Process
 
-serve(app.server, host='localhost', port=3000)
+DEFAULT_PORT = 3000
+SUPERVISE_SECONDS = 1
+BROKER_START_TIMEOUT_SECONDS = 30
+
+
+def warm_caches():
+    from fintech_ibkr import WATCHLIST_PATH, warm_contract_details_cache
+    # Optional: pre-load contract details for everything in the watchlist so
+    # the first chart / trade doesn't pay for the lookup.
+    if not os.path.isfile(WATCHLIST_PATH):
+        return
+    try:
+        warm_contract_details_cache(WATCHLIST_PATH)
+    except Exception as e:
+        print(f'Could not warm contract details cache: {e}')
+
+
+def serve_worker(port):
+    from waitress import serve
+    import app
+    # Start accepting connections straight away and import the pages in the
+    # meantime; a request that arrives first waits for them.
+    threading.Thread(target=app.load_pages, daemon=True).start()
+    serve(app.server, host='localhost', port=port)
+
+
+def run_broker(address, authkey):
+    from fintech_ibkr.broker import serve_broker
+    serve_broker(address, authkey, warm=warm_caches)
+
+
+def wait_for_broker(broker, address, authkey):
+    from fintech_ibkr.broker import broker_client_manager
+    deadline = time.monotonic() + BROKER_START_TIMEOUT_SECONDS
+    while True:
+        try:
+            manager = broker_client_manager(address=address, authkey=authkey.encode())
+            manager.connect()
+            return manager.ibkr().ping()
+        except (OSError, EOFError):
+            if not broker.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError('IB broker process did not start')
+            time.sleep(0.2)
+
+
+def serve_workers(workers, port):
+    # Workers find the broker through the environment they inherit. Jobs,
+    # streams' viewers and zoom caches live in the worker that started them,
+    # so nginx has to keep each browser on one worker (ip_hash).
+    from fintech_ibkr.broker import BROKER_ADDRESS_ENV, BROKER_AUTHKEY_ENV, \
+        default_broker_address, new_broker_authkey
+    address = os.getenv(BROKER_ADDRESS_ENV) or default_broker_address()
+    authkey = os.getenv(BROKER_AUTHKEY_ENV) or new_broker_authkey()
+    os.environ[BROKER_ADDRESS_ENV] = address
+    os.environ[BROKER_AUTHKEY_ENV] = authkey
+
+    def start_broker():
+        broker = Process(target=run_broker, args=(address, authkey), name='ibkr-broker')
+        broker.start()
+        wait_for_broker(broker, address, authkey)
+        return broker
+
+    def start_worker(i):
+        worker = Process(target=serve_worker, args=(port + i,), name=f'web-{port + i}')
+        worker.start()
+        print(f'Web worker {worker.pid} serving on port {port + i}')
+        return worker
+
+    broker = start_broker()
+    processes = [start_worker(i) for i in range(workers)]
+    try:
+        # Restart whatever dies
+        while True:
+            time.sleep(SUPERVISE_SECONDS)
+            if not broker.is_alive():
+                print(f'IB broker exited with {broker.exitcode}, restarting')
+                broker = start_broker()
+            for i, worker in enumerate(processes):
+                if not worker.is_alive():
+                    print(f'Web worker on port {port + i} exited with {worker.exitcode}, restarting')
+                    processes[i] = start_worker(i)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes + [broker]:
+            process.terminate()
+        for process in processes + [broker]:
+            process.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the app with waitress')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='web worker processes; more than 1 adds an IB broker process')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port of the first worker')
+    args = parser.parse_args()
+    if args.workers > 1:
+        serve_workers(args.workers, args.port)
+    else:
+        threading.Thread(target=warm_caches, daemon=True).start()
+        serve_worker(args.port)
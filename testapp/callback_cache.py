@@ -0,0 +1,172 @@
+# Memoization for Dash callbacks.
+#
+#   @callback(Output(...), Input('submit-button', 'n_clicks'), State(...), ...)
+#   @memoize_callback(ignore=('n_clicks',), now=lambda edt_date, **_: edt_date is None)
+#   def update_graph(n_clicks, ...):
+#
+# A callback that hands its work to the job pool returns before there is a
+# result worth keeping, so decorate the function the job runs instead, as
+# pages/hw3_1_page.py does with load_candlestick_graph.
+#
+# Results are keyed on the callback's argument values (its inputs and states)
+# and kept in a bounded in-process TTL cache, backed by an optional SQLite
+# file that every waitress / worker process on the machine shares. Calls about
+# "now" can't be keyed on their arguments alone, so they are keyed on a coarse
+# time bucket as well and expire with it.
+import functools
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from fintech_ibkr.caching import ttl_lru_cache, MISSING
+
+DEFAULT_CACHE_SIZE = 128
+DEFAULT_TTL_SECONDS = 10 * 60
+NOW_BUCKET_SECONDS = 60
+DISK_CACHE_SIZE = 1024
+DISK_CACHE_PATH = os.path.join(os.getenv('TESTAPP_DATA_PATH') or '', 'callback_cache.sqlite3')
+BUSY_TIMEOUT_MILLISECONDS = 10_000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS callback_cache (
+    key TEXT PRIMARY KEY,
+    expires REAL,
+    value BLOB
+);
+CREATE INDEX IF NOT EXISTS callback_cache_expires ON callback_cache (expires);
+"""
+
+
+class disk_cache:
+    # TTL cache in a SQLite file, safe to share between processes. Values are
+    # pickled, so only share it between processes running the same code.
+    def __init__(self, path=DISK_CACHE_PATH, maxsize=DISK_CACHE_SIZE, timer=time.time):
+        self.path = path
+        self.maxsize = maxsize
+        self.timer = timer
+        self._local = threading.local()
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_MILLISECONDS / 1000)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, default=MISSING):
+        row = self.connection().execute(
+            'SELECT value FROM callback_cache WHERE key = ? AND expires > ?',
+            (key, self.timer())).fetchone()
+        return default if row is None else pickle.loads(row[0])
+
+    def set(self, key, value, ttl):
+        now = self.timer()
+        with self.connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO callback_cache (key, expires, value) VALUES (?, ?, ?)',
+                         (key, now + ttl, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+            conn.execute('DELETE FROM callback_cache WHERE expires <= ?', (now,))
+            # Over size: drop whatever expires soonest
+            conn.execute('DELETE FROM callback_cache WHERE key IN ('
+                         'SELECT key FROM callback_cache ORDER BY expires DESC LIMIT -1 OFFSET ?)',
+                         (self.maxsize,))
+
+    def clear(self):
+        with self.connection() as conn:
+            conn.execute('DELETE FROM callback_cache')
+
+
+_default_disk_cache = None
+_default_disk_cache_lock = threading.Lock()
+
+
+def default_disk_cache():
+    # None when there is no data directory to put it in
+    global _default_disk_cache
+    if not os.getenv('TESTAPP_DATA_PATH'):
+        return None
+    with _default_disk_cache_lock:
+        if _default_disk_cache is None:
+            _default_disk_cache = disk_cache()
+        return _default_disk_cache
+
+
+def memoize_callback(ttl=DEFAULT_TTL_SECONDS, maxsize=DEFAULT_CACHE_SIZE, ignore=(),
+                     now=None, now_bucket_seconds=NOW_BUCKET_SECONDS, bypass=None,
+                     should_cache=None, shared=True):
+    # ignore: argument names left out of the key (e.g. n_clicks, which changes
+    #   on every press without changing the answer)
+    # now(**arguments) -> True if the call is relative to the current time
+    # bypass(**arguments) -> True to call straight through, uncached
+    # should_cache(result) -> False for results not worth keeping (errors)
+    # shared: also use the on-disk cache shared between processes
+    def decorator(function):
+        signature = inspect.signature(function)
+        memory = ttl_lru_cache(maxsize, ttl)
+        counters = {'hits': 0, 'disk_hits': 0, 'misses': 0}
+        # Calls come from Dash's and the job pool's threads at once
+        counters_lock = threading.Lock()
+
+        def count(counter):
+            with counters_lock:
+                counters[counter] += 1
+
+        def cache_key(arguments):
+            values = {name: value for name, value in arguments.items() if name not in ignore}
+            expires = ttl
+            if now is not None and now(**arguments):
+                bucket, elapsed = divmod(time.time(), now_bucket_seconds)
+                values['__now__'] = int(bucket)
+                # Don't outlive the bucket
+                expires = min(ttl, now_bucket_seconds - elapsed)
+            text = json.dumps([function.__module__, function.__qualname__, values],
+                              sort_keys=True, default=repr)
+            return hashlib.sha1(text.encode()).hexdigest(), expires
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs).arguments
+            if bypass is not None and bypass(**arguments):
+                return function(*args, **kwargs)
+            key, expires = cache_key(arguments)
+            result = memory.get(key)
+            if result is not MISSING:
+                count('hits')
+                return result
+            disk = default_disk_cache() if shared else None
+            if disk is not None:
+                result = disk.get(key)
+                if result is not MISSING:
+                    count('disk_hits')
+                    memory.set(key, result, expires)
+                    return result
+            count('misses')
+            result = function(*args, **kwargs)
+            if should_cache is None or should_cache(result):
+                memory.set(key, result, expires)
+                if disk is not None:
+                    disk.set(key, result, expires)
+            return result
+
+        def cache_stats():
+            with counters_lock:
+                return dict(counters, size=len(memory), maxsize=maxsize)
+
+        def cache_clear():
+            memory.clear()
+            with counters_lock:
+                for counter in counters:
+                    counters[counter] = 0
+
+        wrapper.cache_stats = cache_stats
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorator
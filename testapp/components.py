@@ -1,20 +1,35 @@
-from git import Repo
+import functools
 from datetime import datetime
 from os import getcwd
 from dash import html
 
-def github_info_header():
+
+@functools.lru_cache(maxsize=1)
+def git_info():
+    # Read once per process; GitPython is only imported here because it is
+    # slow to import and only the main page needs it.
+    from git import Repo
     repo = Repo(search_parent_directories=True)
+    commit = repo.head.commit
+    return {
+        'ref': repo.head.ref.path,
+        'hexsha': repo.head.object.hexsha,
+        'message': commit.message,
+        'author': commit.author.name,
+        'committed': datetime.fromtimestamp(commit.committed_date).strftime(
+            "%A, %d %b %Y at %H:%M:%S"
+        ),
+    }
+
+
+def github_info_header():
+    info = git_info()
 
     return html.Div([
         html.P("Current working directory: {0}".format(getcwd())),
-        html.P(repo.head.ref.path),
-        html.P(repo.head.object.hexsha),
-        html.P(repo.head.commit.message),
-        html.P(repo.head.commit.author.name),
-        html.P(
-            datetime.fromtimestamp(repo.head.commit.committed_date).strftime(
-                "%A, %d %b %Y at %H:%M:%S"
-            )
-        )
+        html.P(info['ref']),
+        html.P(info['hexsha']),
+        html.P(info['message']),
+        html.P(info['author']),
+        html.P(info['committed'])
     ])
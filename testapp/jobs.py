@@ -0,0 +1,198 @@
+# Background jobs for slow callbacks.
+#
+# A callback submits the slow part (IB round trips) to a bounded worker pool
+# and returns straight away with the job id; a dcc.Interval then polls the job
+# for progress and, eventually, its result. Waitress threads are only ever
+# busy for as long as a submit or a poll takes, so a few slow history pulls
+# can no longer starve every other page.
+#
+# Jobs report progress and honour cancellation cooperatively:
+#
+#   def slow(...):
+#       report_progress(0.5, 'Fetching history')
+#       check_cancelled()
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+
+DEFAULT_JOB_WORKERS = 4
+DEFAULT_MAX_QUEUED_JOBS = 64
+# Finished jobs nobody collected are forgotten after this long
+JOB_RESULT_TTL_SECONDS = 10 * 60
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class job_cancelled(Exception):
+    pass
+
+
+class job_pool_full(Exception):
+    pass
+
+
+class job:
+    __slots__ = ('id', 'name', 'status', 'progress', 'message', 'result',
+                 'error', 'created', 'finished', 'future', 'cancel_requested')
+
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.status = QUEUED
+        self.progress = 0.0
+        self.message = 'Queued'
+        self.result = None
+        self.error = None
+        self.created = time.monotonic()
+        self.finished = None
+        self.future = None
+        self.cancel_requested = False
+
+    def snapshot(self):
+        return {'id': self.id, 'name': self.name, 'status': self.status,
+                'progress': self.progress, 'message': self.message}
+
+
+_current = threading.local()
+
+
+def current_job():
+    return getattr(_current, 'job', None)
+
+
+def report_progress(progress, message=None):
+    # No-op outside a job, so job functions can also be called directly
+    running = current_job()
+    if running is not None:
+        running.progress = progress
+        if message is not None:
+            running.message = message
+
+
+def check_cancelled():
+    running = current_job()
+    if running is not None and running.cancel_requested:
+        raise job_cancelled(f'Job {running.id} was cancelled')
+
+
+class job_pool:
+    def __init__(self, max_workers=DEFAULT_JOB_WORKERS, max_queued=DEFAULT_MAX_QUEUED_JOBS,
+                 result_ttl=JOB_RESULT_TTL_SECONDS):
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='testapp-job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.rejected = 0
+
+    def submit(self, function, *args, name=None, **kwargs):
+        # Returns the job id. Raises job_pool_full rather than queueing
+        # without bound when IB is slow and users keep pressing buttons.
+        self._reap()
+        with self._lock:
+            queued = sum(1 for j in self._jobs.values() if j.status == QUEUED)
+            if queued >= self.max_queued:
+                self.rejected += 1
+                raise job_pool_full(f'{queued} jobs already queued')
+            new_job = job(name or function.__name__)
+            self._jobs[new_job.id] = new_job
+            self.submitted += 1
+        new_job.future = self._executor.submit(self._run, new_job, function, args, kwargs)
+        return new_job.id
+
+    def status(self, job_id):
+        # The job's snapshot, or None if it is unknown (never existed,
+        # collected, expired, or submitted to another process)
+        with self._lock:
+            found = self._jobs.get(job_id)
+        return None if found is None else found.snapshot()
+
+    def collect(self, job_id):
+        # Result of a finished job, which is then forgotten. Re-raises the
+        # job's exception, job_cancelled if it was cancelled.
+        with self._lock:
+            found = self._jobs.get(job_id)
+            if found is None or found.status not in FINISHED:
+                raise KeyError(job_id)
+            del self._jobs[job_id]
+        if found.status == CANCELLED:
+            raise job_cancelled(f'Job {job_id} was cancelled')
+        if found.status == FAILED:
+            raise found.error
+        return found.result
+
+    def cancel(self, job_id):
+        # A queued job never runs; a running one stops at its next
+        # check_cancelled(). Returns False if the job is unknown or finished.
+        with self._lock:
+            found = self._jobs.get(job_id)
+        if found is None or found.status in FINISHED:
+            return False
+        found.cancel_requested = True
+        if found.future is not None and found.future.cancel():
+            self._finish(found, CANCELLED, 'Cancelled')
+        return True
+
+    def metrics(self):
+        with self._lock:
+            by_status = {}
+            for j in self._jobs.values():
+                by_status[j.status] = by_status.get(j.status, 0) + 1
+        return {'jobs_by_status': by_status, 'submitted': self.submitted,
+                'rejected': self.rejected}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, running, function, args, kwargs):
+        if running.cancel_requested:
+            self._finish(running, CANCELLED, 'Cancelled')
+            return
+        running.status = RUNNING
+        running.message = 'Running'
+        _current.job = running
+        try:
+            running.result = function(*args, **kwargs)
+        except (job_cancelled, CancelledError):
+            self._finish(running, CANCELLED, 'Cancelled')
+        except Exception as e:
+            print(f'Job {running.name} {running.id} failed: {e}')
+            running.error = e
+            self._finish(running, FAILED, str(e))
+        else:
+            running.progress = 1.0
+            self._finish(running, DONE, 'Done')
+        finally:
+            _current.job = None
+
+    def _finish(self, running, status, message):
+        running.status = status
+        running.message = message
+        running.finished = time.monotonic()
+
+    def _reap(self):
+        cutoff = time.monotonic() - self.result_ttl
+        with self._lock:
+            expired = [job_id for job_id, j in self._jobs.items()
+                       if j.finished is not None and j.finished < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def default_job_pool():
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = job_pool()
+        return _default_pool
@@ -0,0 +1,216 @@
+# WSGI middleware for app.server: compression and browser caching.
+#
+#   server.wsgi_app = caching_middleware(server.wsgi_app)
+#
+# Responses big enough to be worth it are compressed with brotli (when the
+# brotli package is installed) or gzip, whichever the browser accepts.
+# Static files - Dash's JS bundles, /assets - are compressed once per
+# version at the highest level and kept; dynamic responses (callback JSON)
+# are compressed at a fast level on every request.
+#
+# Every GET gets an ETag from a hash of its content, so a browser that
+# already has it gets an empty 304. Fingerprinted files (Dash's
+# name.v2_1_0m1646.min.js bundles, or URLs carrying ?v= / ?m=) never change
+# under the same URL and are marked immutable for a year; everything else
+# is revalidated with the ETag.
+import gzip
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from urllib.parse import parse_qs
+from wsgiref.headers import Headers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Smaller responses fit in a packet or two anyway
+MIN_COMPRESS_BYTES = 1024
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript',
+                      'application/x-javascript', 'image/svg+xml')
+# (gzip level, brotli quality) for responses compressed once and kept, and
+# for ones compressed on every request
+STATIC_LEVELS = (9, 11)
+DYNAMIC_LEVELS = (6, 4)
+STATIC_PREFIXES = ('/_dash-component-suites/', '/assets/')
+# Compressed static files kept per process
+MAX_STATIC_VARIANTS = 256
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+# Dash's fingerprint: .v<version, with _ for .>m<modified time>. in the name
+FINGERPRINT = re.compile(r'\.v[\w-]+m[0-9a-f]+\.')
+CACHE_BUSTING_PARAMETERS = ('v', 'm')
+
+
+def accepted_encodings(accept_encoding):
+    # Accept-Encoding -> {coding: q}, e.g. 'gzip, br;q=0.5' -> {'gzip': 1.0, 'br': 0.5}
+    accepted = {}
+    for part in accept_encoding.split(','):
+        coding, _, parameters = part.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        parameters = parameters.strip()
+        if parameters.startswith('q='):
+            try:
+                q = float(parameters[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def negotiate_encoding(accept_encoding):
+    # 'br', 'gzip' or None for identity
+    accepted = accepted_encodings(accept_encoding or '')
+    available = ('br', 'gzip') if brotli is not None else ('gzip',)
+    choices = [(accepted.get(coding, accepted.get('*', 0.0)), coding) for coding in available]
+    # Highest q wins, brotli breaking ties
+    q, coding = max(choices, key=lambda choice: choice[0])
+    return coding if q > 0 else None
+
+
+def compress(body, encoding, levels):
+    gzip_level, brotli_quality = levels
+    if encoding == 'br':
+        return brotli.compress(body, quality=brotli_quality)
+    # mtime=0 so the same body always compresses to the same bytes
+    return gzip.compress(body, compresslevel=gzip_level, mtime=0)
+
+
+def is_compressible(content_type):
+    return content_type is not None and content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def is_fingerprinted(environ):
+    if FINGERPRINT.search(environ.get('PATH_INFO', '')):
+        return True
+    query = parse_qs(environ.get('QUERY_STRING', ''))
+    return any(parameter in query for parameter in CACHE_BUSTING_PARAMETERS)
+
+
+def content_etag(body):
+    return '"%s"' % hashlib.sha1(body).hexdigest()[:20]
+
+
+def encoded_etag(etag, encoding):
+    # A compressed body is a different representation, so it gets its own
+    # (still strong) ETag: "abc" -> "abc-gzip"
+    if etag.endswith('"'):
+        return f'{etag[:-1]}-{encoding}"'
+    return f'{etag}-{encoding}'
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+def add_vary(headers, field):
+    vary = headers.get('Vary')
+    if vary is None:
+        headers['Vary'] = field
+    elif field.lower() not in [v.strip().lower() for v in vary.split(',')]:
+        headers['Vary'] = f'{vary}, {field}'
+
+
+class caching_middleware:
+    def __init__(self, app, min_size=MIN_COMPRESS_BYTES, max_static_variants=MAX_STATIC_VARIANTS):
+        self.app = app
+        self.min_size = min_size
+        self.max_static_variants = max_static_variants
+        # (ETag, encoding) -> compressed body of a static file, least
+        # recently used first. Not fintech_ibkr.caching, which would pull
+        # pandas and ibapi into the app's import.
+        self._static_variants = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        captured = []
+        chunks = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return chunks.append
+
+        result = self.app(environ, capture)
+        try:
+            chunks.extend(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        status, headers, exc_info = captured
+        body = b''.join(chunks)
+        status, headers, body = self.process(environ, status, Headers(list(headers)), body)
+        start_response(status, headers.items(), exc_info)
+        return [body]
+
+    def process(self, environ, status, headers, body):
+        method = environ.get('REQUEST_METHOD', 'GET')
+        if not status.startswith('200') or method not in ('GET', 'HEAD', 'POST'):
+            return status, headers, body
+        cacheable = method in ('GET', 'HEAD')
+        path = environ.get('PATH_INFO', '')
+        static = cacheable and path.startswith(STATIC_PREFIXES)
+
+        if cacheable:
+            # Replaces Flask's /assets ETag, made from the file's mtime and
+            # size, so a touched but unchanged file is still a 304
+            if method == 'GET':
+                headers['ETag'] = content_etag(body)
+            if is_fingerprinted(environ):
+                headers['Cache-Control'] = IMMUTABLE
+            elif headers.get('Cache-Control') is None or static:
+                headers['Cache-Control'] = REVALIDATE
+
+        if (headers.get('Content-Encoding') is None and method != 'HEAD'
+                and is_compressible(headers.get('Content-Type'))
+                and len(body) >= self.min_size):
+            add_vary(headers, 'Accept-Encoding')
+            encoding = negotiate_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+            if encoding is not None:
+                etag = headers.get('ETag')
+                body = self.compressed(body, encoding, etag if static else None)
+                headers['Content-Encoding'] = encoding
+                if etag is not None:
+                    headers['ETag'] = encoded_etag(etag, encoding)
+
+        etag = headers.get('ETag')
+        if cacheable and etag is not None and etag_matches(environ.get('HTTP_IF_NONE_MATCH'), etag):
+            for name in ('Content-Length', 'Content-Encoding', 'Content-Type'):
+                del headers[name]
+            return '304 Not Modified', headers, b''
+        if method != 'HEAD':
+            headers['Content-Length'] = str(len(body))
+        return status, headers, body
+
+    def compressed(self, body, encoding, etag):
+        # Static files are compressed hard once per ETag; anything else fast
+        # and every time
+        if etag is None:
+            return compress(body, encoding, DYNAMIC_LEVELS)
+        key = (etag, encoding)
+        with self._lock:
+            variant = self._static_variants.get(key)
+            if variant is not None:
+                self._static_variants.move_to_end(key)
+                return variant
+        variant = compress(body, encoding, STATIC_LEVELS)
+        with self._lock:
+            self._static_variants[key] = variant
+            while len(self._static_variants) > self.max_static_variants:
+                self._static_variants.popitem(last=False)
+        return variant
@@ -0,0 +1,45 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+# Run from anywhere without installing the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# testapp won't import without a data directory; never the real one
+os.environ['TESTAPP_DATA_PATH'] = tempfile.mkdtemp(prefix='testapp-tests-')
+atexit.register(shutil.rmtree, os.environ['TESTAPP_DATA_PATH'], True)
+
+from ibapi.contract import Contract
+
+from fintech_ibkr import pacing
+from fintech_ibkr.simulator import tws_simulator
+from fintech_ibkr.synchronous_functions import close_session_pools
+
+
+def make_contract(symbol='EUR'):
+    contract = Contract()
+    contract.symbol = symbol
+    contract.secType = 'CASH'
+    contract.exchange = 'IDEALPRO'
+    contract.currency = 'USD'
+    return contract
+
+
+@pytest.fixture
+def simulator():
+    # port=0: a free port per test, so every test gets its own session pools
+    with tws_simulator(port=0, skip_weekends=False) as sim:
+        yield sim
+        close_session_pools()
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    # A fresh scheduler, without the 15 second wait between identical requests
+    scheduler = pacing.pacing_scheduler()
+    monkeypatch.setattr(pacing, '_default_scheduler', scheduler)
+    monkeypatch.setattr(pacing, 'IDENTICAL_REQUEST_SECONDS', 0)
+    return scheduler
@@ -0,0 +1,18 @@
+import app
+
+
+def test_renderer_gets_the_callbacks_of_the_page_it_is_on():
+    client = app.server.test_client()
+    page = 'http://localhost/homework_3.1'
+    dependencies = client.get('/_dash-dependencies', headers={'Referer': page}).get_json()
+    outputs = {dependency['output'] for dependency in dependencies}
+    # The app's own callback plus the chart page's
+    assert 'page-content.children' in outputs and len(outputs) > 2
+    # A request from a page this worker hasn't served loads that page first
+    body = {'output': 'ticker-output.children',
+            'outputs': {'id': 'ticker-output', 'property': 'children'},
+            'inputs': [{'id': 'ticker-input', 'property': 'value', 'value': 'EUR'}],
+            'changedPropIds': ['ticker-input.value']}
+    response = client.post('/_dash-update-component', json=body,
+                           headers={'Referer': 'http://localhost/'})
+    assert response.get_json()['response']['ticker-output']['children'] == 'You chose: EUR'
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+from ibapi.order import Order
+
+from fintech_ibkr.backtest import backtest_signals, replay
+
+
+def make_bars(dates, price=100.0):
+    n = len(dates)
+    return pd.DataFrame({'date': pd.to_datetime(dates), 'open': price, 'high': price + 1,
+                         'low': price - 1, 'close': price, 'volume': 1.0}, index=range(n))
+
+
+def limit_buy(price, tif):
+    order = Order()
+    order.action, order.orderType, order.totalQuantity = 'BUY', 'LMT', 10
+    order.lmtPrice, order.tif = price, tif
+    return order
+
+
+# Hourly bars: the last two of one day, then the next day
+DATES = ['2026-01-05 22:00', '2026-01-05 23:00', '2026-01-06 00:00', '2026-01-06 01:00']
+
+
+@pytest.mark.parametrize('tif, status', [('DAY', 'Cancelled'), ('', 'Cancelled'), ('GTC', 'Submitted')])
+def test_day_order_sent_on_the_last_bar_of_a_day_expires_with_it(tif, status):
+    orders = []
+
+    def strategy(broker, bar):
+        if bar.date == pd.Timestamp(DATES[1]):
+            # Below the next bar's low, so it keeps working if allowed to
+            orders.append(broker.submit_order(limit_buy(50, tif)))
+
+    result = replay(make_bars(DATES), strategy)
+    assert result.orders.get(orders[0]).status == status
+    assert not len(result.fills)
+
+
+def test_day_order_fills_on_the_day_it_was_sent():
+    orders = []
+
+    def strategy(broker, bar):
+        if bar.date == pd.Timestamp(DATES[2]):
+            orders.append(broker.submit_order(limit_buy(99.5, 'DAY')))
+
+    result = replay(make_bars(DATES), strategy)
+    assert result.orders.get(orders[0]).status == 'Filled'
+    assert result.fills['date'].tolist() == [pd.Timestamp(DATES[3])]
+
+
+def test_signals_trade_at_the_next_open():
+    bars = make_bars(DATES)
+    bars['open'] = [1.0, 2.0, 3.0, 4.0]
+    result = backtest_signals(bars, [1, np.nan, 0, 0], quantity=10)
+    assert result.equity['position'].tolist() == [0, 10, 10, 0]
+    assert result.fills['price'].tolist() == [2.0, 4.0]
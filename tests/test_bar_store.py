@@ -0,0 +1,94 @@
+import time
+
+import pandas as pd
+import pytest
+
+from conftest import make_contract
+from fintech_ibkr import bar_store
+from fintech_ibkr.bar_buffer import BAR_COLUMNS
+from fintech_ibkr.synchronous_functions import fetch_historical_data, request_historical_data
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = bar_store.bar_store(str(tmp_path / 'bar_cache'))
+    monkeypatch.setattr(bar_store, '_default_store', store)
+    return store
+
+
+@pytest.fixture
+def new_york(monkeypatch):
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def bars_at(dates):
+    n = len(dates)
+    return pd.DataFrame({
+        'date': pd.to_datetime(dates), 'open': range(n), 'high': range(n), 'low': range(n),
+        'close': range(n), 'volume': [1.0] * n, 'wap': range(n), 'count': [1] * n,
+    })[BAR_COLUMNS].astype({'open': float, 'high': float, 'low': float, 'close': float, 'wap': float})
+
+
+@pytest.mark.parametrize('endDateTime', ['20260105 00:00:00', ''])
+def test_cached_window_is_what_ib_returns(simulator, scheduler, store, endDateTime):
+    args = (make_contract(), endDateTime, '2 D', '1 hour', 'MIDPOINT', True)
+    cached = fetch_historical_data(*args, port=simulator.port)
+    direct = request_historical_data(*args, port=simulator.port)
+    pd.testing.assert_frame_equal(cached.reset_index(drop=True), direct)
+    # The repeat is answered from the store
+    dispatched = scheduler.metrics()['dispatched']
+    pd.testing.assert_frame_equal(fetch_historical_data(*args, port=simulator.port), cached)
+    assert scheduler.metrics()['dispatched'] == dispatched
+
+
+def test_repeated_dst_hour_keeps_both_bars(new_york, store):
+    # Clocks go back from 02:00 EDT to 01:00 EST on 2026-11-01
+    dates = ['2026-11-01 00:00', '2026-11-01 00:30', '2026-11-01 01:00', '2026-11-01 01:30',
+             '2026-11-01 01:00', '2026-11-01 01:30', '2026-11-01 02:00']
+    end = bar_store.request_end('20261101 03:00:00')
+    gap = bar_store.gap_request(end - 4 * 3600, end, '', '', None)
+    store.write('key', {}, bars_at(dates), gap)
+    read = store.read('key', end - 4 * 3600, end)
+    assert list(read['date']) == list(pd.to_datetime(dates))
+    assert list(read['close']) == list(range(len(dates)))
+
+
+def test_only_missing_parts_are_fetched(simulator, scheduler, store):
+    contract = make_contract()
+    args = ('20260105 00:00:00', '1 hour', 'MIDPOINT', True)
+
+    def fetch(durationStr):
+        return fetch_historical_data(contract, args[0], durationStr, *args[1:], port=simulator.port)
+
+    fetch('14400 S')
+    dispatched = scheduler.metrics()['dispatched']
+    # Twice the window: one request for the older half only
+    cached = fetch('28800 S')
+    assert scheduler.metrics()['dispatched'] == dispatched + 1
+    direct = request_historical_data(contract, args[0], '28800 S', *args[1:], port=simulator.port)
+    pd.testing.assert_frame_equal(cached.reset_index(drop=True), direct)
+    dispatched = scheduler.metrics()['dispatched']
+    # Inside what is cached: no requests at all
+    fetch('3600 S')
+    assert scheduler.metrics()['dispatched'] == dispatched
+
+
+def test_segments_are_compacted_and_later_writes_win(store):
+    hour = 3600
+    start = bar_store.request_end('20260105 00:00:00')
+    dates = pd.date_range('2026-01-05', periods=bar_store.MAX_SEGMENTS + 1, freq='h')
+    for i in range(len(dates)):
+        # Each write refetches the previous bar, with a new close
+        bars = bars_at(dates[max(i - 1, 0):i + 1]).assign(close=float(i))
+        store.write('key', {}, bars, bar_store.gap_request(start + (i - 1) * hour, start + (i + 1) * hour,
+                                                         '', '', None))
+    meta = store._meta('key')
+    assert len(meta['segments']) == 1
+    assert meta['coverage'] == [[start - hour, start + len(dates) * hour]]
+    read = store.read('key')
+    assert list(read['date']) == list(dates)
+    assert list(read['close']) == [float(i) for i in range(1, len(dates))] + [float(len(dates) - 1)]
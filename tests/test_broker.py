@@ -0,0 +1,14 @@
+import pytest
+
+from fintech_ibkr import broker
+
+
+def test_unreachable_broker_is_a_connection_error(tmp_path, monkeypatch):
+    monkeypatch.setenv(broker.BROKER_ADDRESS_ENV, str(tmp_path / 'missing.sock'))
+    monkeypatch.setenv(broker.BROKER_AUTHKEY_ENV, broker.new_broker_authkey())
+    monkeypatch.setattr(broker, '_client', None)
+    for _ in range(2):
+        # Tried afresh on every call
+        with pytest.raises(ConnectionError):
+            broker.fetch_managed_accounts()
+        assert broker._client is None
@@ -0,0 +1,31 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from testapp.callback_cache import memoize_callback
+
+
+def test_counts_every_call_across_threads():
+    calls = []
+
+    @memoize_callback(ignore=('n_clicks',), shared=False)
+    def update(n_clicks, symbol):
+        calls.append(symbol)
+        return symbol.lower()
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda i: update(i, ['EUR', 'GBP'][i % 2]), range(400)))
+    assert results == [['eur', 'gbp'][i % 2] for i in range(400)]
+    stats = update.cache_stats()
+    assert stats['hits'] + stats['misses'] == 400
+    assert stats['misses'] == len(calls) and stats['size'] == 2
+
+
+def test_uncacheable_results_are_recomputed():
+    @memoize_callback(shared=False, should_cache=lambda result: result is not None)
+    def lookup(symbol):
+        return None
+
+    lookup('EUR')
+    lookup('EUR')
+    assert lookup.cache_stats()['misses'] == 2
+    lookup.cache_clear()
+    assert lookup.cache_stats()['misses'] == 0
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+
+from fintech_ibkr.downsampling import aggregate_bars, downsample_bars
+
+
+def make_bars(n):
+    rng = np.random.default_rng(0)
+    close = 100 + rng.standard_normal(n).cumsum()
+    return pd.DataFrame({
+        'date': pd.date_range('2026-01-05', periods=n, freq='min'),
+        'open': close + 0.1, 'high': close + 1, 'low': close - 1, 'close': close,
+        'volume': np.ones(n), 'wap': close, 'count': np.ones(n, dtype=np.int64),
+    })
+
+
+def test_candles_keep_the_ohlc_of_their_bars():
+    bars = make_bars(10_000)
+    candles = aggregate_bars(bars, 100)
+    # Buckets are aligned to the clock, not the first bar: one may be split
+    assert len(candles) <= 101
+    starts = np.searchsorted(bars['date'].values, candles['date'].values)
+    ends = np.append(starts[1:], len(bars))
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        group = bars.iloc[start:end]
+        assert candles['open'][i] == group['open'].iloc[0]
+        assert candles['high'][i] == group['high'].max()
+        assert candles['low'][i] == group['low'].min()
+        assert candles['close'][i] == group['close'].iloc[-1]
+        assert candles['count'][i] == len(group)
+    assert candles['volume'].sum() == bars['volume'].sum()
+    # Few enough already: untouched
+    few = bars.iloc[:50]
+    assert aggregate_bars(few, 100) is few
+
+
+def test_viewport_gets_full_resolution_and_context_the_rest():
+    bars = make_bars(10_000)
+    start, end = bars['date'][5000], bars['date'][5099]
+    candles = downsample_bars(bars, 200, start, end)
+    inside = candles[(candles['date'] >= start) & (candles['date'] <= end)]
+    pd.testing.assert_frame_equal(inside.reset_index(drop=True), bars.iloc[5000:5100].reset_index(drop=True))
+    assert candles['date'].iloc[0] == bars['date'][0]
+    assert len(candles) <= 100 + 200 * 0.25 + 2
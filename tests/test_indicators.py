@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+
+from fintech_ibkr.indicators import STANDARD_INDICATORS, bar_rows, standard_engine
+from fintech_ibkr.simulator import synthetic_bars
+
+KEYS = list(STANDARD_INDICATORS)
+
+
+def make_bars(n, bar_seconds=3600, start=1_767_225_600):
+    bars = synthetic_bars('EUR.USD', start, start + n * bar_seconds, bar_seconds, skip_weekends=False)
+    frame = pd.DataFrame({column: bars[column] for column in ['open', 'high', 'low', 'close', 'volume']})
+    frame.insert(0, 'date', pd.to_datetime(bars['time'], unit='s'))
+    return frame.astype({'volume': 'float64'})
+
+
+def test_streaming_matches_whole_history():
+    bars = make_bars(300)
+    full = standard_engine(KEYS).compute(bars)
+    engine = standard_engine(KEYS)
+    engine.compute(bars.iloc[:100], forming=True)
+    streamed = []
+    for i in range(100, len(bars)):
+        # A revision of the forming bar, then the next bar
+        revised = bars.iloc[i - 1:i].assign(close=lambda frame: frame['close'] + 1)
+        engine.update(revised)
+        streamed.append(engine.update(bars.iloc[i - 1:i + 1])[0])
+    expected = full[engine.columns].to_numpy()[99:len(bars) - 1]
+    np.testing.assert_allclose(np.array(streamed), expected, rtol=1e-9)
+
+
+def test_step_and_update_agree():
+    bars = make_bars(80)
+    by_frame, by_row = standard_engine(KEYS), standard_engine(KEYS)
+    by_frame.compute(bars.iloc[:40], forming=True)
+    by_row.compute(bars.iloc[:40], forming=True)
+    values = by_frame.update(bars.iloc[40:])
+    assert values.shape == (40, len(by_frame.columns))
+    np.testing.assert_array_equal(values, np.array([by_row.step(bar) for bar in bar_rows(bars.iloc[40:])]))
+    # Bars older than the last completed one get NaN
+    assert np.isnan(by_frame.update(bars.iloc[:1])).all()
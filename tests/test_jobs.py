@@ -0,0 +1,69 @@
+import threading
+import time
+
+import pytest
+
+from testapp.jobs import job_pool, job_cancelled, job_pool_full, check_cancelled, report_progress, \
+    CANCELLED, DONE, FAILED, RUNNING, QUEUED
+
+
+def wait_for(pool, job_id, statuses, timeout=2):
+    deadline = time.monotonic() + timeout
+    while pool.status(job_id)['status'] not in statuses:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    return pool.status(job_id)
+
+
+@pytest.fixture
+def pool():
+    pool = job_pool(max_workers=1, max_queued=1)
+    yield pool
+    pool.shutdown()
+
+
+def test_result_and_failure_are_collected_once(pool):
+    def slow(x):
+        report_progress(0.5, 'Halfway')
+        return x * 2
+
+    job_id = pool.submit(slow, 21)
+    assert wait_for(pool, job_id, (DONE,))['progress'] == 1.0
+    assert pool.collect(job_id) == 42
+    assert pool.status(job_id) is None
+
+    job_id = pool.submit(lambda: 1 / 0)
+    wait_for(pool, job_id, (FAILED,))
+    with pytest.raises(ZeroDivisionError):
+        pool.collect(job_id)
+
+
+def test_cancelling_queued_and_running_jobs(pool):
+    started, release = threading.Event(), threading.Event()
+    ran = []
+
+    def running():
+        started.set()
+        release.wait(2)
+        check_cancelled()
+        ran.append('running')
+
+    first = pool.submit(running)
+    assert started.wait(2)
+    second = pool.submit(lambda: ran.append('queued'))
+    assert pool.status(second)['status'] == QUEUED
+    # Only one may wait in the queue
+    with pytest.raises(job_pool_full):
+        pool.submit(lambda: None)
+
+    assert pool.cancel(second)
+    assert pool.status(second)['status'] == CANCELLED
+    assert pool.status(first)['status'] == RUNNING
+    assert pool.cancel(first)
+    release.set()
+    wait_for(pool, first, (CANCELLED,))
+    for job_id in (first, second):
+        with pytest.raises(job_cancelled):
+            pool.collect(job_id)
+    assert ran == []
+    assert not pool.cancel(first)
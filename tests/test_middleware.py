@@ -0,0 +1,74 @@
+import gzip
+
+import pytest
+
+from testapp import middleware
+from testapp.middleware import caching_middleware, IMMUTABLE, REVALIDATE
+
+BIG = b'{"values": [' + b', '.join(b'%d' % i for i in range(1000)) + b']}'
+
+
+def json_app(body):
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [body]
+    return app
+
+
+def call(app, path='/_dash-layout', method='GET', **headers):
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': ''}
+    environ.update({'HTTP_' + name.upper(): value for name, value in headers.items()})
+    response = {}
+
+    def start_response(status, response_headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = dict(response_headers)
+
+    response['body'] = b''.join(app(environ, start_response))
+    return response
+
+
+@pytest.fixture(autouse=True)
+def gzip_only(monkeypatch):
+    # Whether or not brotli is installed
+    monkeypatch.setattr(middleware, 'brotli', None)
+
+
+def test_etag_revalidates_to_an_empty_304():
+    app = caching_middleware(json_app(BIG))
+    first = call(app)
+    assert first['status'] == '200 OK' and first['body'] == BIG
+    assert first['headers']['Cache-Control'] == REVALIDATE
+    second = call(app, if_none_match=first['headers']['ETag'])
+    assert second['status'] == '304 Not Modified' and second['body'] == b''
+    assert 'Content-Length' not in second['headers']
+
+
+def test_gzip_when_accepted_and_worth_it():
+    app = caching_middleware(json_app(BIG))
+    response = call(app, accept_encoding='gzip, deflate')
+    assert response['headers']['Content-Encoding'] == 'gzip'
+    assert response['headers']['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(response['body']) == BIG
+    assert response['headers']['Content-Length'] == str(len(response['body']))
+    # The compressed body has its own ETag, which revalidates too
+    etag = response['headers']['ETag']
+    assert etag.endswith('-gzip"')
+    assert call(app, accept_encoding='gzip', if_none_match=etag)['status'] == '304 Not Modified'
+
+    assert 'Content-Encoding' not in call(app, accept_encoding='gzip;q=0')['headers']
+    small = call(caching_middleware(json_app(b'{}')), accept_encoding='gzip')
+    assert 'Content-Encoding' not in small['headers'] and small['body'] == b'{}'
+
+
+def test_posted_callbacks_are_compressed_but_not_cached():
+    response = call(caching_middleware(json_app(BIG)), path='/_dash-update-component',
+                    method='POST', accept_encoding='gzip')
+    assert response['headers']['Content-Encoding'] == 'gzip'
+    assert 'ETag' not in response['headers'] and 'Cache-Control' not in response['headers']
+
+
+def test_fingerprinted_bundles_are_immutable():
+    app = caching_middleware(json_app(BIG))
+    response = call(app, path='/_dash-component-suites/dash/dcc/dash_core_components.v2_1_0m1646.min.js')
+    assert response['headers']['Cache-Control'] == IMMUTABLE
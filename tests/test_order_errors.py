@@ -0,0 +1,55 @@
+from ibapi.order import Order
+
+import pytest
+
+from conftest import make_contract
+from fintech_ibkr import order_journal
+from fintech_ibkr.synchronous_functions import ibkr_app, ibkr_request_error, submit_order
+
+
+def order_status(app, order_id, status, filled=0.0):
+    app.orderStatus(order_id, status, filled, 1.0, 0.0, 1, 0, 0.0, 1, '', 0.0)
+
+
+def test_notice_for_a_live_order_keeps_waiting():
+    app = ibkr_app()
+    future = app.start_order(5)
+    app.error(5, 2109, 'Order Event Warning: Attribute Outside Regular Trading Hours is ignored')
+    app.error(5, 10167, 'Requested market data is not subscribed. Displaying delayed market data.')
+    assert not future.done()
+    order_status(app, 5, 'PreSubmitted')
+    assert future.result(0) == 'PreSubmitted'
+
+
+def test_rejected_order_fails():
+    app = ibkr_app()
+    future = app.start_order(6)
+    app.error(6, 201, 'Order rejected - reason:')
+    with pytest.raises(ibkr_request_error):
+        future.result(0)
+
+
+def test_cancelled_status_fails_the_order():
+    app = ibkr_app()
+    future = app.start_order(7)
+    order_status(app, 7, 'Cancelled')
+    with pytest.raises(ibkr_request_error):
+        future.result(0)
+
+
+def test_other_requests_still_fail_on_errors():
+    app = ibkr_app()
+    future = app.start_request(8)
+    app.error(8, 10167, 'Requested market data is not subscribed.')
+    with pytest.raises(ibkr_request_error):
+        future.result(0)
+
+
+def test_submit_order_through_the_simulator(simulator, tmp_path, monkeypatch):
+    journal = order_journal.order_journal(str(tmp_path / 'orders.sqlite3'),
+                                          str(tmp_path / 'submitted_orders.csv'))
+    monkeypatch.setattr(order_journal, '_default_journal', journal)
+    order = Order()
+    order.action, order.orderType, order.totalQuantity = 'BUY', 'MKT', 20000
+    assert 'successfully submitted' in submit_order(make_contract(), order, port=simulator.port)
+    assert len(journal.to_frame()) == 1
@@ -0,0 +1,80 @@
+import pytest
+
+from fintech_ibkr.order_journal import order_journal, filter_query_to_sql, sort_by_to_sql
+
+ORDERS = [
+    {'timestamp': '2026-01-05 10:00:00', 'order_id': 1, 'symbol': 'AAPL', 'action': 'BUY',
+     'size': 10, 'order_type': 'LMT', 'lmt_price': '170.00'},
+    {'timestamp': '2026-01-06 11:00:00', 'order_id': 2, 'symbol': 'EUR', 'action': 'SELL',
+     'size': 20000, 'order_type': 'MKT', 'lmt_price': 'N/A'},
+    {'timestamp': '2026-01-06 12:00:00', 'order_id': 3, 'symbol': 'AA_B', 'action': 'BUY',
+     'size': 5, 'order_type': 'MKT', 'lmt_price': 'N/A'},
+]
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = order_journal(str(tmp_path / 'orders.sqlite3'), None)
+    for record in ORDERS:
+        journal.append(record)
+    return journal
+
+
+def symbols(journal, filter_query='', sort_by=None):
+    page, total = journal.query(filter_query=filter_query, sort_by=sort_by)
+    assert total == len(page)
+    return page['symbol'].tolist()
+
+
+def test_filter_query_to_sql():
+    assert filter_query_to_sql('{symbol} contains AA && {size} > 5') == (
+        "WHERE symbol LIKE ? ESCAPE '\\' AND size > ?", ['%AA%', '5'])
+    assert filter_query_to_sql('{timestamp} datestartswith "2026-01"') == (
+        "WHERE timestamp LIKE ? ESCAPE '\\'", ['2026-01%'])
+    assert filter_query_to_sql('{symbol} s= EUR') == ('WHERE symbol = ?', ['EUR'])
+    # Unknown columns and unparseable parts are dropped
+    assert filter_query_to_sql('{password} = x && nonsense') == ('', [])
+
+
+def test_filters_against_the_journal(journal):
+    assert symbols(journal, '{symbol} contains AA') == ['AAPL', 'AA_B']
+    # LIKE wildcards in the value are literal
+    assert symbols(journal, '{symbol} contains A_') == ['AA_B']
+    assert symbols(journal, '{size} >= 10 && {action} = BUY') == ['AAPL']
+    assert symbols(journal, '{timestamp} datestartswith 2026-01-06') == ['EUR', 'AA_B']
+    assert symbols(journal, sort_by=[{'column_id': 'size', 'direction': 'desc'}]) == ['EUR', 'AAPL', 'AA_B']
+
+
+@pytest.mark.parametrize('filter_query, expected', [
+    ("{symbol} = AAPL' OR '1'='1", []),
+    ('{symbol} = x; DROP TABLE orders; --', []),
+    ('{symbol} = "AAPL" OR 1=1 --"', []),
+    ('{symbol} contains %', []),
+    # Not a known column: ignored, like any other part that doesn't parse
+    ('{symbol) = 1 OR 1=1; --} = x', ['AAPL', 'EUR', 'AA_B']),
+])
+def test_injection_shaped_filters_are_only_values(journal, filter_query, expected):
+    where, params = filter_query_to_sql(filter_query)
+    assert where.count('?') == len(params)
+    assert symbols(journal, filter_query) == expected
+    assert len(journal.to_frame()) == len(ORDERS)
+
+
+def test_sort_by_only_takes_known_columns():
+    assert sort_by_to_sql([{'column_id': 'size; DROP TABLE orders', 'direction': 'asc'},
+                           {'column_id': 'symbol', 'direction': 'desc; DROP TABLE orders'}]) == \
+        'ORDER BY symbol ASC, id'
+
+
+def test_legacy_csv_is_imported_once(tmp_path):
+    csv_path = tmp_path / 'submitted_orders.csv'
+    csv_path.write_text('timestamp,order_id,symbol,action,size,order_type,lmt_price\n'
+                        '2026-01-05 10:00:00,7,AAPL,BUY,10,LMT,170.00\n'
+                        '2026-01-05 10:01:00,8,EUR,SELL,20000,MKT,N/A\n')
+    journal = order_journal(str(tmp_path / 'orders.sqlite3'), str(csv_path))
+    assert journal.import_csv(str(csv_path)) == 0
+    # Reopening doesn't import it again either
+    journal = order_journal(str(tmp_path / 'orders.sqlite3'), str(csv_path))
+    frame = journal.to_frame()
+    assert frame['order_id'].tolist() == [7, 8]
+    assert frame['lmt_price'].tolist() == ['170.00', 'N/A']
@@ -0,0 +1,110 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+from conftest import make_contract
+from fintech_ibkr.synchronous_functions import request_historical_data, session_pool
+
+HISTORY = (make_contract(), '20260105 00:00:00', '1 D', '1 hour', 'MIDPOINT', True)
+
+
+def test_timed_out_request_is_forgotten(simulator, scheduler):
+    simulator.latency = 0.5
+    with pytest.raises(TimeoutError):
+        request_historical_data(*HISTORY, port=simulator.port, timeout=0.1)
+    assert not scheduler._pending and not scheduler._requests
+    # The next identical request goes out afresh instead of joining the
+    # abandoned one
+    simulator.latency = 0
+    assert len(request_historical_data(*HISTORY, port=simulator.port, timeout=5)) == 24
+    assert scheduler.metrics()['dispatched'] == 2
+
+
+def test_coalesced_caller_outlives_the_first(simulator, scheduler):
+    simulator.latency = 0.5
+    with ThreadPoolExecutor(2) as pool:
+        first = pool.submit(request_historical_data, *HISTORY, port=simulator.port, timeout=0.1)
+        time.sleep(0.05)
+        second = pool.submit(request_historical_data, *HISTORY, port=simulator.port, timeout=5)
+        with pytest.raises(TimeoutError):
+            first.result()
+        assert len(second.result()) == 24
+    metrics = scheduler.metrics()
+    assert metrics['dispatched'] == 1 and metrics['coalesced'] == 1
+    assert not scheduler._pending
+
+
+def test_last_caller_giving_up_cancels_upstream(simulator, scheduler):
+    simulator.latency = 0.5
+    with ThreadPoolExecutor(2) as pool:
+        calls = [pool.submit(request_historical_data, *HISTORY, port=simulator.port, timeout=0.1)
+                 for _ in range(2)]
+        for call in calls:
+            with pytest.raises(TimeoutError):
+                call.result()
+    assert not scheduler._pending and not scheduler._requests
+    # on_abandon forgot the reqId, so the late answer goes nowhere
+    with session_pool(port=simulator.port).session() as app:
+        assert not app._requests
+
+
+def test_queued_request_is_withdrawn(scheduler):
+    issued = []
+    scheduler._last_by_key['key'] = scheduler.timer() + 60
+    future = scheduler.submit(lambda: issued.append(1), 'key', 'contract')
+    second = scheduler.submit(lambda: issued.append(2), 'key', 'contract')
+    assert second is future
+    # One of the two callers leaving keeps it queued for the other
+    assert not scheduler.cancel(future)
+    assert scheduler.metrics()['queue_depth'] == 1
+    assert scheduler.cancel(future)
+    assert future.cancelled()
+    assert scheduler.metrics()['queue_depth'] == 0
+    assert not scheduler._pending and not issued
+
+
+def test_request_abandoned_while_sending(scheduler):
+    sending, release = threading.Event(), threading.Event()
+    abandoned = threading.Event()
+
+    def issue():
+        sending.set()
+        release.wait()
+        return 'sent'
+
+    future = scheduler.submit(issue, 'key', 'contract', on_abandon=abandoned.set)
+    assert sending.wait(2)
+    assert scheduler.cancel(future)
+    assert not abandoned.is_set()
+    release.set()
+    assert abandoned.wait(2)
+    assert future.cancelled()
+
+
+def test_request_waiting_to_send_holds_up_nothing(scheduler):
+    release = threading.Event()
+    blocked = scheduler.submit(lambda: release.wait(5) and 'late', 'blocked', 'a')
+    # A request behind one stuck checking out a connection still goes out
+    assert scheduler.submit(lambda: 'prompt', 'free', 'b').result(timeout=2) == 'prompt'
+    assert not blocked.done()
+    release.set()
+    assert blocked.result(timeout=2) == 'late'
+
+
+def test_cancelled_while_answer_arrives(scheduler):
+    answers = []
+
+    def issue():
+        answer = Future()
+        answers.append(answer)
+        return answer
+
+    future = scheduler.submit(issue, 'key', 'contract')
+    while not answers:
+        time.sleep(0.01)
+    assert scheduler.cancel(future)
+    answers[0].set_result('too late')
+    # The dispatcher survives settling a cancelled Future
+    assert scheduler.submit(lambda: 'next', 'other', 'contract').result(timeout=2) == 'next'
@@ -0,0 +1,78 @@
+import threading
+import time
+
+import pytest
+
+from conftest import make_contract
+from fintech_ibkr.client_ids import client_id_allocator
+from fintech_ibkr.sessions import ibkr_session_pool
+from fintech_ibkr.synchronous_functions import ibkr_app, request_historical_data, \
+    fetch_contract_details, session_pool
+
+
+def test_checkout_reuses_the_connection(simulator):
+    pool = ibkr_session_pool(ibkr_app, '127.0.0.1', simulator.port, 500, size=1)
+    with pool.session() as app:
+        assert app.isConnected()
+    with pool.session() as again:
+        assert again is app
+    pool.close()
+
+
+def test_checkout_reconnects_a_dropped_connection(simulator):
+    # TWS may not have noticed the old socket close yet, the allocator moves
+    # on to another id if it refuses this one
+    pool = ibkr_session_pool(ibkr_app, '127.0.0.1', simulator.port, 510, size=1,
+                             allocator=client_id_allocator(510, 519, path=None))
+    with pool.session() as app:
+        app.disconnect()
+    with pool.session() as reconnected:
+        assert reconnected is not app and reconnected.isConnected()
+    pool.close()
+
+
+def test_checkout_times_out_when_every_slot_is_busy(simulator):
+    pool = ibkr_session_pool(ibkr_app, '127.0.0.1', simulator.port, 520, size=1)
+    with pool.session():
+        with pytest.raises(TimeoutError):
+            with pool.session(timeout=0.1):
+                pass
+    pool.close()
+    with pytest.raises(RuntimeError):
+        with pool.session():
+            pass
+
+
+def test_requests_in_flight_hold_no_connection(simulator, scheduler):
+    # Slow history requests must leave the pool free for orders and
+    # contract lookups.
+    simulator.latency = 0.5
+    pool = session_pool(port=simulator.port)
+    calls = [threading.Thread(target=request_historical_data,
+                              args=(make_contract(symbol),) + ('20260105 00:00:00', '1 D', '1 hour',
+                                                               'MIDPOINT', True),
+                              kwargs={'port': simulator.port})
+             for symbol in ['EUR', 'GBP', 'AUD']]
+    for call in calls:
+        call.start()
+    time.sleep(0.2)
+    assert scheduler.metrics()['in_flight'] == 3
+    with pool.session(timeout=0.1), pool.session(timeout=0.1):
+        pass
+    simulator.latency = 0
+    assert fetch_contract_details(make_contract('CHF'), port=simulator.port,
+                                  use_cache=False, timeout=2) is not None
+    for call in calls:
+        call.join()
+
+
+def test_request_ids_start_at_next_valid_id(simulator, scheduler):
+    pool = session_pool(port=simulator.port)
+    # Nothing to seed the counter from before the first connection
+    with pytest.raises(RuntimeError):
+        pool.next_request_id()
+    request_historical_data(make_contract(), '20260105 00:00:00', '1 D', '1 hour',
+                            'MIDPOINT', True, port=simulator.port)
+    with pool.session() as app:
+        # The request above used nextValidId itself
+        assert pool.next_request_id() == app.next_valid_id + 1
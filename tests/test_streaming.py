@@ -0,0 +1,53 @@
+import time
+
+from conftest import make_contract
+from fintech_ibkr.streaming import subscription_broker
+
+
+class fake_subscription:
+    def __init__(self):
+        self.alive = True
+        self.cancelled = False
+
+    def cancel(self):
+        self.alive = False
+        self.cancelled = True
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_viewers_share_one_upstream():
+    subscriptions = []
+
+    def subscribe(*args, **kwargs):
+        subscriptions.append(fake_subscription())
+        return subscriptions[-1]
+
+    broker = subscription_broker(subscribe)
+    first = broker.attach('a', make_contract(), '5 secs', 'MIDPOINT', True)
+    second = broker.attach('b', make_contract(), '5 secs', 'MIDPOINT', True)
+    assert first is second and len(subscriptions) == 1
+    broker.detach('a')
+    assert not first.cancelled
+    broker.detach('b')
+    assert first.cancelled
+    assert broker.stats()['upstreams'] == 0
+
+
+def test_abandoned_lone_viewer_is_released():
+    # The only viewer stops polling and nobody attaches again: the reaper
+    # thread still has to cancel the upstream.
+    subscription = fake_subscription()
+    broker = subscription_broker(lambda *args, **kwargs: subscription,
+                                 idle_seconds=0.1, reap_seconds=0.05)
+    broker.attach('a', make_contract(), '5 secs', 'MIDPOINT', True)
+    assert wait_for(lambda: subscription.cancelled)
+    assert not broker._upstreams and not broker._viewers
+    assert wait_for(lambda: broker._reaper is None)